@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Steady-state polling: every poll brings the whole board of each stop again, with a
+# few changed delays and the occasional new departure. Compares saving whole boards
+# with saving only what the ChangeFilter lets through.
+
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from bahnstat.changefilter import ChangeFilter
+from bahnstat.database import DatabaseConnection, DatabaseAccessor
+from bahnstat.datatypes import *
+
+STOPS = 20
+BOARD_SIZE = 40
+POLLS = 30
+CHANGED_DELAYS = 0.05
+
+START = datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(hours=8)
+
+def polls():
+    """the boards of all stops for every poll"""
+    rnd = random.Random(42)
+    stops = [WatchedStop(uuid4(), 7000000 + s, 'Stop {}'.format(s)) for s in range(STOPS)]
+    delays = {}
+
+    for p in range(POLLS):
+        boards = []
+        for s, stop in enumerate(stops):
+            deps = []
+            for i in range(p // 3, p // 3 + BOARD_SIZE):
+                key = (s, i)
+                if key not in delays or rnd.random() < CHANGED_DELAYS:
+                    delays[key] = rnd.choice([None, 0, 0, 1, 2, 5])
+                deps.append(Departure(START + timedelta(minutes=5 * i), 'RB {}'.format(38800 + i), 'Mannheim Hbf',
+                                      stop.backend_stop_id, 10000 + i, 'ddb:90700: :R:j18', delays[key]))
+            boards.append((stop, deps))
+        yield boards
+
+def run(filtered: bool) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        db = DatabaseAccessor(DatabaseConnection(os.path.join(d, 'bench.sqlite')))
+        changes = ChangeFilter()
+        rows = 0
+        elapsed = 0.0
+
+        for p, boards in enumerate(polls()):
+            if p == 0:
+                for stop, deps in boards:
+                    db.persist_watched_stop(stop)
+
+            t = time.perf_counter()
+            for stop, deps in boards:
+                if filtered:
+                    rows += changes.persist(db.persist_departures, stop, deps)
+                else:
+                    db.persist_departures(stop, deps)
+                    rows += len(deps)
+            elapsed += time.perf_counter() - t
+
+        print('{:<14} {:6} rows saved in {} polls, {:7.1f} ms per poll'.format(
+            'change filter' if filtered else 'whole boards', rows, POLLS, elapsed / POLLS * 1000))
+
+if __name__ == '__main__':
+    run(False)
+    run(True)
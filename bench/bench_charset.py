@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+# Charset detection without a charset from the HTTP headers, on the EFA fixture:
+# scanning the whole response for <meta> tags like detect_charset() used to, and the
+# prescan of the first 1024 bytes. Then the whole of parsehtmlbytes() with both.
+
+import os
+import time
+
+import bahnstat.mechanize_mini as minimech
+
+POLLS = 10
+
+def load(name: str) -> bytes:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'testcases', name), 'rb') as f:
+        return f.read()
+
+def full_scan(html: bytes) -> None:
+    parser = minimech._CharsetDetectingHTMLParser()
+    parser.feed(str(html, 'ascii', 'replace'))
+    parser.close()
+
+def timed(f, *args) -> float:
+    t = time.process_time()
+    for i in range(POLLS):
+        f(*args)
+    return (time.process_time() - t) / POLLS * 1000
+
+if __name__ == '__main__':
+    body = load('XML_DM_REQUEST zugausfall rb neustadt.xml')
+    charset = minimech.detect_charset(body)
+    full, prescan = timed(full_scan, body), timed(minimech.detect_charset, body)
+    parse = timed(minimech.parsehtmlbytes, body, charset)
+
+    print('{} KiB, detected {}'.format(len(body) // 1024, charset))
+    print('{:<16} {:8.3f} ms, parsehtmlbytes {:7.2f} ms'.format('full scan', full, full + parse))
+    print('{:<16} {:8.3f} ms, parsehtmlbytes {:7.2f} ms'.format('prescan', prescan, prescan + parse))
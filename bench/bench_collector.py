@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Cycle time of the sequential DB runner loop and of the asyncio collector against a
+# local stand-in for the DB Timetables API, which answers every request after LATENCY
+# seconds. A cycle is one steady-state sync (a single rchg request) of every station.
+
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+from bahnstat.collector import AsyncFetcher, Collector, DbTimetableJob, HostLimit
+from bahnstat.database import DatabaseConnection, DatabaseAccessor
+from bahnstat.datatypes import WatchedStop
+from bahnstat.dbtimetableclient import DbTimetableClient
+from bahnstat.httppool import HttpConnectionPool
+
+LATENCY = 0.05
+STATIONS = [4, 16, 64]
+NOW = datetime(2018, 5, 22, 8, 15)
+
+TESTCASES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'testcases')
+
+def testcase(filename: str) -> bytes:
+    with open(os.path.join(TESTCASES, filename), 'rb') as f:
+        return f.read()
+
+BODIES = {
+    'plan': testcase('dbtimetable plan karlsruhe.xml'),
+    'fchg': testcase('dbtimetable fchg karlsruhe.xml'),
+    'rchg': b"<?xml version='1.0' encoding='UTF-8'?><timetable station='Karlsruhe Hbf'/>",
+}
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(LATENCY)
+        body = BODIES[self.path.split('/')[1]]
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def sequential(url: str, stations) -> float:
+    db = DatabaseAccessor(DatabaseConnection(':memory:'))
+    pool = HttpConnectionPool()
+    clients = [DbTimetableClient(s, apiurl=url, pool=pool) for s in stations]
+    for s in stations:
+        db.persist_watched_stop(s)
+
+    for cycle in range(2):
+        t = time.perf_counter()
+        for c in clients:
+            board = c.current_board(NOW)
+            db.persist_departures(c.station, board.departures)
+            db.persist_arrivals(c.station, board.arrivals)
+
+    pool.close()
+    return time.perf_counter() - t
+
+def concurrent(url: str, stations) -> float:
+    fetcher = AsyncFetcher(default_limit=HostLimit(64), max_workers=64)
+    collector = Collector(':memory:', stations, [DbTimetableJob(s, 60, now=lambda: NOW, apiurl=url) for s in stations],
+                          fetcher, max_clients=64)
+
+    async def cycles() -> float:
+        await collector.collect_once()
+        return await collector.collect_once()
+
+    try:
+        return asyncio.run(cycles())
+    finally:
+        collector.close()
+
+if __name__ == '__main__':
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, kwargs=dict(poll_interval=0.01), daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    for n in STATIONS:
+        stations = [WatchedStop(uuid4(), 8000000 + i, 'Station {}'.format(i)) for i in range(n)]
+        print('{:3} stations: sequential cycle {:6.0f} ms, asyncio cycle {:6.0f} ms'.format(
+            n, sequential(url, stations) * 1000, concurrent(url, stations) * 1000))
+
+    server.shutdown()
+    server.server_close()
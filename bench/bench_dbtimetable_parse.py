@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+# Compares parsing DB Timetables API responses into a minidom tree, like the client
+# used to do, with the streaming expat parser: CPU time and peak memory per poll.
+# The recorded plan and fchg payloads are repeated to the size of a big station.
+
+import io
+import os
+import time
+import tracemalloc
+from xml.dom.minidom import parse as domparse
+
+from bahnstat.dbtimetableclient import DbTimetableStop, _parse_fulltime, _parse_stops
+
+REPEAT = 8
+POLLS = 20
+
+def load(name: str) -> bytes:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'testcases', name), 'rb') as f:
+        xml = f.read()
+
+    decl, root, rest = xml.split(b'\n', 2)
+    body, tail = rest.rsplit(b'</timetable>', 1)
+    return b'\n'.join([decl, root, body * REPEAT]) + b'</timetable>' + tail
+
+def minidom(xml: bytes) -> int:
+    return len([DbTimetableStop.from_domnode(s) for s in domparse(io.BytesIO(xml)).getElementsByTagName('s')])
+
+def streaming(xml: bytes) -> int:
+    return len(_parse_stops(io.BytesIO(xml)))
+
+if __name__ == '__main__':
+    for payload in ['dbtimetable plan karlsruhe.xml', 'dbtimetable fchg karlsruhe.xml']:
+        xml = load(payload)
+        for name, f in [('minidom', minidom), ('streaming', streaming)]:
+            _parse_fulltime.cache_clear()
+            t = time.process_time()
+            for i in range(POLLS):
+                stops = f(xml)
+            elapsed = (time.process_time() - t) / POLLS
+
+            tracemalloc.start()
+            f(xml)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print('{:<32} {:<10} {:5} stops in {:7.2f} ms, peak {:7.0f} KiB'.format(
+                payload, name, stops, elapsed * 1000, peak / 1024))
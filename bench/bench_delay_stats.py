@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Compares the separate median/percentile/stdev aggregates that aggregated_trips() used to
+# call with the combined delay_stats aggregate, on both delay columns like it did.
+
+import math
+import random
+import statistics
+import time
+
+from bahnstat.database import DatabaseConnection
+from bahnstat.delaystats import DelayStats
+
+ROWS = 2000000
+GROUP_SIZE = 360
+
+# the separate aggregates, as DatabaseConnection registered them before delay_stats:
+# each one keeps and sorts or scans its own list of the values
+
+class MedianAggregate:
+    def __init__(self):
+        self.l = []
+
+    def step(self, value):
+        if value is not None:
+            self.l.append(value)
+
+    def finalize(self):
+        if len(self.l) < 1:
+            return None
+        else:
+            return statistics.median(self.l)
+
+class PercentileAggregate:
+    def __init__(self):
+        self.l = []
+        self.percentile = 1
+
+    def step(self, percentile, value):
+        if value is not None:
+            self.l.append(value)
+
+        self.percentile = percentile
+
+    def finalize(self):
+        self.l.sort()
+
+        if len(self.l) < 1:
+            return None
+
+        k = len(self.l) * self.percentile / 100
+        c = math.ceil(k)
+
+        if k == c:
+            return (self.l[int(c)-1] + self.l[int(c)])/2
+        else:
+            return self.l[int(c) - 1]
+
+class StdevAggregate:
+    def __init__(self):
+        self.l = []
+
+    def step(self, value):
+        if value is not None and math.isfinite(value):
+            self.l.append(value)
+
+    def finalize(self):
+        if len(self.l) < 2:
+            return None
+        else:
+            return statistics.stdev(self.l)
+
+def fill(db: DatabaseConnection) -> None:
+    rnd = random.Random(42)
+    db.exec('CREATE TEMP TABLE Delays(grp INTEGER, dep_delay REAL, arr_delay REAL)')
+    db.execmany('INSERT INTO Delays VALUES (:g, :d, :a)',
+                (dict(g=i // GROUP_SIZE,
+                      d=rnd.choice([None, float('inf')]) if rnd.random() < 0.05 else rnd.randrange(-1, 20),
+                      a=rnd.choice([None, float('inf')]) if rnd.random() < 0.05 else rnd.randrange(-3, 25))
+                 for i in range(ROWS)))
+
+def separate(db: DatabaseConnection) -> int:
+    n = 0
+    for row in db.exec('''SELECT grp, median(dep_delay), percentile(90, dep_delay), stdev(dep_delay),
+                                 median(arr_delay), percentile(90, arr_delay), stdev(arr_delay), COUNT(*)
+                          FROM Delays GROUP BY grp'''):
+        n += 1
+    return n
+
+def combined(db: DatabaseConnection) -> int:
+    n = 0
+    for grp, dep, arr, count in db.exec('''SELECT grp, delay_stats(dep_delay, 90), delay_stats(arr_delay, 90), COUNT(*)
+                                           FROM Delays GROUP BY grp'''):
+        DelayStats.from_sql(dep)
+        DelayStats.from_sql(arr)
+        n += 1
+    return n
+
+if __name__ == '__main__':
+    db = DatabaseConnection(':memory:')
+    db.conn.create_aggregate('median', 1, MedianAggregate)
+    db.conn.create_aggregate('percentile', 2, PercentileAggregate)
+    db.conn.create_aggregate('stdev', 1, StdevAggregate)
+    fill(db)
+
+    for name, f in [('separate', separate), ('combined', combined)]:
+        t = time.perf_counter()
+        groups = f(db)
+        elapsed = time.perf_counter() - t
+        print('{:<10} {} rows, {} groups in {:6.2f} s  {:9.0f} rows/s'.format(name, ROWS, groups, elapsed, ROWS / elapsed))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+# Compares parsing an EFA departure monitor into a mechanize_mini tree, like the
+# client used to do, with the streaming expat parser: CPU time and peak memory.
+
+import io
+import os
+import time
+import tracemalloc
+
+from bahnstat.efaxmlclient import _departure_monitor_from_response, parse_monitor
+from bahnstat.mechanize_mini import parsehtmlbytes
+
+POLLS = 10
+
+def load(name: str) -> bytes:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'testcases', name), 'rb') as f:
+        return f.read()
+
+def tree(xml: bytes) -> int:
+    return len(_departure_monitor_from_response(parsehtmlbytes(xml)).departures)
+
+def streaming(xml: bytes) -> int:
+    return len(parse_monitor(io.BytesIO(xml), 'dep').departures)
+
+if __name__ == '__main__':
+    payload = 'XML_DM_REQUEST zugausfall rb neustadt.xml'
+    xml = load(payload)
+    for name, f in [('tree', tree), ('streaming', streaming)]:
+        t = time.process_time()
+        for i in range(POLLS):
+            deps = f(xml)
+        elapsed = (time.process_time() - t) / POLLS
+
+        tracemalloc.start()
+        f(xml)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print('{:<42} {:<10} {:3} departures in {:7.2f} ms, peak {:7.0f} KiB'.format(
+            payload, name, deps, elapsed * 1000, peak / 1024))
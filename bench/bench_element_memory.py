@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+# Memory of the mechanize_mini tree of an EFA departure monitor: the peak while
+# parsing, and what the finished tree keeps, both measured with tracemalloc.
+
+import gc
+import os
+import time
+import tracemalloc
+
+import bahnstat.mechanize_mini as minimech
+
+POLLS = 5
+
+def load(name: str) -> bytes:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'testcases', name), 'rb') as f:
+        return f.read()
+
+if __name__ == '__main__':
+    body = load('XML_DM_REQUEST zugausfall rb neustadt.xml')
+    charset = minimech.detect_charset(body)
+
+    t = time.process_time()
+    for i in range(POLLS):
+        minimech.parsehtmlbytes(body, charset)
+    elapsed = (time.process_time() - t) / POLLS
+
+    gc.collect()
+    tracemalloc.start()
+    root = minimech.parsehtmlbytes(body, charset)
+    gc.collect()
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('{} KiB response, {} elements: parsed in {:.1f} ms, peak {:.0f} KiB, tree {:.0f} KiB'.format(
+        len(body) // 1024, len(list(root.iter())), elapsed * 1000, peak / 1024, kept / 1024))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Compares per-row persistence (one transaction per departure, as the runners
+# used to do it) with persisting whole boards in a single transaction.
+
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from bahnstat.database import DatabaseConnection, DatabaseAccessor, _encode_delay, _encode_trip_code, _to_minutes
+from bahnstat.datatypes import *
+
+BOARDS = 50
+BOARD_SIZE = 40
+
+def legacy_persist_departure(db: DatabaseAccessor, stop: WatchedStop, dep: Departure) -> None:
+    with db.connection:
+        stop_pk, = db.connection.exec('SELECT pk FROM WatchedStop WHERE id = :uuid', uuid=stop.id).fetchone()
+        db.connection.exec('INSERT OR IGNORE INTO LineCodeDictionary(line_code) VALUES (:lc)', lc=dep.line_code)
+        lc, = db.connection.exec('SELECT pk FROM LineCodeDictionary WHERE line_code = :lc', lc=dep.line_code).fetchone()
+        db.connection.exec('INSERT OR IGNORE INTO TrainNameDictionary(train_name) VALUES (:n)', n=dep.train_name)
+        tn, = db.connection.exec('SELECT pk FROM TrainNameDictionary WHERE train_name = :n', n=dep.train_name).fetchone()
+        db.connection.exec('INSERT OR IGNORE INTO OriginDestinationDictionary(name) VALUES (:n)', n=dep.destination)
+        dest, = db.connection.exec('SELECT pk FROM OriginDestinationDictionary WHERE name = :n', n=dep.destination).fetchone()
+
+        time, tc = _to_minutes(dep.time), _encode_trip_code(dep.trip_code)
+        db.connection.exec('''INSERT OR IGNORE
+            INTO Departure (stop_pk, time, trip_code, line_code_pk, destination_pk, train_name_pk)
+            VALUES (:sid, :time, :tc, :lc, :dest, :name)''',
+            sid=stop_pk, time=time, tc=tc, lc=lc, dest=dest, name=tn)
+
+        if dep.delay is not None:
+            db.connection.exec('''UPDATE Departure SET delay = :delay
+                WHERE stop_pk=:sid AND time=:time AND trip_code=:tc AND line_code_pk=:lc''',
+                delay=_encode_delay(dep.delay), sid=stop_pk, time=time, tc=tc, lc=lc)
+
+def make_boards(stop: WatchedStop):
+    rnd = random.Random(42)
+    start = datetime(2018, 5, 22, 6, 0)
+    boards = []
+    for b in range(BOARDS):
+        now = start + timedelta(minutes=2*b)
+        boards.append([Departure(now + timedelta(minutes=3*i), 'RB {}'.format(38800 + (b + i) % 60),
+                                 'Destination {}'.format(i % 12), stop.backend_stop_id,
+                                 str(38800 + b + i), 'ddb:90700: :R:j18', rnd.choice([None, 0, 1, 2, 5]))
+                       for i in range(BOARD_SIZE)])
+    return boards
+
+def run(name, persist_board):
+    with tempfile.TemporaryDirectory() as d:
+        db = DatabaseAccessor(DatabaseConnection(os.path.join(d, 'bench.sqlite')))
+        stop = WatchedStop(uuid4(), 7000090, 'Karlsruhe Hbf')
+        db.persist_watched_stop(stop)
+        boards = make_boards(stop)
+
+        t = time.perf_counter()
+        for board in boards:
+            persist_board(db, stop, board)
+        elapsed = time.perf_counter() - t
+
+    rows = BOARDS * BOARD_SIZE
+    print('{:<10} {:6} rows in {:7.3f} s  {:9.0f} rows/s'.format(name, rows, elapsed, rows / elapsed))
+
+def per_row(db, stop, board):
+    for dep in board:
+        legacy_persist_departure(db, stop, dep)
+
+def batched(db, stop, board):
+    db.persist_departures(stop, board)
+
+if __name__ == '__main__':
+    run('per-row', per_row)
+    run('batched', batched)
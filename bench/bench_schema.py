@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Compares the Departure table of schema v6..v9 (rowid table with TIMESTAMP text,
+# REAL delays and a separate UNIQUE index) with the compact layout of schema v10:
+# size on disk and the time of the range scans behind departures().
+
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from bahnstat.database import DatabaseConnection, _to_minutes
+
+import legacyschema
+
+STOPS = 20
+DAYS = 200
+DEPARTURES_PER_DAY = 100
+SCAN_DAYS = 30
+SCAN_REPEAT = 20
+
+def make_v6_db(dbfile: str) -> None:
+    """a schema v6 database with DAYS days of departures"""
+    rnd = random.Random(42)
+    conn = legacyschema.make_v6_db(dbfile)
+    conn.executemany('INSERT INTO WatchedStop VALUES (?, ?, ?, ?, 1)',
+                     [(s, 'stop-{}'.format(s), 7000000 + s, 'Stop {}'.format(s)) for s in range(1, STOPS + 1)])
+    conn.executemany('INSERT INTO LineCodeDictionary VALUES (?, ?)', [(i, 'ddb:907{:02d}: :R:j18'.format(i)) for i in range(1, 41)])
+    conn.executemany('INSERT INTO OriginDestinationDictionary VALUES (?, ?)', [(i, 'Destination {}'.format(i)) for i in range(1, 41)])
+    conn.executemany('INSERT INTO TrainNameDictionary VALUES (?, ?)', [(i, 'RB {}'.format(38800 + i)) for i in range(1, 41)])
+
+    start = datetime.combine(datetime.now().date() - timedelta(days=DAYS), datetime.min.time())
+    conn.executemany('INSERT INTO Departure VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     ((s, str(start + timedelta(days=d, minutes=5*60 + 10*i)),
+                       rnd.choice([None, float('inf'), 0.0, 0.0, 1.0, 2.0, 5.0, 12.0]),
+                       str(10000 + 100*s + i), i % 40 + 1, i % 40 + 1, i % 40 + 1)
+                      for s in range(1, STOPS + 1) for d in range(DAYS) for i in range(DEPARTURES_PER_DAY)))
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+
+def departure_size(conn: sqlite3.Connection) -> int:
+    size, = conn.execute('''SELECT SUM(pgsize) FROM dbstat
+                            WHERE name IN ('Departure', 'sqlite_autoindex_Departure_1')''').fetchone()
+    return size
+
+def scan(conn: sqlite3.Connection, since) -> float:
+    t = time.perf_counter()
+    for r in range(SCAN_REPEAT):
+        for s in range(1, STOPS + 1):
+            conn.execute('SELECT COUNT(*), SUM(delay) FROM Departure WHERE stop_pk = ? AND time > ?', (s, since)).fetchone()
+    return (time.perf_counter() - t) / SCAN_REPEAT
+
+def report(name: str, size: int, elapsed: float) -> None:
+    print('{:<8} Departure table + unique index {:7.1f} MiB, {}-day scans of {} stops {:7.1f} ms'.format(
+        name, size / 2**20, SCAN_DAYS, STOPS, elapsed * 1000))
+
+if __name__ == '__main__':
+    since = datetime.combine(datetime.now().date() - timedelta(days=SCAN_DAYS), datetime.min.time())
+
+    with tempfile.TemporaryDirectory() as d:
+        dbfile = os.path.join(d, 'bench.sqlite')
+        make_v6_db(dbfile)
+
+        conn = sqlite3.connect(dbfile)
+        report('v6', departure_size(conn), scan(conn, str(since)))
+        conn.close()
+
+        t = time.perf_counter()
+        db = DatabaseConnection(dbfile)
+        print('migration to the current schema took {:.1f} s'.format(time.perf_counter() - t))
+        report('current', departure_size(db.conn), scan(db.conn, _to_minutes(since)))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# CSS selectors on an EFA departure monitor.
+#
+# First the way the tree-based parser uses them: a handful of selectors, each called
+# for every departure, parsed for every call or compiled once and cached.
+#
+# Then whole-document lookups: walking the parsed tree, and the index of a Document,
+# once including building the index and then from the built index.
+
+import email
+import http.client
+import io
+import os
+import time
+from urllib.response import addinfourl
+
+import bahnstat.mechanize_mini as minimech
+
+POLLS = 10
+SELECTORS = ['itdServingLine', 'itdNoTrain', 'itdDateTime', 'itdDate', 'itdTime']
+LOOKUPS = ['itdDeparture', 'itdDepartureList itdDeparture', 'itdOdvName odvNameElem']
+
+def load(name: str) -> bytes:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'testcases', name), 'rb') as f:
+        return f.read()
+
+def document(body: bytes) -> minimech.Document:
+    headers = email.message_from_string('Content-Type: text/xml; charset=iso-8859-1\n', _class=http.client.HTTPMessage)
+    return minimech.Document(None, addinfourl(io.BytesIO(body), headers, 'http://example.com/', 200))
+
+def timed(f) -> float:
+    t = time.process_time()
+    for i in range(POLLS):
+        f()
+    return (time.process_time() - t) / POLLS * 1000
+
+if __name__ == '__main__':
+    body = load('XML_DM_REQUEST zugausfall rb neustadt.xml')
+    root = minimech.parsehtmlbytes(body)
+    deps = list(root.query_selector_all('itdDepartureList itdDeparture'))
+
+    def per_departure(select):
+        for d in deps:
+            for sel in SELECTORS:
+                select(sel, d)
+
+    n = len(deps) * len(SELECTORS)
+    print('{:<24} {} queries in {:6.2f} ms'.format('parsed for every call', n,
+          timed(lambda: per_departure(lambda sel, d: minimech.CompiledSelector(sel).select(d)))))
+    print('{:<24} {} queries in {:6.2f} ms'.format('compiled', n,
+          timed(lambda: per_departure(lambda sel, d: d.query_selector(sel)))))
+
+    doc = document(body)
+    for sel in LOOKUPS:
+        def indexed(rebuild: bool) -> None:
+            if rebuild:
+                doc.document_element = doc.document_element
+            list(doc.query_selector_all(sel))
+
+        matches = len(list(root.query_selector_all(sel)))
+        print('{:<32} {:3} matches: walk {:7.2f} ms, index build + lookup {:7.2f} ms, lookup {:6.3f} ms'.format(
+            sel, matches, timed(lambda: list(root.query_selector_all(sel))), timed(lambda: indexed(True)),
+            timed(lambda: indexed(False))))
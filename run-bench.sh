@@ -0,0 +1,17 @@
+#!/bin/sh
+
+set -eu
+
+cd "$(dirname "$(readlink -f "$0")")"
+
+# the benchmarks share some fixtures with the tests
+export PYTHONPATH="$PWD/src:$PWD/test:${PYTHONPATH:-}"
+
+if [ "$#" -eq 0 ]; then
+    set -- bench/bench_*.py
+fi
+
+for b in "$@"; do
+    echo "== $b"
+    python3 "$b"
+done
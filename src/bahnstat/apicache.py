@@ -0,0 +1,107 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional, Set, Tuple
+import sqlite3
+import threading
+import time
+import zlib
+
+__all__ = [ 'ApiResponseCache', 'PLAN_MAX_AGE' ]
+
+# plan slices only change through the change feeds, so they are kept that long
+PLAN_MAX_AGE = timedelta(hours=12)
+
+_TIMESLICE_FORMAT = '%Y-%m-%d %H'
+
+class ApiResponseCache:
+    """raw responses of the DB Timetables API in a SQLite side file.
+
+    It keeps the plan slices, and for every station the journal of change responses
+    since the last full change feed (fchg), together with the plan slices they apply
+    to. With that, a restarted collector rebuilds the state of its change integrator
+    and continues with recent changes only. Nothing in here is needed for correctness,
+    the file can be deleted at any time.
+
+    Clients running in different threads can share the cache.
+    """
+    def __init__(self, path: str) -> None:
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.isolation_level = None
+        self._lock = threading.RLock()
+
+        # losing the last commits on a power failure only costs a few requests
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS PlanSlice(
+                eva_id INTEGER NOT NULL,
+                timeslice TEXT NOT NULL,
+                fetched REAL NOT NULL,
+                body BLOB NOT NULL,
+                PRIMARY KEY (eva_id, timeslice));
+            CREATE TABLE IF NOT EXISTS ChangeJournal(
+                eva_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                fetched REAL NOT NULL,
+                body BLOB NOT NULL,
+                PRIMARY KEY (eva_id, seq));
+            CREATE TABLE IF NOT EXISTS ChangeTimeslices(
+                eva_id INTEGER NOT NULL PRIMARY KEY,
+                timeslices TEXT NOT NULL);
+            ''')
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.conn.rollback()
+                raise
+            else:
+                self.conn.commit()
+
+    def plan(self, eva_id: int, timeslice: datetime) -> Optional[bytes]:
+        """the plan slice, if it has been fetched within PLAN_MAX_AGE"""
+        with self._lock:
+            row = self.conn.execute('''SELECT body FROM PlanSlice
+                                       WHERE eva_id = ? AND timeslice = ? AND fetched > ?''',
+                                    (eva_id, timeslice.strftime(_TIMESLICE_FORMAT),
+                                     time.time() - PLAN_MAX_AGE.total_seconds())).fetchone()
+
+        return zlib.decompress(row[0]) if row is not None else None
+
+    def put_plan(self, eva_id: int, timeslice: datetime, body: bytes) -> None:
+        now = time.time()
+        with self._transaction():
+            self.conn.execute('INSERT OR REPLACE INTO PlanSlice VALUES (?, ?, ?, ?)',
+                              (eva_id, timeslice.strftime(_TIMESLICE_FORMAT), now, zlib.compress(body)))
+            self.conn.execute('DELETE FROM PlanSlice WHERE fetched < ?', (now - PLAN_MAX_AGE.total_seconds(),))
+
+    def start_changes(self, eva_id: int, timeslices: Set[datetime], body: bytes) -> None:
+        """starts a new journal with a full change feed for the given plan slices"""
+        with self._transaction():
+            self.conn.execute('DELETE FROM ChangeJournal WHERE eva_id = ?', (eva_id,))
+            self.conn.execute('INSERT OR REPLACE INTO ChangeTimeslices VALUES (?, ?)',
+                              (eva_id, ','.join(sorted(t.strftime(_TIMESLICE_FORMAT) for t in timeslices))))
+            self.conn.execute('INSERT INTO ChangeJournal VALUES (?, 0, ?, ?)', (eva_id, time.time(), zlib.compress(body)))
+
+    def add_changes(self, eva_id: int, body: bytes) -> None:
+        """appends a recent change response to the journal"""
+        with self._transaction():
+            self.conn.execute('''INSERT INTO ChangeJournal
+                                 SELECT eva_id, MAX(seq) + 1, ?, ? FROM ChangeJournal WHERE eva_id = ? GROUP BY eva_id''',
+                              (time.time(), zlib.compress(body), eva_id))
+
+    def changes(self, eva_id: int) -> Optional[Tuple[Set[datetime], List[Tuple[float, bytes]]]]:
+        """the plan slices of the journal, and its (fetch time, response) entries in order"""
+        with self._lock:
+            row = self.conn.execute('SELECT timeslices FROM ChangeTimeslices WHERE eva_id = ?', (eva_id,)).fetchone()
+            journal = [(fetched, zlib.decompress(body)) for fetched, body in self.conn.execute(
+                           'SELECT fetched, body FROM ChangeJournal WHERE eva_id = ? ORDER BY seq', (eva_id,))]
+        if row is None or not journal:
+            return None
+
+        return {datetime.strptime(t, _TIMESLICE_FORMAT) for t in row[0].split(',') if t}, journal
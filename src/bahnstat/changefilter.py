@@ -0,0 +1,87 @@
+from bahnstat.datatypes import *
+
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+__all__ = [ 'ChangeFilter', 'FINGERPRINT_MAX_AGE' ]
+
+# events are remembered this long after their scheduled time. Forgetting one early
+# only costs a redundant write when it shows up again.
+FINGERPRINT_MAX_AGE = timedelta(hours=6)
+
+_Event = Union[Departure, Arrival]
+
+class ChangeFilter:
+    """remembers the last saved state of the departures or arrivals of the watched
+    stops, so that each poll only saves the new and changed ones.
+
+    For a row which is already saved, the database only takes a new delay, so the
+    fingerprint of an event is its delay, keyed by (stop, time, trip_code, line_code)
+    like the rows. The clock function can be replaced for testing.
+    """
+    def __init__(self, max_age: timedelta = FINGERPRINT_MAX_AGE, *,
+                 clock: Callable[[], datetime] = datetime.now) -> None:
+        self.max_age = max_age
+        self._clock = clock
+        self._saved = dict() # type: Dict[Tuple[Any, datetime, Any, str], Optional[float]]
+        self._next_eviction = clock() + max_age / 4
+
+        # events passed on and skipped since the last call of stats()
+        self._passed = 0
+        self._skipped = 0
+
+    def changed(self, stop: WatchedStop, events: Iterable[_Event]) -> List[_Event]:
+        """the events which are new, or whose delay differs from the saved one"""
+        saved = self._saved
+        result = []
+        skipped = 0
+        for e in events:
+            key = (stop.id, e.time, e.trip_code, e.line_code)
+            if key not in saved or (e.delay is not None and e.delay != saved[key]):
+                result.append(e)
+            else:
+                skipped += 1
+
+        self._passed += len(result)
+        self._skipped += skipped
+        return result
+
+    def mark_saved(self, stop: WatchedStop, events: Iterable[_Event]) -> None:
+        saved = self._saved
+        for e in events:
+            key = (stop.id, e.time, e.trip_code, e.line_code)
+            if e.delay is not None or key not in saved:
+                saved[key] = e.delay
+
+        self._evict()
+
+    def persist(self, persist: Callable[[WatchedStop, List[_Event]], None], stop: WatchedStop,
+                events: Iterable[_Event]) -> int:
+        """saves the changed events with `persist`, e.g. DatabaseAccessor.persist_departures.
+        Returns the number of saved events."""
+        changed = self.changed(stop, events)
+        if changed:
+            persist(stop, changed)
+            self.mark_saved(stop, changed)
+
+        return len(changed)
+
+    def _evict(self) -> None:
+        now = self._clock()
+        if now < self._next_eviction:
+            return
+
+        before = now - self.max_age
+        for key in [k for k in self._saved if k[1] < before]:
+            del self._saved[key]
+
+        self._next_eviction = now + self.max_age / 4
+
+    def __len__(self) -> int:
+        return len(self._saved)
+
+    def stats(self) -> Tuple[int, int]:
+        """number of saved and skipped events since the last call"""
+        passed, skipped = self._passed, self._skipped
+        self._passed = self._skipped = 0
+        return passed, skipped
@@ -0,0 +1,304 @@
+from bahnstat.apicache import ApiResponseCache
+from bahnstat.changefilter import ChangeFilter
+from bahnstat.database import DatabaseConnection, DatabaseAccessor, DEFAULT_BUSY_TIMEOUT, MIGRATION_BATCH_SIZE, \
+    ROLLUP_INTERVAL
+from bahnstat.datatypes import *
+from bahnstat.dbrunner import REQUESTS_PER_MINUTE, REQUEST_BURST, sync_interval
+from bahnstat.dbtimetableclient import DbTimetableClient, DB_API_URL
+from bahnstat.efaxmlclient import EFA_URL, stop_dm_url, parse_monitor
+from bahnstat.httppool import HttpConnectionPool, PooledResponse
+from bahnstat.scheduling import TokenBucket
+
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Union
+from urllib.parse import urlsplit
+import asyncio
+import io
+import logging
+import random
+
+__all__ = [ 'HostLimit', 'DEFAULT_HOST_LIMITS', 'AsyncFetcher', 'EfaJob', 'DbTimetableJob', 'Collector',
+            'efa_jobs', 'db_jobs' ]
+
+_log = logging.getLogger(__name__)
+
+# like the sequential EFA runner: every monitor every 2 minutes, plus up to 15 s
+EFA_INTERVAL = 120.0
+EFA_JITTER = 15.0
+
+class HostLimit:
+    """at most `concurrency` requests to a host at the same time, and with a `rate`,
+    at most `burst + rate * t` requests within any `t` seconds"""
+    def __init__(self, concurrency: int, rate: float = None, burst: float = 1) -> None:
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+
+DEFAULT_HOST_LIMITS = {
+    urlsplit(EFA_URL).hostname: HostLimit(4),
+    urlsplit(DB_API_URL).hostname: HostLimit(4, (REQUESTS_PER_MINUTE - REQUEST_BURST) / 60, REQUEST_BURST),
+} # type: Dict[str, HostLimit]
+
+class AsyncFetcher:
+    """GET requests for the event loop, limited per host.
+
+    The requests themselves are those of a HttpConnectionPool, which run in a thread
+    pool, so keep-alive and the handling of stale connections are the same as in the
+    sequential runners. Hosts without an entry in `limits` get `default_limit`.
+    """
+    def __init__(self, pool: HttpConnectionPool = None, limits: Mapping[str, HostLimit] = DEFAULT_HOST_LIMITS, *,
+                 default_limit: HostLimit = HostLimit(4), max_workers: int = 16) -> None:
+        self.pool = pool if pool is not None else HttpConnectionPool(maxidle=max_workers)
+        self.limits = dict(limits)
+        self.default_limit = default_limit
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='fetch')
+        self._hosts = dict() # type: Dict[str, Tuple[asyncio.Semaphore, Optional[TokenBucket]]]
+
+    def _gate(self, host: str) -> Tuple[asyncio.Semaphore, Optional[TokenBucket]]:
+        if host not in self._hosts:
+            limit = self.limits.get(host, self.default_limit)
+            bucket = TokenBucket(limit.rate, limit.burst) if limit.rate is not None else None
+            self._hosts[host] = (asyncio.Semaphore(limit.concurrency), bucket)
+
+        return self._hosts[host]
+
+    async def get(self, url: str, headers: Mapping[str, str] = None) -> PooledResponse:
+        semaphore, bucket = self._gate(urlsplit(url).hostname)
+        async with semaphore:
+            if bucket is not None:
+                await asyncio.sleep(bucket.reserve())
+
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self.pool.get, url, headers)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self.pool.close()
+
+# ('departures' or 'arrivals', stop, the departures or arrivals) for the writer
+_Result = Tuple[str, WatchedStop, list]
+
+def _monitor_items(mode: str, body: bytes, charset: Optional[str]) -> list:
+    """the departures or arrivals of an EFA monitor response, like EfaXmlClient returns them"""
+    monitor = parse_monitor(io.BytesIO(body), mode, charset)
+    if mode == 'dep':
+        return monitor.departures
+    else:
+        return monitor.arrivals
+
+class EfaJob:
+    """the departure (`mode` 'dep') or arrival ('arr') monitor of a stop"""
+    def __init__(self, stop: WatchedStop, mode: str, user_agent: str, *, baseurl: str = EFA_URL) -> None:
+        self.stop = stop
+        self.mode = mode
+        self.url = stop_dm_url(stop, mode=mode, baseurl=baseurl)
+        self.headers = {'User-Agent': user_agent}
+        self.interval = EFA_INTERVAL
+        self.jitter = EFA_JITTER
+
+    def __str__(self) -> str:
+        return '{} monitor of {}'.format(self.mode, self.stop.name)
+
+    async def sync(self, collector: 'Collector') -> List[_Result]:
+        r = await collector.fetcher.get(self.url, self.headers)
+        items = await collector.parse(_monitor_items, self.mode, r.body, r.headers.get_content_charset())
+
+        return [('departures' if self.mode == 'dep' else 'arrivals', self.stop, items)]
+
+class DbTimetableJob:
+    """the board of a DB station.
+
+    The client keeps the plans and changes between syncs, so each sync runs the whole
+    client in a worker thread. The job is the connection pool of its client: the
+    requests go back to the event loop, and through the limits of the fetcher.
+    """
+    def __init__(self, stop: WatchedStop, interval: float, *, now: Callable[[], datetime] = datetime.now,
+                 **client_args) -> None:
+        self.stop = stop
+        self.interval = interval
+        self.jitter = 0.0
+        self.now = now
+        self.client = DbTimetableClient(stop, pool=self, **client_args) # type: ignore
+        self._fetcher = None # type: Optional[AsyncFetcher]
+        self._loop = None # type: Optional[asyncio.AbstractEventLoop]
+
+    def __str__(self) -> str:
+        return 'board of {}'.format(self.stop.name)
+
+    def get(self, url: str, headers: Mapping[str, str] = None) -> PooledResponse:
+        """called by the client, in its worker thread"""
+        return asyncio.run_coroutine_threadsafe(self._fetcher.get(url, headers), self._loop).result()
+
+    async def sync(self, collector: 'Collector') -> List[_Result]:
+        self._fetcher = collector.fetcher
+        self._loop = asyncio.get_running_loop()
+        board = await self._loop.run_in_executor(collector.client_executor, self.client.current_board, self.now())
+
+        return [('departures', self.stop, board.departures), ('arrivals', self.stop, board.arrivals)]
+
+def efa_jobs(stops: Iterable[WatchedStop], user_agent: str, *, baseurl: str = EFA_URL) -> List[EfaJob]:
+    return [EfaJob(s, mode, user_agent, baseurl=baseurl) for s in stops if s.active for mode in ('dep', 'arr')]
+
+def db_jobs(stops: Iterable[WatchedStop], apikey: str, *, cache: ApiResponseCache = None,
+            apiurl: str = DB_API_URL) -> List[DbTimetableJob]:
+    active = [s for s in stops if s.active]
+    if not active:
+        return []
+
+    # each station as often as the request budget allows
+    interval = sync_interval(REQUESTS_PER_MINUTE, len(active))
+    return [DbTimetableJob(s, interval, auth=apikey, apiurl=apiurl, cache=cache, lookahead=timedelta(hours=2))
+            for s in active]
+
+class Collector:
+    """syncs the stops of both backends concurrently, on an asyncio event loop.
+
+    Every job (an EFA monitor or a DB board) repeats its syncs in its own task. The
+    requests go through the fetcher, which keeps the limits of each host, parsing
+    runs in `parse_executor` (a thread pool by default, EFA parsing also works in a
+    process pool), and a single writer task saves all results, so the database sees
+    one transaction at a time just like with the sequential runners. Like those, it
+    only saves the departures and arrivals which changed.
+
+    The database connection is opened and used by a thread of its own, so the event
+    loop keeps going while a board is saved. Every `rollup_interval` seconds, the same
+    thread also brings the rollups up to date.
+    """
+    def __init__(self, dbfile: str, stops: Iterable[WatchedStop], jobs: Iterable[Union[EfaJob, DbTimetableJob]],
+                 fetcher: AsyncFetcher = None, *, wal: bool = False, busy_timeout: float = DEFAULT_BUSY_TIMEOUT,
+                 parse_executor: Executor = None, watchdog_func: Callable = None, max_clients: int = 16,
+                 rollup_interval: float = ROLLUP_INTERVAL) -> None:
+        self.dbfile = dbfile
+        self.wal = wal
+        self.busy_timeout = busy_timeout
+        self.db = None # type: Optional[DatabaseAccessor]
+        self.stops = list(stops)
+        self.jobs = list(jobs)
+        self.fetcher = fetcher if fetcher is not None else AsyncFetcher()
+
+        # DB clients wait for their requests in these threads, so parsing gets its own
+        self.client_executor = ThreadPoolExecutor(max_clients, thread_name_prefix='client')
+        self._own_parse_executor = parse_executor is None
+        self.parse_executor = parse_executor if parse_executor is not None else ThreadPoolExecutor(4, thread_name_prefix='parse')
+
+        # owns the database connection, and the change filters which go with it
+        self.db_executor = ThreadPoolExecutor(1, thread_name_prefix='db')
+        self.changes = {
+            'departures': ChangeFilter(),
+            'arrivals': ChangeFilter(),
+        } # type: Dict[str, ChangeFilter]
+
+        self._watchdog_func = watchdog_func
+        self._queue = None # type: Optional[asyncio.Queue]
+        self.rollup_interval = rollup_interval
+
+    def _watchdog(self) -> None:
+        if self._watchdog_func is not None:
+            self._watchdog_func()
+
+    def parse(self, func: Callable[..., Any], *args) -> 'asyncio.Future[Any]':
+        return asyncio.get_running_loop().run_in_executor(self.parse_executor, func, *args)
+
+    def _open_db(self) -> None:
+        """runs in the database thread"""
+        if self.db is None:
+            self.db = DatabaseAccessor(DatabaseConnection(self.dbfile, wal=self.wal, busy_timeout=self.busy_timeout))
+
+        for s in self.stops:
+            self.db.persist_watched_stop(s)
+
+    def _persist(self, kind: str, stop: WatchedStop, items: list) -> None:
+        """runs in the database thread"""
+        persist = self.db.persist_departures if kind == 'departures' else self.db.persist_arrivals
+        self.changes[kind].persist(persist, stop, items)
+
+    def _refresh_rollups(self) -> int:
+        """runs in the database thread"""
+        with self.db.connection:
+            return self.db.connection.refresh_rollups(limit=MIGRATION_BATCH_SIZE)
+
+    def _close_db(self) -> None:
+        """runs in the database thread"""
+        if self.db is not None:
+            self.db.connection.conn.close()
+            self.db = None
+
+    async def _writer(self) -> None:
+        # one board at a time, in the database thread
+        loop = asyncio.get_running_loop()
+        while True:
+            kind, stop, items = await self._queue.get()
+            try:
+                await loop.run_in_executor(self.db_executor, self._persist, kind, stop, items)
+            except Exception:
+                # the next sync brings the same data again, and the watchdog notices
+                # if the database stays broken
+                _log.exception('could not save the results for {}'.format(stop.name))
+            else:
+                self._watchdog()
+            finally:
+                self._queue.task_done()
+
+    async def _rollups(self) -> None:
+        # a batch at a time, so that the boards which arrive meanwhile are saved in between
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.rollup_interval)
+            try:
+                while await loop.run_in_executor(self.db_executor, self._refresh_rollups):
+                    pass
+            except Exception:
+                _log.exception('could not refresh the rollups')
+
+    async def _sync(self, job: Union[EfaJob, DbTimetableJob]) -> None:
+        try:
+            results = await job.sync(self)
+        except Exception:
+            _log.exception('sync of the {} failed'.format(job))
+            return
+
+        for r in results:
+            self._queue.put_nowait(r)
+
+    async def _repeat(self, job: Union[EfaJob, DbTimetableJob]) -> None:
+        loop = asyncio.get_running_loop()
+
+        # spread the first syncs over the interval
+        await asyncio.sleep(random.uniform(0, job.interval))
+
+        while True:
+            start = loop.time()
+            await self._sync(job)
+            await asyncio.sleep(max(0.0, start + job.interval + random.uniform(0, job.jitter) - loop.time()))
+
+    async def _start(self) -> 'asyncio.Task[None]':
+        await asyncio.get_running_loop().run_in_executor(self.db_executor, self._open_db)
+
+        self._queue = asyncio.Queue()
+        return asyncio.ensure_future(self._writer())
+
+    async def collect_once(self) -> float:
+        """syncs every job once, all at the same time. Returns the seconds until all
+        results were saved."""
+        writer = await self._start()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            await asyncio.gather(*(self._sync(j) for j in self.jobs))
+            await self._queue.join()
+        finally:
+            writer.cancel()
+
+        return loop.time() - start
+
+    async def run(self) -> None:
+        writer = await self._start()
+        await asyncio.gather(writer, self._rollups(), *(self._repeat(j) for j in self.jobs))
+
+    def close(self) -> None:
+        self.fetcher.close()
+        self.client_executor.shutdown()
+        if self._own_parse_executor:
+            self.parse_executor.shutdown()
+        self.db_executor.submit(self._close_db)
+        self.db_executor.shutdown()
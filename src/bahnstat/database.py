@@ -1,127 +1,559 @@
 import sqlite3
+import os
+import logging
+import re
 from uuid import UUID, uuid5
-from datetime import datetime, time
+from datetime import datetime, date, time, timedelta
 import random
-import statistics
 import math
-from typing import Iterable, Iterator, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.request import pathname2url
 
 from bahnstat.datatypes import *
+from bahnstat.delaystats import *
 from bahnstat.holidays_bw import *
 
+_log = logging.getLogger(__name__)
+
 sqlite3.enable_callback_tracebacks(True)
 
 # uuid converter
 sqlite3.register_converter('UUID', lambda s: UUID(str(s, encoding='ascii')))
 sqlite3.register_adapter(UUID, lambda u: str(u))
 
-class MedianAggregate:
+class DelayStatsAggregate:
+    """delay_stats(value, quantile...): median, quantiles, stdev and counts in one pass.
+
+    Returns the serialized form of a :class:`DelayStats`, see :meth:`DelayStats.from_sql`.
+    """
     def __init__(self):
-        self.l = []
+        self.finite = [] # type: List[float]
+        self.nonfinite = 0
+        self.quantiles = () # type: Sequence[float]
 
-    def step(self, value):
+    def step(self, value, *quantiles):
         if value is not None:
-            self.l.append(value)
+            if math.isfinite(value):
+                self.finite.append(value)
+            else:
+                self.nonfinite += 1
+
+        self.quantiles = quantiles
 
     def finalize(self):
-        if len(self.l) < 1:
-            return None
-        else:
-            return statistics.median(self.l)
+        return DelayStats.from_finite(self.finite, self.nonfinite, self.quantiles).to_sql()
 
-class PercentileAggregate:
+class DelaySummaryAggregate:
+    """delay_summary(value): a :class:`DelaySummary` sketch of the values, for the rollup tables"""
     def __init__(self):
-        self.l = []
-        self.percentile = 1
+        self.summary = DelaySummary()
 
-    def step(self, percentile, value):
-        if value is not None:
-            self.l.append(value)
-
-        self.percentile = percentile
+    def step(self, value):
+        self.summary.add(value)
 
     def finalize(self):
-        self.l.sort()
+        return self.summary.to_sql()
 
-        if len(self.l) < 1:
-            return None
+class DelaySummaryMergeAggregate:
+    """delay_summary_merge(summary): merges the sketches of several rollup rows, e.g. of a date range"""
+    def __init__(self):
+        self.summary = DelaySummary()
 
-        k = len(self.l) * self.percentile / 100
-        c = math.ceil(k)
+    def step(self, summary):
+        if summary is not None:
+            self.summary.merge(DelaySummary.from_sql(summary))
 
-        if k == c:
-            return (self.l[int(c)-1] + self.l[int(c)])/2
-        else:
-            return self.l[int(c) - 1]
+    def finalize(self):
+        return self.summary.to_sql()
 
-class StdevAggregate:
-    def __init__(self):
-        self.l = []
+# Departure and Arrival rows store times as whole minutes since 1970-01-01, in local time
+# like the timetables, and delays as whole minutes with this value for cancellations
+EPOCH = datetime(1970, 1, 1)
+CANCELLED_DELAY = -32768
 
-    def step(self, value):
-        if value is not None and math.isfinite(value):
-            self.l.append(value)
+def _to_minutes(t: datetime) -> int:
+    return (t - EPOCH) // timedelta(minutes=1)
 
-    def finalize(self):
-        if len(self.l) < 2:
-            return None
-        else:
-            return statistics.stdev(self.l)
+def _from_minutes(m: int) -> datetime:
+    return EPOCH + timedelta(minutes=m)
 
-def date_type(datestr):
-    if datestr is None:
+def _to_timestamp(t: datetime) -> str:
+    """TIMESTAMP text of TripObservation, like MINUTES_SQL_DATETIME() writes it"""
+    return t.strftime('%Y-%m-%d %H:%M:%S')
+
+def _encode_delay(delay: Optional[float]) -> Optional[int]:
+    if delay is None:
         return None
+    elif math.isfinite(delay):
+        return int(round(delay))
+    else:
+        return CANCELLED_DELAY
 
-    d = datetime.strptime(datestr, '%Y-%m-%d').date()
+def _decode_delay(delay: Optional[int]) -> Optional[float]:
+    if delay is None:
+        return None
+    elif delay == CANCELLED_DELAY:
+        return math.inf
+    else:
+        return float(delay)
 
-    if d in HOLIDAYS:
-        return 'sun'
+def _encode_trip_code(trip_code: Any) -> Any:
+    """numeric trip codes are stored as integers, anything else (e.g. with leading zeros) as text"""
+    if isinstance(trip_code, int):
+        return trip_code
 
-    wd = d.weekday()
-    if 0 <= wd <= 4:
-        return 'mofr'
-    elif wd == 5:
-        return 'sat'
-    elif wd == 6:
-        return 'sun'
+    trip_code = str(trip_code)
+    if 0 < len(trip_code) <= 18 and trip_code[0] in '123456789' and trip_code.isdigit() and trip_code.isascii():
+        return int(trip_code)
     else:
-        assert False
-
-def DATE_TYPE_SQL_CHECK(fieldname, t):
+        return trip_code
+
+def MINUTES_SQL_DATETIME(field):
+    """SQL expression converting a minutes column into the TIMESTAMP text format"""
+    return "datetime({} * 60, 'unixepoch')".format(field)
+
+def DELAY_SQL_REAL(field):
+    """SQL expression converting a delay column into minutes, with cancellations as infinity"""
+    return "(CASE {0} WHEN {1} THEN 9e999 ELSE {0} END)".format(field, CANCELLED_DELAY)
+
+# SQL expressions converting the columns of schema v9 into the compact encoding
+_COMPACT_TIME_SQL = "CAST(strftime('%s', time) AS INTEGER) / 60"
+_COMPACT_DELAY_SQL = "(CASE WHEN abs(delay) > 1e308 THEN {} ELSE CAST(round(delay) AS INTEGER) END)".format(CANCELLED_DELAY)
+_COMPACT_TRIP_CODE_SQL = '''(CASE WHEN trip_code GLOB '[1-9]*' AND NOT trip_code GLOB '*[^0-9]*' AND length(trip_code) <= 18
+                                THEN CAST(trip_code AS INTEGER) ELSE trip_code END)'''
+
+def _compact_copy_sql(schema: str, table: str, where: str = '1') -> str:
+    """SQL copying the rows of `<table>_TMP` matching `where` into the compact layout of schema v10"""
+    place = 'destination_pk' if table == 'Departure' else 'origin_pk'
+
+    # times with seconds may collapse into one minute, then keep a row with a delay
+    return '''
+        INSERT INTO {0}.{1} (stop_pk, time, line_code_pk, trip_code, delay, {2}, train_name_pk)
+        SELECT stop_pk, {3}, line_code_pk, {4}, {5}, {2}, train_name_pk
+        FROM {0}.{1}_TMP
+        WHERE {6}
+        ON CONFLICT (stop_pk, time, line_code_pk, trip_code) DO UPDATE
+        SET delay = excluded.delay, {2} = excluded.{2}, train_name_pk = excluded.train_name_pk
+        WHERE excluded.delay IS NOT NULL
+        '''.format(schema, table, place, _COMPACT_TIME_SQL, _COMPACT_TRIP_CODE_SQL, _COMPACT_DELAY_SQL, where)
+
+def _daterange_start(daterange: int) -> datetime:
+    """start of a report window covering the last `daterange` days"""
+    return datetime.combine(date.today() - timedelta(days=daterange), time())
+
+# the Calendar table starts with the year before data collection began
+CALENDAR_FIRST_YEAR = 2017
+
+def DATE_TYPE_SQL_JOIN(datefield, t):
+    """join with the Calendar table, restricted to days of the given date type"""
     if t == 'any' or t == 'all':
-        return ' (1 = 1) '
+        return ' '
     else:
-        return " (DATE_TYPE({}) = '{}') ".format(fieldname, t)
+        assert t in DAY_TYPES
+        return " JOIN Calendar ON Calendar.date = {} AND Calendar.date_type = '{}' ".format(datefield, t)
 
-
-DBVER_CURRENT = 6
+def MINUTES_DATE_TYPE_SQL_JOIN(field, t):
+    """like DATE_TYPE_SQL_JOIN() for a minutes column, looking up the day by its first minute
+    instead of converting every row to a date"""
+    if t == 'any' or t == 'all':
+        return ' '
+    else:
+        assert t in DAY_TYPES
+        return (" JOIN Calendar ON Calendar.date_type = '{1}'"
+                " AND Calendar.start_minute = {0} - {0} % (24*60) ".format(field, t))
+
+
+DBVER_CURRENT = 12
+
+# rows copied per transaction by the schema migrations
+MIGRATION_BATCH_SIZE = 10000
+
+def ROWID_RANGE_SQL(table):
+    """SQL condition selecting the batch (:lo, :hi] of a table by rowid"""
+    return '{0}.rowid > :lo AND {0}.rowid <= :hi'.format(table)
+
+# seconds a connection waits for another one to release its lock
+DEFAULT_BUSY_TIMEOUT = 30.0
+
+# seconds between two refreshes of the rollups by the collectors
+ROLLUP_INTERVAL = 300.0
+
+# tables which are moved into the yearly archive files, with their columns
+PARTITIONED_TABLES = OrderedDict([
+    ('Departure', 'stop_pk, time, delay, trip_code, line_code_pk, destination_pk, train_name_pk'),
+    ('Arrival', 'stop_pk, time, delay, trip_code, line_code_pk, origin_pk, train_name_pk'),
+    ('TripObservation', 'origin_pk, destination_pk, dep_time, arr_time, line_code_pk, trip_code, train_name_pk, dep_delay, arr_delay'),
+])
+
+# the time column which decides about the partition, and how to encode a time for it
+PARTITION_TIME_COLUMNS = {
+    'Departure': ('time', _to_minutes),
+    'Arrival': ('time', _to_minutes),
+    'TripObservation': ('dep_time', _to_timestamp),
+}
+
+# layout version of the archive files
+ARCHIVE_VERSION = 2
+
+def archive_path(dbfile: str, year: int) -> str:
+    """file name of the archive with the observations of the given year, e.g. bahnstat.2018.sqlite"""
+    root, ext = os.path.splitext(dbfile)
+    return '{}.{:04d}{}'.format(root, year, ext)
+
+# raw observations older than this many days are deleted by prune(). The reports
+# look back at most 360 days, older days are only needed in their rollups.
+RETENTION_DAYS = 400
+
+# dictionary table -> (table, column) pairs referencing its entries
+DICTIONARY_REFERENCES = OrderedDict([
+    ('LineCodeDictionary', [('Departure', 'line_code_pk'), ('Arrival', 'line_code_pk'),
+                            ('TripObservation', 'line_code_pk')]),
+    ('OriginDestinationDictionary', [('Departure', 'destination_pk'), ('Arrival', 'origin_pk'),
+                                     ('DepartureDailyRollup', 'destination_pk')]),
+    ('TrainNameDictionary', [('Departure', 'train_name_pk'), ('Arrival', 'train_name_pk'),
+                             ('TripObservation', 'train_name_pk'), ('TripDailyRollup', 'train_name_pk'),
+                             ('DepartureDailyRollup', 'train_name_pk')]),
+])
+
+def archive_years(dbfile: str) -> List[int]:
+    """years for which an archive file exists next to the database file"""
+    if dbfile == ':memory:':
+        return []
+
+    root, ext = os.path.splitext(os.path.abspath(dbfile))
+    pattern = re.compile(re.escape(os.path.basename(root)) + r'\.(\d{4})' + re.escape(ext) + '$')
+    years = []
+    for name in os.listdir(os.path.dirname(root)):
+        m = pattern.match(name)
+        if m:
+            years.append(int(m.group(1)))
+
+    return sorted(years)
+
+def _task_version(task: str) -> int:
+    """schema version of the migration step a task like 'v3:LineCodeDictionary' belongs to"""
+    return int(task[1:task.index(':')])
 
 class DatabaseConnection:
-    """low-level database access"""
-    def __init__(self, dbfile: str) -> None:
-        self.conn = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES)
+    """low-level database access
+
+    With `wal=True`, the database is switched to write-ahead-log mode. Readers then
+    no longer block writers (and vice versa), so reports can be generated while the
+    collectors keep ingesting. The journal mode is persistent, so connections which
+    don't ask for WAL mode simply use whatever mode the database file is in.
+
+    `read_only=True` opens the database file without write access, e.g. for report
+    generation. Temporary tables and views still work. Such a connection can't migrate
+    the schema, so the database needs to be opened read-write once after an upgrade.
+
+    Schema migrations copy the large tables in batches of MIGRATION_BATCH_SIZE rows, one
+    transaction each, so the collectors are only blocked for short moments. If the
+    migration is interrupted, the next read-write connection continues it, and several
+    connections opened at the same time share the work. New databases
+    use auto_vacuum=INCREMENTAL, so the space freed by a migration is given back by
+    :meth:`incremental_vacuum` instead of a full VACUUM.
+
+    Observations of past years can be moved into archive files with :meth:`roll_over`.
+    :meth:`partitions` gives the queries a source which covers exactly the partitions
+    they need, and attaches the archives of these years read-only as `archive_<year>`
+    only while the query runs. SQLite allows at most 10 attached databases by default,
+    so queries should cover as few years as possible. The rollups stay in the main file,
+    so the reports don't need the archives at all.
+    """
+    def __init__(self, dbfile: str, *, read_only: bool = False, wal: bool = False,
+                 busy_timeout: float = DEFAULT_BUSY_TIMEOUT, wal_autocheckpoint: int = None) -> None:
+        self.dbfile = dbfile
+        self.read_only = read_only
+
+        # year -> schema name of the attached archives, and how many queries use them
+        self.archives = OrderedDict() # type: OrderedDict[int, str]
+        self._archive_users = {} # type: Dict[int, int]
+
+        # with uri=True, ATTACH also understands URIs, which we need for read-only archives
+        if read_only:
+            self.conn = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(dbfile))),
+                                        detect_types=sqlite3.PARSE_DECLTYPES, timeout=busy_timeout, uri=True)
+        else:
+            self.conn = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES, timeout=busy_timeout, uri=True)
         self.conn.isolation_level = None
 
-        self.conn.create_aggregate('median', 1, MedianAggregate)
-        self.conn.create_aggregate('percentile', 2, PercentileAggregate)
-        self.conn.create_aggregate('stdev', 1, StdevAggregate)
-
-        self.conn.create_function('date_type', 1, date_type)
+        self.conn.create_aggregate('delay_stats', -1, DelayStatsAggregate)
+        self.conn.create_aggregate('delay_summary', 1, DelaySummaryAggregate)
+        self.conn.create_aggregate('delay_summary_merge', 1, DelaySummaryMergeAggregate)
 
         self.conn.execute('PRAGMA foreign_keys = ON')
         self.conn.execute('PRAGMA recursive_triggers = ON')
         self.conn.execute('PRAGMA temp_store = MEMORY')
 
+        if not read_only:
+            # only takes effect before the first table is created, so it must come before
+            # the switch to WAL mode. Existing databases are switched over by vacuum().
+            self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+        if wal and not read_only:
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            # in WAL mode, this is still safe against application crashes, and it
+            # saves the fsync on every commit
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+
+        if wal_autocheckpoint is not None:
+            self.conn.execute('PRAGMA wal_autocheckpoint = {:d}'.format(wal_autocheckpoint))
+
         dbver = self.conn.execute('PRAGMA user_version').fetchone()[0]
-        if dbver < DBVER_CURRENT:
+        if dbver < DBVER_CURRENT or self._migration_pending():
+            if read_only:
+                raise sqlite3.OperationalError('database schema v{} is outdated or not completely migrated, '
+                                               'open it read-write to migrate'.format(dbver))
+
             self._migrate_db()
 
-        self._setup_temps()
+        if not read_only:
+            self.extend_calendar()
+        elif self.exec('SELECT MAX(date) FROM Calendar').fetchone()[0] < date.today().isoformat():
+            _log.warning('the calendar ends before today, open the database read-write to extend it')
+
+    @property
+    def journal_mode(self) -> str:
+        return self.conn.execute('PRAGMA journal_mode').fetchone()[0]
+
+    def checkpoint(self, mode: str = 'PASSIVE') -> Tuple[int, int, int]:
+        """ copy the write-ahead log back into the database file.
+
+        `mode` is one of PASSIVE (don't wait for other connections), FULL, RESTART or
+        TRUNCATE (wait for other writers, then reset the log). Returns the
+        (busy, log pages, checkpointed pages) triple of `PRAGMA wal_checkpoint`.
+        Without WAL mode, this does nothing.
+        """
+        assert mode in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+        busy, log, checkpointed = self.exec('PRAGMA wal_checkpoint({})'.format(mode)).fetchone()
+        return busy, log, checkpointed
+
+    def incremental_vacuum(self, pages: int = 1024) -> int:
+        """ returns unused pages to the file system, at most `pages` per transaction.
+
+        Unlike VACUUM, this needs neither exclusive access for a long time nor free disk
+        space for a copy of the database. It only works with auto_vacuum=INCREMENTAL, which
+        new databases have; older ones are switched over once by :meth:`vacuum`.
+        Returns the number of freed pages.
+        """
+        if self.exec('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            _log.info('auto_vacuum is not INCREMENTAL, vacuum() switches the database over')
+            return 0
+
+        freed = 0
+        free = self.exec('PRAGMA freelist_count').fetchone()[0]
+        while free:
+            with self:
+                self.exec('PRAGMA incremental_vacuum({:d})'.format(pages)).fetchall()
+                remaining = self.exec('PRAGMA freelist_count').fetchone()[0]
+            if remaining >= free:
+                break
+
+            freed += free - remaining
+            free = remaining
+
+        return freed
+
+    def vacuum(self) -> None:
+        """ shrinks the database file.
+
+        The first call on a database without auto_vacuum=INCREMENTAL switches it over
+        with a full VACUUM, later calls only need :meth:`incremental_vacuum`.
+        """
+        if self.exec('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            self.exec('PRAGMA auto_vacuum = INCREMENTAL')
+            self.exec('VACUUM')
+        else:
+            self.incremental_vacuum()
+
+    def _attach_archive(self, year: int) -> str:
+        schema = 'archive_{:04d}'.format(year)
+        if year not in self.archives:
+            self.exec('ATTACH DATABASE :uri AS {}'.format(schema),
+                      uri='file:{}?mode=ro'.format(pathname2url(os.path.abspath(archive_path(self.dbfile, year)))))
+
+            version = self.exec('PRAGMA {}.user_version'.format(schema)).fetchone()[0]
+            if version < ARCHIVE_VERSION:
+                if not self.conn.in_transaction:
+                    self.exec('DETACH DATABASE {}'.format(schema))
+                raise sqlite3.OperationalError('archive {} has the outdated layout v{}, '
+                                               'run rollover-db.py to migrate it'.format(year, version))
+
+            self.archives[year] = schema
+
+        self._archive_users[year] = self._archive_users.get(year, 0) + 1
+        return schema
+
+    def _detach_archives(self) -> None:
+        # DETACH fails inside a transaction, so archives released there are only
+        # detached when it ends
+        if self.conn.in_transaction:
+            return
+
+        for year in [year for year, users in self._archive_users.items() if users == 0]:
+            self.exec('DETACH DATABASE {}'.format(self.archives.pop(year)))
+            del self._archive_users[year]
+
+    @contextmanager
+    def _archives(self, since: date = None) -> Iterator[List[str]]:
+        """attaches the archives of the years overlapping the window starting at `since`
+        for the duration of the block, and gives their schema names"""
+        years = [] # type: List[int]
+        try:
+            for year in archive_years(self.dbfile):
+                if since is None or year >= since.year:
+                    self._attach_archive(year)
+                    years.append(year)
+
+            yield [self.archives[year] for year in years]
+        finally:
+            for year in years:
+                self._archive_users[year] -= 1
+            self._detach_archives()
+
+    @contextmanager
+    def partitions(self, table: str, since: date = None) -> Iterator[str]:
+        """FROM clause source for a partitioned table, named like the table itself.
+
+        Only archives of years overlapping the window starting at `since` are included,
+        and they are only attached until the block ends, so the query must be finished
+        by then. The main database is always included, since it may still contain past
+        years which haven't been rolled over yet.
+        """
+        with self._archives(since) as schemas:
+            if not schemas:
+                yield table
+                return
+
+            columns = PARTITIONED_TABLES[table]
+            yield '(' + ' UNION ALL '.join('SELECT {} FROM {}.{}'.format(columns, schema, table)
+                                           for schema in ['main'] + schemas) + ') AS ' + table
+
+    def roll_over(self, year: int) -> Dict[str, int]:
+        """moves the observations of a past year into its archive file.
+
+        Running it again for the same year moves the rows which have arrived since. This
+        also makes it safe to repeat after a crash, because in WAL mode, the commit isn't
+        atomic across both files. An archive with an outdated layout is upgraded, even
+        if there is nothing to move. Returns the number of moved rows per table.
+        """
+        assert not self.read_only and self.dbfile != ':memory:'
+        if year >= date.today().year:
+            raise ValueError('only past years can be rolled over')
+
+        self.exec('ATTACH DATABASE :path AS rollover', path=archive_path(self.dbfile, year))
+        try:
+            moved = OrderedDict() # type: Dict[str, int]
+            with self:
+                archive_version = self.exec('PRAGMA rollover.user_version').fetchone()[0]
+                if archive_version < 1:
+                    self._create_compact_fact_table('rollover', 'Departure', references=False)
+                    self._create_compact_fact_table('rollover', 'Arrival', references=False)
+                    self.exec('''
+                        CREATE TABLE rollover.TripObservation(
+                            origin_pk INTEGER NOT NULL,
+                            destination_pk INTEGER NOT NULL,
+                            dep_time TIMESTAMP NOT NULL,
+                            arr_time TIMESTAMP NOT NULL,
+                            line_code_pk INTEGER NOT NULL,
+                            trip_code TEXT NOT NULL,
+                            train_name_pk INTEGER NOT NULL,
+                            dep_delay REAL,
+                            arr_delay REAL,
+                            PRIMARY KEY (origin_pk, destination_pk, dep_time, line_code_pk, trip_code, arr_time))
+                        WITHOUT ROWID
+                        ''')
+                elif archive_version < 2:
+                    # archive layout v2: compact Departure and Arrival rows, like db schema v10
+                    self._compact_fact_table('rollover', 'Departure', references=False)
+                    self._compact_fact_table('rollover', 'Arrival', references=False)
+                self.exec('PRAGMA rollover.user_version = {:d}'.format(ARCHIVE_VERSION))
+
+                for table, columns in PARTITIONED_TABLES.items():
+                    time_column, encode = PARTITION_TIME_COLUMNS[table]
+                    start, end = encode(datetime(year, 1, 1)), encode(datetime(year + 1, 1, 1))
+                    self.exec('''INSERT OR REPLACE INTO rollover.{0} ({1})
+                                 SELECT {1} FROM main.{0} WHERE {2} >= :start AND {2} < :end'''.format(table, columns, time_column),
+                              start=start, end=end)
+                    moved[table] = self.exec('DELETE FROM main.{0} WHERE {1} >= :start AND {1} < :end'.format(table, time_column),
+                                             start=start, end=end).rowcount
+        finally:
+            self.exec('DETACH DATABASE rollover')
+
+        return moved
+
+    def prune(self, days: int = RETENTION_DAYS, rollup_days: int = None) -> Dict[str, int]:
+        """deletes the raw observations older than `days` days from the main database.
+
+        Their rollups are brought up to date first and kept, so the reports don't change
+        as long as `days` is longer than their window. With `rollup_days`, the daily
+        rollups older than that are deleted as well, and
+        :meth:`DatabaseAccessor.aggregated_departures` then only covers that window.
+        Afterwards, dictionary entries which are referenced neither by the main database
+        nor by an archive are removed, and the freed space is given back to the file system.
+
+        Removing dictionary entries bumps the generation in DictionaryGeneration, so that
+        the :class:`DatabaseAccessor` of other processes clear their caches before their next
+        write. The newest entry of each dictionary is
+        always kept, so that the primary keys of removed entries are never reused.
+        Returns the number of deleted rows per table.
+        """
+        assert not self.read_only
+        if days < 1 or (rollup_days is not None and rollup_days < days):
+            raise ValueError('rollups must be kept at least as long as the raw observations')
+
+        cutoff = _daterange_start(days)
+        deleted = OrderedDict((table, 0) for table in PARTITIONED_TABLES) # type: Dict[str, int]
+
+        # one transaction per stop, so that the collectors are never blocked for long.
+        # Most dirty rollups are brought up to date before, in transactions of their own.
+        self.extend_calendar()
+        self.update_rollups()
+        for stop_pk, in self.exec('SELECT pk FROM WatchedStop').fetchall():
+            with self:
+                # rows written by other programs may not be in the rollups yet
+                self.refresh_rollups()
+
+                for table, stop_column in [('Departure', 'stop_pk'), ('Arrival', 'stop_pk'), ('TripObservation', 'origin_pk')]:
+                    time_column, encode = PARTITION_TIME_COLUMNS[table]
+                    deleted[table] += self.exec('DELETE FROM main.{0} WHERE {1} = :stop AND {2} < :cutoff'.format(
+                                                    table, stop_column, time_column),
+                                                stop=stop_pk, cutoff=encode(cutoff)).rowcount
+
+        with self._archives() as archives, self:
+            if rollup_days is not None:
+                since = _daterange_start(rollup_days).date()
+                for table in ['TripDailyRollup', 'DepartureDailyRollup']:
+                    deleted[table] = self.exec('DELETE FROM {} WHERE date < :since'.format(table), since=since.isoformat()).rowcount
+
+            # archives have no foreign keys, so their references are checked here
+            for dictionary, references in DICTIONARY_REFERENCES.items():
+                used = ' UNION '.join('SELECT {} FROM {}.{}'.format(column, schema, table)
+                                      for table, column in references
+                                      for schema in ['main'] + (archives if table in PARTITIONED_TABLES else []))
+                deleted[dictionary] = self.exec('''
+                    DELETE FROM {0}
+                    WHERE pk < (SELECT MAX(pk) FROM {0}) AND pk NOT IN ({1})
+                    '''.format(dictionary, used)).rowcount
+
+            # tells the other connections to forget their cached primary keys
+            if any(deleted[dictionary] for dictionary in DICTIONARY_REFERENCES):
+                self.exec('UPDATE DictionaryGeneration SET generation = generation + 1')
+
+        self.incremental_vacuum()
+        return deleted
 
     def exec(self, sql, **params):
         """ execute sql, with named parameters """
         return self.conn.execute(sql, params)
 
+    def execmany(self, sql, params: Iterable[dict]):
+        """ execute sql once for every dictionary of named parameters """
+        return self.conn.executemany(sql, params)
+
     def __enter__(self):
         self.conn.execute('BEGIN IMMEDIATE')
 
@@ -130,356 +562,989 @@ class DatabaseConnection:
     def __exit__(self, type, value, traceback):
         if type is not None:
             self.conn.rollback()
+            self._detach_archives()
             return False
         else:
             self.conn.commit()
+            self._detach_archives()
             return True
 
     def _migrate_db(self):
+        # Every step runs in its own transactions and bumps user_version when it is
+        # complete. Large copies run in batches of MIGRATION_BATCH_SIZE rows, and their
+        # progress is kept in MigrationProgress, so an interrupted migration continues
+        # where it stopped when the database is opened again. Another process may do
+        # the same at any time, so each transaction checks user_version and the progress
+        # again and skips work which is already done.
+        dbver = self.exec('PRAGMA user_version').fetchone()[0]
         should_vacuum = False
 
-        with self:
-            dbver = self.exec('PRAGMA user_version').fetchone()[0]
-
-            if dbver < 1:
-                self.exec('''
-                    CREATE TABLE WatchedStop(
-                        id UUID NOT NULL PRIMARY KEY,
-                        efa_stop_id INTEGER NOT NULL,
-                        name TEXT NOT NULL)
-                    ''')
-                self.exec('''
-                    CREATE TABLE Departure(
-                        stop UUID REFERENCES WatchedStop(id),
-                        time TIMESTAMP NOT NULL,
-                        delay REAL,
-                        trip_code TEXT NOT NULL,
-                        line_code TEXT NOT NULL,
-                        destination TEXT NOT NULL,
-                        train_name TEXT NOT NULL,
-                        UNIQUE(stop,time,trip_code,line_code))
-                    ''')
-                self.exec('''
-                    CREATE TABLE Arrival(
-                        stop UUID REFERENCES WatchedStop(id),
-                        time TIMESTAMP NOT NULL,
-                        delay REAL,
-                        trip_code TEXT NOT NULL,
-                        line_code TEXT NOT NULL,
-                        origin TEXT NOT NULL,
-                        train_name TEXT NOT NULL,
-                        UNIQUE(stop,time,trip_code,line_code))
-                    ''')
-
-                dbver = 1
-
-            if dbver < 2:
-                # migration to db schema v2: use integer primary keys instead of UUIDs
-                # for inter-table relations to save space
-                self.exec('''ALTER TABLE WatchedStop RENAME TO WatchedStop_TMP''')
-                self.exec('''
-                    CREATE TABLE WatchedStop(
-                        pk INTEGER PRIMARY KEY,
-                        id UUID NOT NULL UNIQUE,
-                        efa_stop_id INTEGER NOT NULL,
-                        name TEXT NOT NULL)
-                    ''')
-                self.exec('''
-                    INSERT INTO WatchedStop (id, efa_stop_id, name)
-                    SELECT id, efa_stop_id, name FROM WatchedStop_TMP
-                    ''')
-
-                self.exec('''ALTER TABLE Departure RENAME TO Departure_TMP''')
-                self.exec('''
-                    CREATE TABLE Departure(
-                        stop_pk INTEGER REFERENCES WatchedStop(pk),
-                        time TIMESTAMP NOT NULL,
-                        delay REAL,
-                        trip_code TEXT NOT NULL,
-                        line_code TEXT NOT NULL,
-                        destination TEXT NOT NULL,
-                        train_name TEXT NOT NULL,
-                        UNIQUE(stop_pk,time,trip_code,line_code))
-                    ''')
-                self.exec('''
-                    INSERT INTO Departure (stop_pk, time, delay, trip_code, line_code, destination, train_name)
-                    SELECT WatchedStop.pk, time, delay, trip_code, line_code, destination, train_name
-                    FROM Departure_TMP
-                    INNER JOIN WatchedStop WHERE WatchedStop.id = Departure_TMP.stop
-                    ''')
-
-                self.exec('''ALTER TABLE Arrival RENAME TO Arrival_TMP''')
-                self.exec('''
-                    CREATE TABLE Arrival(
-                        stop_pk INTEGER REFERENCES WatchedStop(pk),
-                        time TIMESTAMP NOT NULL,
-                        delay REAL,
-                        trip_code TEXT NOT NULL,
-                        line_code TEXT NOT NULL,
-                        origin TEXT NOT NULL,
-                        train_name TEXT NOT NULL,
-                        UNIQUE(stop_pk,time,trip_code,line_code))
-                    ''')
-                self.exec('''
-                    INSERT INTO Arrival (stop_pk, time, delay, trip_code, line_code, origin, train_name)
-                    SELECT WatchedStop.pk, time, delay, trip_code, line_code, origin, train_name
-                    FROM Arrival_TMP
-                    INNER JOIN WatchedStop WHERE WatchedStop.id = Arrival_TMP.stop
-                    ''')
-
-                self.exec('DROP TABLE Arrival_TMP')
-                self.exec('DROP TABLE Departure_TMP')
-                self.exec('DROP TABLE WatchedStop_TMP')
-
-                should_vacuum = True
-
-                dbver = 2
-
-            if dbver < 3:
-                # db schema v3: do manual dictionary compression for line codes
-                self.exec('''
-                    CREATE TABLE LineCodeDictionary(
-                        pk INTEGER PRIMARY KEY,
-                        line_code TEXT UNIQUE NOT NULL)
-                    ''')
-                self.exec('''
-                    INSERT OR IGNORE INTO LineCodeDictionary (line_code)
-                    SELECT line_code FROM Departure
-                    ''')
-                self.exec('''
+        self.exec('''
+            CREATE TABLE IF NOT EXISTS MigrationProgress(
+                task TEXT NOT NULL PRIMARY KEY,
+                position INTEGER NOT NULL,
+                done INTEGER NOT NULL)
+            ''')
+
+        if dbver < 1:
+            with self:
+                if self._step_pending(1):
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS WatchedStop(
+                            id UUID NOT NULL PRIMARY KEY,
+                            efa_stop_id INTEGER NOT NULL,
+                            name TEXT NOT NULL)
+                        ''')
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS Departure(
+                            stop UUID REFERENCES WatchedStop(id),
+                            time TIMESTAMP NOT NULL,
+                            delay REAL,
+                            trip_code TEXT NOT NULL,
+                            line_code TEXT NOT NULL,
+                            destination TEXT NOT NULL,
+                            train_name TEXT NOT NULL,
+                            UNIQUE(stop,time,trip_code,line_code))
+                        ''')
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS Arrival(
+                            stop UUID REFERENCES WatchedStop(id),
+                            time TIMESTAMP NOT NULL,
+                            delay REAL,
+                            trip_code TEXT NOT NULL,
+                            line_code TEXT NOT NULL,
+                            origin TEXT NOT NULL,
+                            train_name TEXT NOT NULL,
+                            UNIQUE(stop,time,trip_code,line_code))
+                        ''')
+
+                    self._finish_step(1)
+            dbver = 1
+
+        if dbver < 2:
+            # migration to db schema v2: use integer primary keys instead of UUIDs
+            # for inter-table relations to save space
+            self._rebuild_table('v2:WatchedStop', 'WatchedStop', '''
+                CREATE TABLE IF NOT EXISTS WatchedStop(
+                    pk INTEGER PRIMARY KEY,
+                    id UUID NOT NULL UNIQUE,
+                    efa_stop_id INTEGER NOT NULL,
+                    name TEXT NOT NULL)
+                ''', '''
+                INSERT INTO WatchedStop (id, efa_stop_id, name)
+                SELECT id, efa_stop_id, name FROM WatchedStop_TMP
+                WHERE {}
+                '''.format(ROWID_RANGE_SQL('WatchedStop_TMP')))
+
+            self._rebuild_table('v2:Departure', 'Departure', '''
+                CREATE TABLE IF NOT EXISTS Departure(
+                    stop_pk INTEGER REFERENCES WatchedStop(pk),
+                    time TIMESTAMP NOT NULL,
+                    delay REAL,
+                    trip_code TEXT NOT NULL,
+                    line_code TEXT NOT NULL,
+                    destination TEXT NOT NULL,
+                    train_name TEXT NOT NULL,
+                    UNIQUE(stop_pk,time,trip_code,line_code))
+                ''', '''
+                INSERT INTO Departure (stop_pk, time, delay, trip_code, line_code, destination, train_name)
+                SELECT WatchedStop.pk, time, delay, trip_code, line_code, destination, train_name
+                FROM Departure_TMP
+                INNER JOIN WatchedStop WHERE WatchedStop.id = Departure_TMP.stop AND {}
+                '''.format(ROWID_RANGE_SQL('Departure_TMP')))
+
+            self._rebuild_table('v2:Arrival', 'Arrival', '''
+                CREATE TABLE IF NOT EXISTS Arrival(
+                    stop_pk INTEGER REFERENCES WatchedStop(pk),
+                    time TIMESTAMP NOT NULL,
+                    delay REAL,
+                    trip_code TEXT NOT NULL,
+                    line_code TEXT NOT NULL,
+                    origin TEXT NOT NULL,
+                    train_name TEXT NOT NULL,
+                    UNIQUE(stop_pk,time,trip_code,line_code))
+                ''', '''
+                INSERT INTO Arrival (stop_pk, time, delay, trip_code, line_code, origin, train_name)
+                SELECT WatchedStop.pk, time, delay, trip_code, line_code, origin, train_name
+                FROM Arrival_TMP
+                INNER JOIN WatchedStop WHERE WatchedStop.id = Arrival_TMP.stop AND {}
+                '''.format(ROWID_RANGE_SQL('Arrival_TMP')))
+
+            with self:
+                if self._step_pending(2):
+                    self.exec('DROP TABLE IF EXISTS Arrival_TMP')
+                    self.exec('DROP TABLE IF EXISTS Departure_TMP')
+                    self.exec('DROP TABLE IF EXISTS WatchedStop_TMP')
+
+                    self._finish_step(2)
+            dbver = 2
+            should_vacuum = True
+
+        if dbver < 3:
+            # db schema v3: do manual dictionary compression for line codes
+            with self:
+                if self._run_once('v3:LineCodeDictionary'):
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS LineCodeDictionary(
+                            pk INTEGER PRIMARY KEY,
+                            line_code TEXT UNIQUE NOT NULL)
+                        ''')
+            for table in ['Departure', 'Arrival']:
+                self._run_chunked('v3:LineCodeDictionary:' + table, table, '''
                     INSERT OR IGNORE INTO LineCodeDictionary (line_code)
-                    SELECT line_code FROM Arrival
-                    ''')
-
-                self.exec('''ALTER TABLE Departure RENAME TO Departure_TMP''')
-                self.exec('''
-                    CREATE TABLE Departure(
-                        stop_pk INTEGER REFERENCES WatchedStop(pk),
-                        time TIMESTAMP NOT NULL,
-                        delay REAL,
-                        trip_code TEXT NOT NULL,
-                        line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
-                        destination TEXT NOT NULL,
-                        train_name TEXT NOT NULL,
-                        UNIQUE(stop_pk,time,trip_code,line_code_pk))
-                    ''')
-                self.exec('''
-                    INSERT INTO Departure (stop_pk, time, delay, trip_code, line_code_pk, destination, train_name)
-                    SELECT stop_pk, time, delay, trip_code, LineCodeDictionary.pk, destination, train_name
-                    FROM Departure_TMP
-                    INNER JOIN LineCodeDictionary WHERE LineCodeDictionary.line_code = Departure_TMP.line_code
-                    ''')
-
-                self.exec('''ALTER TABLE Arrival RENAME TO Arrival_TMP''')
-                self.exec('''
-                    CREATE TABLE Arrival(
-                        stop_pk INTEGER REFERENCES WatchedStop(pk),
-                        time TIMESTAMP NOT NULL,
-                        delay REAL,
-                        trip_code TEXT NOT NULL,
-                        line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
-                        origin TEXT NOT NULL,
-                        train_name TEXT NOT NULL,
-                        UNIQUE(stop_pk,time,trip_code,line_code_pk))
-                    ''')
-                self.exec('''
-                    INSERT INTO Arrival (stop_pk, time, delay, trip_code, line_code_pk, origin, train_name)
-                    SELECT stop_pk, time, delay, trip_code, LineCodeDictionary.pk, origin, train_name
-                    FROM Arrival_TMP
-                    INNER JOIN LineCodeDictionary WHERE LineCodeDictionary.line_code = Arrival_TMP.line_code
-                    ''')
-
-                self.exec('DROP TABLE Arrival_TMP')
-                self.exec('DROP TABLE Departure_TMP')
-
-                should_vacuum = True
-                dbver = 3
-
-            if dbver < 4:
-                # db schema v4: manual dictionary compression for origin and destination names
-                self.exec('''
-                    CREATE TABLE OriginDestinationDictionary(
-                        pk INTEGER PRIMARY KEY,
-                        name TEXT UNIQUE NOT NULL)
-                    ''')
-                self.exec('''
-                    INSERT OR IGNORE INTO OriginDestinationDictionary (name)
-                    SELECT destination FROM Departure
-                    ''')
-                self.exec('''
+                    SELECT line_code FROM {0} WHERE {1}
+                    '''.format(table, ROWID_RANGE_SQL(table)))
+
+            self._rebuild_table('v3:Departure', 'Departure', '''
+                CREATE TABLE IF NOT EXISTS Departure(
+                    stop_pk INTEGER REFERENCES WatchedStop(pk),
+                    time TIMESTAMP NOT NULL,
+                    delay REAL,
+                    trip_code TEXT NOT NULL,
+                    line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
+                    destination TEXT NOT NULL,
+                    train_name TEXT NOT NULL,
+                    UNIQUE(stop_pk,time,trip_code,line_code_pk))
+                ''', '''
+                INSERT INTO Departure (stop_pk, time, delay, trip_code, line_code_pk, destination, train_name)
+                SELECT stop_pk, time, delay, trip_code, LineCodeDictionary.pk, destination, train_name
+                FROM Departure_TMP
+                INNER JOIN LineCodeDictionary WHERE LineCodeDictionary.line_code = Departure_TMP.line_code AND {}
+                '''.format(ROWID_RANGE_SQL('Departure_TMP')))
+
+            self._rebuild_table('v3:Arrival', 'Arrival', '''
+                CREATE TABLE IF NOT EXISTS Arrival(
+                    stop_pk INTEGER REFERENCES WatchedStop(pk),
+                    time TIMESTAMP NOT NULL,
+                    delay REAL,
+                    trip_code TEXT NOT NULL,
+                    line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
+                    origin TEXT NOT NULL,
+                    train_name TEXT NOT NULL,
+                    UNIQUE(stop_pk,time,trip_code,line_code_pk))
+                ''', '''
+                INSERT INTO Arrival (stop_pk, time, delay, trip_code, line_code_pk, origin, train_name)
+                SELECT stop_pk, time, delay, trip_code, LineCodeDictionary.pk, origin, train_name
+                FROM Arrival_TMP
+                INNER JOIN LineCodeDictionary WHERE LineCodeDictionary.line_code = Arrival_TMP.line_code AND {}
+                '''.format(ROWID_RANGE_SQL('Arrival_TMP')))
+
+            with self:
+                if self._step_pending(3):
+                    self.exec('DROP TABLE IF EXISTS Arrival_TMP')
+                    self.exec('DROP TABLE IF EXISTS Departure_TMP')
+
+                    self._finish_step(3)
+            dbver = 3
+            should_vacuum = True
+
+        if dbver < 4:
+            # db schema v4: manual dictionary compression for origin and destination names
+            with self:
+                if self._run_once('v4:OriginDestinationDictionary'):
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS OriginDestinationDictionary(
+                            pk INTEGER PRIMARY KEY,
+                            name TEXT UNIQUE NOT NULL)
+                        ''')
+            for table, column in [('Departure', 'destination'), ('Arrival', 'origin')]:
+                self._run_chunked('v4:OriginDestinationDictionary:' + table, table, '''
                     INSERT OR IGNORE INTO OriginDestinationDictionary (name)
-                    SELECT origin FROM Arrival
-                    ''')
-
-                self.exec('''ALTER TABLE Departure RENAME TO Departure_TMP''')
-                self.exec('''
-                    CREATE TABLE Departure(
-                        stop_pk INTEGER REFERENCES WatchedStop(pk),
-                        time TIMESTAMP NOT NULL,
-                        delay REAL,
-                        trip_code TEXT NOT NULL,
-                        line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
-                        destination_pk INTEGER REFERENCES OriginDestinationDictionary(pk),
-                        train_name TEXT NOT NULL,
-                        UNIQUE(stop_pk,time,trip_code,line_code_pk))
-                    ''')
-                self.exec('''
-                    INSERT INTO Departure (stop_pk, time, delay, trip_code, line_code_pk, destination_pk, train_name)
-                    SELECT stop_pk, time, delay, trip_code, line_code_pk, OriginDestinationDictionary.pk, train_name
-                    FROM Departure_TMP
-                    INNER JOIN OriginDestinationDictionary WHERE OriginDestinationDictionary.name = Departure_TMP.destination
-                    ''')
-
-                self.exec('''ALTER TABLE Arrival RENAME TO Arrival_TMP''')
-                self.exec('''
-                    CREATE TABLE Arrival(
-                        stop_pk INTEGER REFERENCES WatchedStop(pk),
-                        time TIMESTAMP NOT NULL,
-                        delay REAL,
-                        trip_code TEXT NOT NULL,
-                        line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
-                        origin_pk INTEGER REFERENCES OriginDestinationDictionary(pk),
-                        train_name TEXT NOT NULL,
-                        UNIQUE(stop_pk,time,trip_code,line_code_pk))
-                    ''')
-                self.exec('''
-                    INSERT INTO Arrival (stop_pk, time, delay, trip_code, line_code_pk, origin_pk, train_name)
-                    SELECT stop_pk, time, delay, trip_code, line_code_pk, OriginDestinationDictionary.pk, train_name
-                    FROM Arrival_TMP
-                    INNER JOIN OriginDestinationDictionary ON OriginDestinationDictionary.name = Arrival_TMP.origin
-                    ''')
-
-                self.exec('DROP TABLE Arrival_TMP')
-                self.exec('DROP TABLE Departure_TMP')
-
-                dbver = 4
-                should_vacuum = True
-
-            if dbver < 5:
-                # db schema v5: manual dictionary compression for train names
-                self.exec('''
-                    CREATE TABLE TrainNameDictionary(
-                        pk INTEGER PRIMARY KEY,
-                        train_name TEXT UNIQUE NOT NULL)
-                    ''')
-                self.exec('''
+                    SELECT {1} FROM {0} WHERE {2}
+                    '''.format(table, column, ROWID_RANGE_SQL(table)))
+
+            self._rebuild_table('v4:Departure', 'Departure', '''
+                CREATE TABLE IF NOT EXISTS Departure(
+                    stop_pk INTEGER REFERENCES WatchedStop(pk),
+                    time TIMESTAMP NOT NULL,
+                    delay REAL,
+                    trip_code TEXT NOT NULL,
+                    line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
+                    destination_pk INTEGER REFERENCES OriginDestinationDictionary(pk),
+                    train_name TEXT NOT NULL,
+                    UNIQUE(stop_pk,time,trip_code,line_code_pk))
+                ''', '''
+                INSERT INTO Departure (stop_pk, time, delay, trip_code, line_code_pk, destination_pk, train_name)
+                SELECT stop_pk, time, delay, trip_code, line_code_pk, OriginDestinationDictionary.pk, train_name
+                FROM Departure_TMP
+                INNER JOIN OriginDestinationDictionary WHERE OriginDestinationDictionary.name = Departure_TMP.destination AND {}
+                '''.format(ROWID_RANGE_SQL('Departure_TMP')))
+
+            self._rebuild_table('v4:Arrival', 'Arrival', '''
+                CREATE TABLE IF NOT EXISTS Arrival(
+                    stop_pk INTEGER REFERENCES WatchedStop(pk),
+                    time TIMESTAMP NOT NULL,
+                    delay REAL,
+                    trip_code TEXT NOT NULL,
+                    line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
+                    origin_pk INTEGER REFERENCES OriginDestinationDictionary(pk),
+                    train_name TEXT NOT NULL,
+                    UNIQUE(stop_pk,time,trip_code,line_code_pk))
+                ''', '''
+                INSERT INTO Arrival (stop_pk, time, delay, trip_code, line_code_pk, origin_pk, train_name)
+                SELECT stop_pk, time, delay, trip_code, line_code_pk, OriginDestinationDictionary.pk, train_name
+                FROM Arrival_TMP
+                INNER JOIN OriginDestinationDictionary ON OriginDestinationDictionary.name = Arrival_TMP.origin
+                WHERE {}
+                '''.format(ROWID_RANGE_SQL('Arrival_TMP')))
+
+            with self:
+                if self._step_pending(4):
+                    self.exec('DROP TABLE IF EXISTS Arrival_TMP')
+                    self.exec('DROP TABLE IF EXISTS Departure_TMP')
+
+                    self._finish_step(4)
+            dbver = 4
+            should_vacuum = True
+
+        if dbver < 5:
+            # db schema v5: manual dictionary compression for train names
+            with self:
+                if self._run_once('v5:TrainNameDictionary'):
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS TrainNameDictionary(
+                            pk INTEGER PRIMARY KEY,
+                            train_name TEXT UNIQUE NOT NULL)
+                        ''')
+            for table in ['Departure', 'Arrival']:
+                self._run_chunked('v5:TrainNameDictionary:' + table, table, '''
                     INSERT OR IGNORE INTO TrainNameDictionary(train_name)
-                    SELECT train_name FROM Departure
-                    ''')
-                self.exec('''
-                    INSERT OR IGNORE INTO TrainNameDictionary(train_name)
-                    SELECT train_name FROM Arrival
-                    ''')
-
-                self.exec('''ALTER TABLE Departure RENAME TO Departure_TMP''')
-                self.exec('''
-                    CREATE TABLE Departure(
-                        stop_pk INTEGER REFERENCES WatchedStop(pk),
-                        time TIMESTAMP NOT NULL,
-                        delay REAL,
-                        trip_code TEXT NOT NULL,
-                        line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
-                        destination_pk INTEGER REFERENCES OriginDestinationDictionary(pk),
-                        train_name_pk INTEGER REFERENCES TrainNameDictionary(pk),
-                        UNIQUE(stop_pk,time,trip_code,line_code_pk))
-                    ''')
-                self.exec('''
-                    INSERT INTO Departure (stop_pk, time, delay, trip_code, line_code_pk, destination_pk, train_name_pk)
-                    SELECT stop_pk, time, delay, trip_code, line_code_pk, destination_pk, TrainNameDictionary.pk
-                    FROM Departure_TMP
-                    INNER JOIN TrainNameDictionary WHERE TrainNameDictionary.train_name = Departure_TMP.train_name
-                    ''')
-
-                self.exec('''ALTER TABLE Arrival RENAME TO Arrival_TMP''')
-                self.exec('''
-                    CREATE TABLE Arrival(
-                        stop_pk INTEGER REFERENCES WatchedStop(pk),
-                        time TIMESTAMP NOT NULL,
-                        delay REAL,
-                        trip_code TEXT NOT NULL,
-                        line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
-                        origin_pk INTEGER REFERENCES OriginDestinationDictionary(pk),
-                        train_name_pk INTEGER REFERENCES TrainNameDictionary(pk),
-                        UNIQUE(stop_pk,time,trip_code,line_code_pk))
-                    ''')
-                self.exec('''
-                    INSERT INTO Arrival (stop_pk, time, delay, trip_code, line_code_pk, origin_pk, train_name_pk)
-                    SELECT stop_pk, time, delay, trip_code, line_code_pk, origin_pk, TrainNameDictionary.pk
-                    FROM Arrival_TMP
-                    INNER JOIN TrainNameDictionary ON TrainNameDictionary.train_name = Arrival_TMP.train_name
-                    ''')
-
-                self.exec('DROP TABLE Arrival_TMP')
-                self.exec('DROP TABLE Departure_TMP')
-
-                dbver = 5
-                should_vacuum = True
-
-            if dbver < 6:
-                # active flag in WatchedStop table
-
-                self.exec('ALTER TABLE WatchedStop ADD COLUMN active INTEGER NOT NULL DEFAULT 0')
-                self.exec('UPDATE WatchedStop SET active = 1')
-
-                dbver = 6
-
-            assert dbver == DBVER_CURRENT
-            self.exec('PRAGMA user_version = {}'.format(dbver))
+                    SELECT train_name FROM {0} WHERE {1}
+                    '''.format(table, ROWID_RANGE_SQL(table)))
+
+            self._rebuild_table('v5:Departure', 'Departure', '''
+                CREATE TABLE IF NOT EXISTS Departure(
+                    stop_pk INTEGER REFERENCES WatchedStop(pk),
+                    time TIMESTAMP NOT NULL,
+                    delay REAL,
+                    trip_code TEXT NOT NULL,
+                    line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
+                    destination_pk INTEGER REFERENCES OriginDestinationDictionary(pk),
+                    train_name_pk INTEGER REFERENCES TrainNameDictionary(pk),
+                    UNIQUE(stop_pk,time,trip_code,line_code_pk))
+                ''', '''
+                INSERT INTO Departure (stop_pk, time, delay, trip_code, line_code_pk, destination_pk, train_name_pk)
+                SELECT stop_pk, time, delay, trip_code, line_code_pk, destination_pk, TrainNameDictionary.pk
+                FROM Departure_TMP
+                INNER JOIN TrainNameDictionary WHERE TrainNameDictionary.train_name = Departure_TMP.train_name AND {}
+                '''.format(ROWID_RANGE_SQL('Departure_TMP')))
+
+            self._rebuild_table('v5:Arrival', 'Arrival', '''
+                CREATE TABLE IF NOT EXISTS Arrival(
+                    stop_pk INTEGER REFERENCES WatchedStop(pk),
+                    time TIMESTAMP NOT NULL,
+                    delay REAL,
+                    trip_code TEXT NOT NULL,
+                    line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
+                    origin_pk INTEGER REFERENCES OriginDestinationDictionary(pk),
+                    train_name_pk INTEGER REFERENCES TrainNameDictionary(pk),
+                    UNIQUE(stop_pk,time,trip_code,line_code_pk))
+                ''', '''
+                INSERT INTO Arrival (stop_pk, time, delay, trip_code, line_code_pk, origin_pk, train_name_pk)
+                SELECT stop_pk, time, delay, trip_code, line_code_pk, origin_pk, TrainNameDictionary.pk
+                FROM Arrival_TMP
+                INNER JOIN TrainNameDictionary ON TrainNameDictionary.train_name = Arrival_TMP.train_name
+                WHERE {}
+                '''.format(ROWID_RANGE_SQL('Arrival_TMP')))
+
+            with self:
+                if self._step_pending(5):
+                    self.exec('DROP TABLE IF EXISTS Arrival_TMP')
+                    self.exec('DROP TABLE IF EXISTS Departure_TMP')
+
+                    self._finish_step(5)
+            dbver = 5
+            should_vacuum = True
+
+        if dbver < 6:
+            # active flag in WatchedStop table
+            with self:
+                if self._step_pending(6):
+                    self.exec('ALTER TABLE WatchedStop ADD COLUMN active INTEGER NOT NULL DEFAULT 0')
+                    self.exec('UPDATE WatchedStop SET active = 1')
+
+                    self._finish_step(6)
+            dbver = 6
+
+        if dbver < 7:
+            # db schema v7: persistent trip table, kept up to date by triggers,
+            # so that reports don't need to join departures and arrivals again
+            with self:
+                if self._run_once('v7:TripObservation'):
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS TripObservation(
+                            origin_pk INTEGER NOT NULL REFERENCES WatchedStop(pk),
+                            destination_pk INTEGER NOT NULL REFERENCES WatchedStop(pk),
+                            dep_time TIMESTAMP NOT NULL,
+                            arr_time TIMESTAMP NOT NULL,
+                            line_code_pk INTEGER NOT NULL REFERENCES LineCodeDictionary(pk),
+                            trip_code TEXT NOT NULL,
+                            train_name_pk INTEGER NOT NULL REFERENCES TrainNameDictionary(pk),
+                            dep_delay REAL,
+                            arr_delay REAL,
+                            PRIMARY KEY (origin_pk, destination_pk, dep_time, line_code_pk, trip_code, arr_time))
+                        WITHOUT ROWID
+                        ''')
+                    self.exec('CREATE INDEX IF NOT EXISTS Departure_Index_Trip ON Departure(line_code_pk, trip_code, time)')
+                    self.exec('CREATE INDEX IF NOT EXISTS Arrival_Index_Trip ON Arrival(line_code_pk, trip_code, time)')
+                    self.exec('CREATE INDEX IF NOT EXISTS TripObservation_Index_Departure ON TripObservation(line_code_pk, trip_code, dep_time)')
+                    self.exec('CREATE INDEX IF NOT EXISTS TripObservation_Index_Arrival ON TripObservation(line_code_pk, trip_code, arr_time)')
+
+            self._run_chunked('v7:TripObservation:Departure', 'Departure', '''
+                INSERT OR IGNORE INTO TripObservation (origin_pk, destination_pk, dep_time, arr_time,
+                    line_code_pk, trip_code, train_name_pk, dep_delay, arr_delay)
+                SELECT Departure.stop_pk, Arrival.stop_pk, Departure.time, Arrival.time,
+                    Departure.line_code_pk, Departure.trip_code, Departure.train_name_pk, Departure.delay, Arrival.delay
+                FROM Departure
+                JOIN Arrival ON Arrival.line_code_pk = Departure.line_code_pk
+                 AND Arrival.trip_code = Departure.trip_code
+                 AND Arrival.time > Departure.time
+                 AND Arrival.time < datetime(Departure.time, '+12 hours')
+                WHERE {}
+                '''.format(ROWID_RANGE_SQL('Departure')))
+
+            with self:
+                if self._step_pending(7):
+                    # a trip consists of a departure and an arrival of the same train within 12 hours
+                    self.exec('''
+                        CREATE TRIGGER IF NOT EXISTS Departure_TripObservation_Insert AFTER INSERT ON Departure
+                        BEGIN
+                            INSERT OR IGNORE INTO TripObservation (origin_pk, destination_pk, dep_time, arr_time,
+                                line_code_pk, trip_code, train_name_pk, dep_delay, arr_delay)
+                            SELECT NEW.stop_pk, Arrival.stop_pk, NEW.time, Arrival.time,
+                                NEW.line_code_pk, NEW.trip_code, NEW.train_name_pk, NEW.delay, Arrival.delay
+                            FROM Arrival
+                            WHERE Arrival.line_code_pk = NEW.line_code_pk
+                             AND Arrival.trip_code = NEW.trip_code
+                             AND Arrival.time > NEW.time
+                             AND Arrival.time < datetime(NEW.time, '+12 hours');
+                        END
+                        ''')
+                    self.exec('''
+                        CREATE TRIGGER IF NOT EXISTS Arrival_TripObservation_Insert AFTER INSERT ON Arrival
+                        BEGIN
+                            INSERT OR IGNORE INTO TripObservation (origin_pk, destination_pk, dep_time, arr_time,
+                                line_code_pk, trip_code, train_name_pk, dep_delay, arr_delay)
+                            SELECT Departure.stop_pk, NEW.stop_pk, Departure.time, NEW.time,
+                                NEW.line_code_pk, NEW.trip_code, Departure.train_name_pk, Departure.delay, NEW.delay
+                            FROM Departure
+                            WHERE Departure.line_code_pk = NEW.line_code_pk
+                             AND Departure.trip_code = NEW.trip_code
+                             AND Departure.time < NEW.time
+                             AND Departure.time > datetime(NEW.time, '-12 hours');
+                        END
+                        ''')
+                    self.exec('''
+                        CREATE TRIGGER IF NOT EXISTS Departure_TripObservation_Update AFTER UPDATE OF delay ON Departure
+                        BEGIN
+                            UPDATE TripObservation SET dep_delay = NEW.delay
+                            WHERE line_code_pk = NEW.line_code_pk
+                             AND trip_code = NEW.trip_code
+                             AND dep_time = NEW.time
+                             AND origin_pk = NEW.stop_pk;
+                        END
+                        ''')
+                    self.exec('''
+                        CREATE TRIGGER IF NOT EXISTS Arrival_TripObservation_Update AFTER UPDATE OF delay ON Arrival
+                        BEGIN
+                            UPDATE TripObservation SET arr_delay = NEW.delay
+                            WHERE line_code_pk = NEW.line_code_pk
+                             AND trip_code = NEW.trip_code
+                             AND arr_time = NEW.time
+                             AND destination_pk = NEW.stop_pk;
+                        END
+                        ''')
+
+                    self._finish_step(7)
+            dbver = 7
+        if dbver < 8:
+            # db schema v8: daily rollups for the reports. Changed rows only mark their
+            # rollup group as dirty, because the summaries are computed in Python;
+            # refresh_rollups() recomputes the dirty groups. The triggers use an upsert
+            # clause, because the ON CONFLICT policy of the outer statement (the
+            # upserts of the collectors) would override an INSERT OR IGNORE.
+            with self:
+                if self._step_pending(8):
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS TripDailyRollup(
+                            origin_pk INTEGER NOT NULL REFERENCES WatchedStop(pk),
+                            destination_pk INTEGER NOT NULL REFERENCES WatchedStop(pk),
+                            date TEXT NOT NULL,
+                            train_name_pk INTEGER NOT NULL REFERENCES TrainNameDictionary(pk),
+                            dep TEXT NOT NULL,
+                            arr TEXT NOT NULL,
+                            count INTEGER NOT NULL,
+                            dep_delays TEXT NOT NULL,
+                            arr_delays TEXT NOT NULL,
+                            PRIMARY KEY (origin_pk, destination_pk, date, train_name_pk, dep, arr))
+                        WITHOUT ROWID
+                        ''')
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS TripRollupDirty(
+                            origin_pk INTEGER NOT NULL,
+                            destination_pk INTEGER NOT NULL,
+                            date TEXT NOT NULL,
+                            train_name_pk INTEGER NOT NULL,
+                            dep TEXT NOT NULL,
+                            arr TEXT NOT NULL,
+                            PRIMARY KEY (origin_pk, destination_pk, date, train_name_pk, dep, arr))
+                        WITHOUT ROWID
+                        ''')
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS DepartureDailyRollup(
+                            stop_pk INTEGER NOT NULL REFERENCES WatchedStop(pk),
+                            date TEXT NOT NULL,
+                            train_name_pk INTEGER NOT NULL REFERENCES TrainNameDictionary(pk),
+                            destination_pk INTEGER NOT NULL REFERENCES OriginDestinationDictionary(pk),
+                            time TEXT NOT NULL,
+                            count INTEGER NOT NULL,
+                            delays TEXT NOT NULL,
+                            PRIMARY KEY (stop_pk, date, train_name_pk, destination_pk, time))
+                        WITHOUT ROWID
+                        ''')
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS DepartureRollupDirty(
+                            stop_pk INTEGER NOT NULL,
+                            date TEXT NOT NULL,
+                            train_name_pk INTEGER NOT NULL,
+                            destination_pk INTEGER NOT NULL,
+                            time TEXT NOT NULL,
+                            PRIMARY KEY (stop_pk, date, train_name_pk, destination_pk, time))
+                        WITHOUT ROWID
+                        ''')
+
+                    for event in ['INSERT', 'UPDATE']:
+                        self.exec('''
+                            CREATE TRIGGER IF NOT EXISTS TripObservation_Rollup_{0} AFTER {0} ON TripObservation
+                            BEGIN
+                                INSERT INTO TripRollupDirty (origin_pk, destination_pk, date, train_name_pk, dep, arr)
+                                VALUES (NEW.origin_pk, NEW.destination_pk, date(NEW.dep_time), NEW.train_name_pk,
+                                        strftime('%H:%M', NEW.dep_time), strftime('%H:%M', NEW.arr_time))
+                                ON CONFLICT DO NOTHING;
+                            END
+                            '''.format(event))
+                    self.exec('''
+                        CREATE TRIGGER IF NOT EXISTS Departure_Rollup_Insert AFTER INSERT ON Departure
+                        BEGIN
+                            INSERT INTO DepartureRollupDirty (stop_pk, date, train_name_pk, destination_pk, time)
+                            VALUES (NEW.stop_pk, date(NEW.time), NEW.train_name_pk, NEW.destination_pk, strftime('%H:%M', NEW.time))
+                            ON CONFLICT DO NOTHING;
+                        END
+                        ''')
+                    self.exec('''
+                        CREATE TRIGGER IF NOT EXISTS Departure_Rollup_Update AFTER UPDATE OF delay ON Departure
+                        BEGIN
+                            INSERT INTO DepartureRollupDirty (stop_pk, date, train_name_pk, destination_pk, time)
+                            VALUES (NEW.stop_pk, date(NEW.time), NEW.train_name_pk, NEW.destination_pk, strftime('%H:%M', NEW.time))
+                            ON CONFLICT DO NOTHING;
+                        END
+                        ''')
+
+                    # the rollups are computed after the last step, in batches
+                    self._add_migration_task('rollups')
+                    self._finish_step(8)
+            dbver = 8
+
+        if dbver < 9:
+            # db schema v9: the rollups store binned quantile sketches as BLOBs
+            # instead of exact value lists, so they are recomputed from the observations
+            with self:
+                if self._step_pending(9):
+                    self.exec('DROP TABLE IF EXISTS TripDailyRollup')
+                    self.exec('DROP TABLE IF EXISTS DepartureDailyRollup')
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS TripDailyRollup(
+                            origin_pk INTEGER NOT NULL REFERENCES WatchedStop(pk),
+                            destination_pk INTEGER NOT NULL REFERENCES WatchedStop(pk),
+                            date TEXT NOT NULL,
+                            train_name_pk INTEGER NOT NULL REFERENCES TrainNameDictionary(pk),
+                            dep TEXT NOT NULL,
+                            arr TEXT NOT NULL,
+                            count INTEGER NOT NULL,
+                            dep_delays BLOB NOT NULL,
+                            arr_delays BLOB NOT NULL,
+                            PRIMARY KEY (origin_pk, destination_pk, date, train_name_pk, dep, arr))
+                        WITHOUT ROWID
+                        ''')
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS DepartureDailyRollup(
+                            stop_pk INTEGER NOT NULL REFERENCES WatchedStop(pk),
+                            date TEXT NOT NULL,
+                            train_name_pk INTEGER NOT NULL REFERENCES TrainNameDictionary(pk),
+                            destination_pk INTEGER NOT NULL REFERENCES OriginDestinationDictionary(pk),
+                            time TEXT NOT NULL,
+                            count INTEGER NOT NULL,
+                            delays BLOB NOT NULL,
+                            PRIMARY KEY (stop_pk, date, train_name_pk, destination_pk, time))
+                        WITHOUT ROWID
+                        ''')
+                    self._add_migration_task('rollups')
+                    self._finish_step(9)
+            dbver = 9
+
+        if dbver < 10:
+            # db schema v10: compact Departure and Arrival rows, clustered on their key
+            # instead of a rowid table plus a unique index with nearly the same content
+            with self:
+                if self._run_once('v10:drop-triggers'):
+                    for trigger in ['Departure_TripObservation_Insert', 'Arrival_TripObservation_Insert',
+                                    'Departure_TripObservation_Update', 'Arrival_TripObservation_Update',
+                                    'Departure_Rollup_Insert', 'Departure_Rollup_Update']:
+                        self.exec('DROP TRIGGER IF EXISTS {}'.format(trigger))
+
+            for table in ['Departure', 'Arrival']:
+                with self:
+                    if self._run_once('v10:{}:create'.format(table)):
+                        self.exec('ALTER TABLE {0} RENAME TO {0}_TMP'.format(table))
+                        self._create_compact_fact_table('main', table, references=True)
+                self._run_chunked('v10:' + table, table + '_TMP',
+                                  _compact_copy_sql('main', table, ROWID_RANGE_SQL(table + '_TMP')))
+
+            with self:
+                if self._step_pending(10):
+                    self.exec('DROP TABLE IF EXISTS Departure_TMP')
+                    self.exec('DROP TABLE IF EXISTS Arrival_TMP')
+                    self.exec('CREATE INDEX IF NOT EXISTS Departure_Index_Trip ON Departure(line_code_pk, trip_code, time)')
+                    self.exec('CREATE INDEX IF NOT EXISTS Arrival_Index_Trip ON Arrival(line_code_pk, trip_code, time)')
+
+                    self.exec('''
+                        CREATE TRIGGER IF NOT EXISTS Departure_TripObservation_Insert AFTER INSERT ON Departure
+                        BEGIN
+                            INSERT OR IGNORE INTO TripObservation (origin_pk, destination_pk, dep_time, arr_time,
+                                line_code_pk, trip_code, train_name_pk, dep_delay, arr_delay)
+                            SELECT NEW.stop_pk, Arrival.stop_pk, {0}, {1},
+                                NEW.line_code_pk, NEW.trip_code, NEW.train_name_pk, {2}, {3}
+                            FROM Arrival
+                            WHERE Arrival.line_code_pk = NEW.line_code_pk
+                             AND Arrival.trip_code = NEW.trip_code
+                             AND Arrival.time > NEW.time
+                             AND Arrival.time < NEW.time + 12*60;
+                        END
+                        '''.format(MINUTES_SQL_DATETIME('NEW.time'), MINUTES_SQL_DATETIME('Arrival.time'),
+                                   DELAY_SQL_REAL('NEW.delay'), DELAY_SQL_REAL('Arrival.delay')))
+                    self.exec('''
+                        CREATE TRIGGER IF NOT EXISTS Arrival_TripObservation_Insert AFTER INSERT ON Arrival
+                        BEGIN
+                            INSERT OR IGNORE INTO TripObservation (origin_pk, destination_pk, dep_time, arr_time,
+                                line_code_pk, trip_code, train_name_pk, dep_delay, arr_delay)
+                            SELECT Departure.stop_pk, NEW.stop_pk, {0}, {1},
+                                NEW.line_code_pk, NEW.trip_code, Departure.train_name_pk, {2}, {3}
+                            FROM Departure
+                            WHERE Departure.line_code_pk = NEW.line_code_pk
+                             AND Departure.trip_code = NEW.trip_code
+                             AND Departure.time < NEW.time
+                             AND Departure.time > NEW.time - 12*60;
+                        END
+                        '''.format(MINUTES_SQL_DATETIME('Departure.time'), MINUTES_SQL_DATETIME('NEW.time'),
+                                   DELAY_SQL_REAL('Departure.delay'), DELAY_SQL_REAL('NEW.delay')))
+                    self.exec('''
+                        CREATE TRIGGER IF NOT EXISTS Departure_TripObservation_Update AFTER UPDATE OF delay ON Departure
+                        BEGIN
+                            UPDATE TripObservation SET dep_delay = {1}
+                            WHERE line_code_pk = NEW.line_code_pk
+                             AND trip_code = NEW.trip_code
+                             AND dep_time = {0}
+                             AND origin_pk = NEW.stop_pk;
+                        END
+                        '''.format(MINUTES_SQL_DATETIME('NEW.time'), DELAY_SQL_REAL('NEW.delay')))
+                    self.exec('''
+                        CREATE TRIGGER IF NOT EXISTS Arrival_TripObservation_Update AFTER UPDATE OF delay ON Arrival
+                        BEGIN
+                            UPDATE TripObservation SET arr_delay = {1}
+                            WHERE line_code_pk = NEW.line_code_pk
+                             AND trip_code = NEW.trip_code
+                             AND arr_time = {0}
+                             AND destination_pk = NEW.stop_pk;
+                        END
+                        '''.format(MINUTES_SQL_DATETIME('NEW.time'), DELAY_SQL_REAL('NEW.delay')))
+                    for event in ['INSERT', 'UPDATE OF delay']:
+                        self.exec('''
+                            CREATE TRIGGER IF NOT EXISTS Departure_Rollup_{0} AFTER {1} ON Departure
+                            BEGIN
+                                INSERT INTO DepartureRollupDirty (stop_pk, date, train_name_pk, destination_pk, time)
+                                VALUES (NEW.stop_pk, date({2}), NEW.train_name_pk, NEW.destination_pk, strftime('%H:%M', {2}))
+                                ON CONFLICT DO NOTHING;
+                            END
+                            '''.format(event.split()[0].capitalize(), event, MINUTES_SQL_DATETIME('NEW.time')))
+
+                    self._finish_step(10)
+            dbver = 10
+            should_vacuum = True
+
+        if dbver < 11:
+            # db schema v11: prune() counts up the generation when it removes dictionary
+            # entries, so that other connections know that their cached keys are stale
+            with self:
+                if self._step_pending(11):
+                    self.exec('CREATE TABLE IF NOT EXISTS DictionaryGeneration(generation INTEGER NOT NULL)')
+                    self.exec('''INSERT INTO DictionaryGeneration (generation)
+                                 SELECT 0 WHERE NOT EXISTS (SELECT * FROM DictionaryGeneration)''')
+                    self._finish_step(11)
+            dbver = 11
+
+        if dbver < 12:
+            # db schema v12: the Calendar is stored instead of being rebuilt by every
+            # connection, with the first minute of each day for joins with Departure and Arrival
+            with self:
+                if self._step_pending(12):
+                    self.exec('''
+                        CREATE TABLE IF NOT EXISTS Calendar(
+                            date TEXT NOT NULL PRIMARY KEY,
+                            date_type TEXT NOT NULL,
+                            weekday INTEGER NOT NULL,
+                            is_holiday INTEGER NOT NULL,
+                            holiday_name TEXT,
+                            start_minute INTEGER NOT NULL)
+                        WITHOUT ROWID
+                        ''')
+                    self.exec('CREATE INDEX IF NOT EXISTS Calendar_Index_DateType ON Calendar(date_type, date)')
+                    self.exec('CREATE INDEX IF NOT EXISTS Calendar_Index_DateTypeMinute ON Calendar(date_type, start_minute)')
+                    self.fill_calendar(CALENDAR_FIRST_YEAR, date.today().year + 1)
+                    self._finish_step(12)
+            dbver = 12
+
+        assert dbver == DBVER_CURRENT
+
+        if self._migration_task_pending('rollups'):
+            self.rebuild_rollups()
+            with self:
+                self.exec("DELETE FROM MigrationProgress WHERE task = 'rollups'")
 
         if should_vacuum:
-            self.exec('VACUUM')
+            self.incremental_vacuum()
 
-    def _setup_temps(self):
-        self.exec('''
-            CREATE TEMP VIEW trip
-            AS SELECT TrainNameDictionary.train_name as train_name,
-                      WatchedStop_Departure.id as origin,
-                      WatchedStop_Arrival.id as destination,
-                      strftime('%Y-%m-%d', Departure.time) as date,
-                      strftime('%H:%M', Departure.time) as dep_time,
-                      Departure.delay as dep_delay,
-                      strftime('%H:%M', Arrival.time) as arr_time,
-                      Arrival.delay as arr_delay
-            FROM Departure
-            JOIN Arrival ON Arrival.line_code_pk = Departure.line_code_pk
-             AND Arrival.trip_code = Departure.trip_code
-             AND Arrival.time > Departure.time
-             AND julianday(Arrival.time) - julianday(Departure.time) < 0.5
-            JOIN WatchedStop WatchedStop_Departure ON WatchedStop_Departure.pk = Departure.stop_pk
-            JOIN WatchedStop WatchedStop_Arrival ON WatchedStop_Arrival.pk = Arrival.stop_pk
-            JOIN TrainNameDictionary ON TrainNameDictionary.pk = Departure.train_name_pk''')
-
-    def _materialize_trip_view(self):
+    def _add_migration_task(self, task: str) -> None:
+        self.exec('INSERT OR IGNORE INTO MigrationProgress (task, position, done) VALUES (:task, 0, 0)', task=task)
+
+    def _migration_task_pending(self, task: str) -> bool:
+        return self.exec('SELECT 1 FROM MigrationProgress WHERE task = :task AND NOT done', task=task).fetchone() is not None
+
+    def _migration_pending(self) -> bool:
+        """whether an earlier migration was interrupted, or left work for later"""
+        if self.exec("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'MigrationProgress'").fetchone() is None:
+            return False
+        return self.exec('SELECT 1 FROM MigrationProgress LIMIT 1').fetchone() is not None
+
+    def _step_pending(self, version: int) -> bool:
+        """whether the migration step to schema `version` still has to be done. Must be
+        called inside the transaction which does the work, so that a step another
+        process has finished in the meantime isn't done again."""
+        return self.exec('PRAGMA user_version').fetchone()[0] < version
+
+    def _run_once(self, task: str) -> bool:
+        """records `task` as done and returns whether it hasn't been done before.
+        Must be called inside the transaction which does the work. Task names start
+        with the schema version of their step, like 'v3:LineCodeDictionary'."""
+        if not self._step_pending(_task_version(task)):
+            return False
+
+        return self.exec('INSERT OR IGNORE INTO MigrationProgress (task, position, done) VALUES (:task, 0, 1)',
+                         task=task).rowcount == 1
+
+    def _run_chunked(self, task: str, source: str, sql: str) -> None:
+        """runs `sql` for consecutive rowid ranges (:lo, :hi] of the table `source`,
+        one transaction per batch, and records the progress under `task`.
+
+        Each batch reads the progress inside its transaction, so several processes can
+        run the same task without copying a batch twice."""
+        version = _task_version(task)
+        while True:
+            with self:
+                if not self._step_pending(version):
+                    return
+
+                self._add_migration_task(task)
+                position, done = self.exec('SELECT position, done FROM MigrationProgress WHERE task = :task',
+                                           task=task).fetchone()
+                if done:
+                    return
+
+                last = self.exec('SELECT MAX(rowid) FROM {}'.format(source)).fetchone()[0] or 0
+                if position >= last:
+                    self.exec('UPDATE MigrationProgress SET done = 1 WHERE task = :task', task=task)
+                    return
+
+                end = position + MIGRATION_BATCH_SIZE
+                self.exec(sql, lo=position, hi=end)
+                self.exec('UPDATE MigrationProgress SET position = :end WHERE task = :task', end=end, task=task)
+
+            _log.info('migration {}: {} of {} rows'.format(task, min(end, last), last))
+
+    def _rebuild_table(self, task: str, table: str, create: str, copy: str) -> None:
+        """renames `table` to `<table>_TMP`, creates the new table and fills it in batches.
+        The caller drops the old table when the whole step is done."""
         with self:
+            if self._run_once(task + ':create'):
+                self.exec('ALTER TABLE {0} RENAME TO {0}_TMP'.format(table))
+                self.exec(create)
+
+        self._run_chunked(task, table + '_TMP', copy)
+
+    def _finish_step(self, version: int) -> int:
+        """forgets the progress of a completed migration step and sets the schema version.
+        Must be called inside the last transaction of the step."""
+        self.exec('DELETE FROM MigrationProgress WHERE task LIKE :prefix', prefix='v{}:%'.format(version))
+        self.exec('PRAGMA user_version = {:d}'.format(version))
+        _log.info('migrated the database to schema v{}'.format(version))
+
+        return version
+
+    def _create_compact_fact_table(self, schema: str, table: str, references: bool) -> None:
+        """creates Departure or Arrival in the layout of schema v10"""
+        place = 'destination_pk' if table == 'Departure' else 'origin_pk'
+
+        def ref(parent: str) -> str:
+            # foreign keys can't point into another database file
+            return ' REFERENCES {}(pk)'.format(parent) if references else ''
+
+        self.exec('''
+            CREATE TABLE {0}.{1}(
+                stop_pk INTEGER NOT NULL{3},
+                time INTEGER NOT NULL,
+                line_code_pk INTEGER NOT NULL{4},
+                trip_code NOT NULL,
+                delay INTEGER,
+                {2} INTEGER NOT NULL{5},
+                train_name_pk INTEGER NOT NULL{6},
+                PRIMARY KEY (stop_pk, time, line_code_pk, trip_code))
+            WITHOUT ROWID
+            '''.format(schema, table, place, ref('WatchedStop'), ref('LineCodeDictionary'),
+                       ref('OriginDestinationDictionary'), ref('TrainNameDictionary')))
+
+    def _compact_fact_table(self, schema: str, table: str, references: bool) -> None:
+        """converts Departure or Arrival from the layout of schema v9 to the one of v10"""
+        self.exec('ALTER TABLE {0}.{1} RENAME TO {1}_TMP'.format(schema, table))
+        self._create_compact_fact_table(schema, table, references)
+        self.exec(_compact_copy_sql(schema, table))
+        self.exec('DROP TABLE {0}.{1}_TMP'.format(schema, table))
+
+    def rebuild_rollups(self) -> None:
+        """marks all rollup groups as dirty and recomputes them, in transactions of at
+        most MIGRATION_BATCH_SIZE groups. Must be called outside of a transaction."""
+        with self, self.partitions('TripObservation') as trips, self.partitions('Departure') as departures:
             self.exec('''
-                CREATE TEMP TABLE Trip_ AS
-                SELECT train_name AS train_name,
-                       origin AS origin,
-                       destination AS destination,
-                       date AS date,
-                       dep_time AS dep_time,
-                       dep_delay AS dep_delay,
-                       arr_time AS arr_time,
-                       arr_delay AS arr_delay
-                FROM Trip''')
-            self.exec('DROP VIEW Trip')
-            self.exec('ALTER TABLE Trip_ RENAME TO Trip')
-            self.exec('CREATE INDEX Trip_Index_1 ON Trip(origin, destination, dep_time)')
+                INSERT OR IGNORE INTO TripRollupDirty (origin_pk, destination_pk, date, train_name_pk, dep, arr)
+                SELECT DISTINCT origin_pk, destination_pk, date(dep_time), train_name_pk,
+                    strftime('%H:%M', dep_time), strftime('%H:%M', arr_time)
+                FROM ''' + trips)
+            self.exec('''
+                INSERT OR IGNORE INTO DepartureRollupDirty (stop_pk, date, train_name_pk, destination_pk, time)
+                SELECT DISTINCT stop_pk, date({0}), train_name_pk, destination_pk, strftime('%H:%M', {0})
+                FROM '''.format(MINUTES_SQL_DATETIME('time')) + departures)
+
+        self.update_rollups()
+
+    def update_rollups(self) -> int:
+        """recomputes all dirty rollup groups, in transactions of at most
+        MIGRATION_BATCH_SIZE groups, so that the collectors are never blocked for long.
+        Must be called outside of a transaction. Returns the number of recomputed groups.
+        """
+        total = 0
+        while True:
+            with self:
+                groups = self.refresh_rollups(limit=MIGRATION_BATCH_SIZE)
+            if not groups:
+                break
+
+            total += groups
+            _log.info('rollups: {} groups recomputed'.format(total))
+
+        return total
+
+    def dirty_rollup_groups(self) -> int:
+        """number of rollup groups whose observations changed since they were computed"""
+        count, = self.exec('''SELECT (SELECT COUNT(*) FROM TripRollupDirty)
+                                   + (SELECT COUNT(*) FROM DepartureRollupDirty)''').fetchone()
+        return count
+
+    def refresh_rollups(self, limit: int = -1) -> int:
+        """recomputes the rollup rows which were marked dirty by changed observations.
+
+        Must be called inside a transaction. Writing observations only marks their rollup
+        groups as dirty (by triggers, so this also covers other programs). The collectors
+        call :meth:`update_rollups` every ROLLUP_INTERVAL seconds, and the aggregated
+        accessors of a writable connection before they read the rollups. The observations
+        are read from the archives as well, if a dirty group has already been rolled over.
+        With a `limit`, only that many dirty trip and departure groups are recomputed.
+        Returns the number of recomputed groups.
+        """
+        first, = self.exec('''SELECT MIN(date) FROM (SELECT date FROM TripRollupDirty
+                                                   UNION ALL SELECT date FROM DepartureRollupDirty)''').fetchone()
+        if first is None:
+            return 0
+
+        since = datetime.strptime(first, '%Y-%m-%d').date()
+        with self.partitions('TripObservation', since) as trips, self.partitions('Departure', since) as departures:
+            return self._refresh_rollups(limit, trips, departures)
+
+    def _refresh_rollups(self, limit: int, trips: str, departures: str) -> int:
+        dirty_trips = '''SELECT origin_pk, destination_pk, date, train_name_pk, dep, arr FROM TripRollupDirty
+                         ORDER BY origin_pk, destination_pk, date, train_name_pk, dep, arr LIMIT :limit'''
+        self.exec('''
+            DELETE FROM TripDailyRollup
+            WHERE (origin_pk, destination_pk, date, train_name_pk, dep, arr) IN ({})
+            '''.format(dirty_trips), limit=limit)
+        self.exec('''
+            INSERT INTO TripDailyRollup (origin_pk, destination_pk, date, train_name_pk, dep, arr,
+                count, dep_delays, arr_delays)
+            SELECT d.origin_pk, d.destination_pk, d.date, d.train_name_pk, d.dep, d.arr,
+                COUNT(*), delay_summary(TripObservation.dep_delay), delay_summary(TripObservation.arr_delay)
+            FROM ({}) AS d
+            JOIN {} ON TripObservation.origin_pk = d.origin_pk
+             AND TripObservation.destination_pk = d.destination_pk
+             AND TripObservation.dep_time >= d.date || ' ' || d.dep
+             AND TripObservation.dep_time < datetime(d.date || ' ' || d.dep, '+1 minute')
+             AND TripObservation.train_name_pk = d.train_name_pk
+             AND strftime('%H:%M', TripObservation.arr_time) = d.arr
+            GROUP BY d.origin_pk, d.destination_pk, d.date, d.train_name_pk, d.dep, d.arr
+            '''.format(dirty_trips, trips), limit=limit)
+        groups = self.exec('''
+            DELETE FROM TripRollupDirty
+            WHERE (origin_pk, destination_pk, date, train_name_pk, dep, arr) IN ({})
+            '''.format(dirty_trips), limit=limit).rowcount
+
+        dirty_departures = '''SELECT stop_pk, date, train_name_pk, destination_pk, time FROM DepartureRollupDirty
+                              ORDER BY stop_pk, date, train_name_pk, destination_pk, time LIMIT :limit'''
+        self.exec('''
+            DELETE FROM DepartureDailyRollup
+            WHERE (stop_pk, date, train_name_pk, destination_pk, time) IN ({})
+            '''.format(dirty_departures), limit=limit)
+        self.exec('''
+            INSERT INTO DepartureDailyRollup (stop_pk, date, train_name_pk, destination_pk, time, count, delays)
+            SELECT d.stop_pk, d.date, d.train_name_pk, d.destination_pk, d.time, COUNT(*), delay_summary({0})
+            FROM ({1}) AS d
+            JOIN {2} ON Departure.stop_pk = d.stop_pk
+             AND Departure.time = CAST(strftime('%s', d.date || ' ' || d.time) AS INTEGER) / 60
+             AND Departure.train_name_pk = d.train_name_pk
+             AND Departure.destination_pk = d.destination_pk
+            GROUP BY d.stop_pk, d.date, d.train_name_pk, d.destination_pk, d.time
+            '''.format(DELAY_SQL_REAL('Departure.delay'), dirty_departures, departures), limit=limit)
+        groups += self.exec('''
+            DELETE FROM DepartureRollupDirty
+            WHERE (stop_pk, date, train_name_pk, destination_pk, time) IN ({})
+            '''.format(dirty_departures), limit=limit).rowcount
+
+        return groups
+
+    def extend_calendar(self) -> None:
+        """makes sure that the Calendar table covers the next year. Done by every read-write
+        connection when it is opened and by :meth:`prune`, so the Calendar keeps up with
+        the collectors and the read-only report connections find it complete."""
+        last, = self.exec('SELECT MAX(date) FROM Calendar').fetchone()
+        year = date.today().year + 1
+        if last < date(year, 12, 31).isoformat():
+            with self:
+                self.fill_calendar(int(last[:4]), year)
+
+    def fill_calendar(self, first_year: int, last_year: int) -> None:
+        """makes sure that the Calendar table contains all days of the given years"""
+        d = date(first_year, 1, 1)
+        rows = []
+        while d.year <= last_year:
+            name = holidays(d.year).get(d)
+            rows.append(dict(date=d.isoformat(), date_type=day_type(d), weekday=d.isoweekday(),
+                             is_holiday=int(name is not None), name=name,
+                             start=_to_minutes(datetime.combine(d, time()))))
+            d += timedelta(days=1)
+
+        self.execmany('''INSERT OR IGNORE INTO Calendar (date, date_type, weekday, is_holiday, holiday_name, start_minute)
+                         VALUES (:date, :date_type, :weekday, :is_holiday, :name, :start)''', rows)
+
+class _LruCache:
+    """bounded mapping which forgets the least recently used entries first"""
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._entries = OrderedDict() # type: OrderedDict[Any, int]
+
+    def get(self, key: Any) -> Optional[int]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Any, value: int) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, key: Any) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+DICTIONARY_CACHE_SIZE = 8192
 
 class DatabaseAccessor:
     """high-level database access"""
 
-    def __init__(self, connection: DatabaseConnection) -> None:
+    def __init__(self, connection: DatabaseConnection, cache_size: int = DICTIONARY_CACHE_SIZE) -> None:
         self.connection = connection
 
-    def materialize_trips(self) -> None:
-        """creates a temporary table out of all the trips. This speeds up trip-related OLAP."""
-        self.connection._materialize_trip_view()
+        # in-process copies of the dictionary tables, so that repeated observations
+        # don't need to look up their strings again
+        self._stop_pks = _LruCache(cache_size)
+        self._line_code_pks = _LruCache(cache_size)
+        self._train_name_pks = _LruCache(cache_size)
+        self._origin_destination_pks = _LruCache(cache_size)
+
+        # cache entries for dictionary rows inserted by the current transaction
+        self._uncommitted = [] # type: List[Tuple[_LruCache, Any]]
+
+        # the caches are cleared when prune() has removed dictionary entries since
+        self._dictionary_generation = self._read_dictionary_generation()
+        self._warm_caches()
+
+        self._warned_stale_rollups = False
+
+    def _read_dictionary_generation(self) -> int:
+        return self.connection.exec('SELECT generation FROM DictionaryGeneration').fetchone()[0]
+
+    def _warm_caches(self) -> None:
+        for cache, table, column in [(self._line_code_pks, 'LineCodeDictionary', 'line_code'),
+                                     (self._train_name_pks, 'TrainNameDictionary', 'train_name'),
+                                     (self._origin_destination_pks, 'OriginDestinationDictionary', 'name')]:
+            # newest entries are the most likely to be seen again
+            rows = self.connection.exec('SELECT {}, pk FROM {} ORDER BY pk DESC LIMIT :n'.format(column, table),
+                                        n=cache.maxsize).fetchall()
+            for key, pk in reversed(rows):
+                cache.put(key, pk)
+
+    def clear_caches(self) -> None:
+        """forgets the cached primary keys. Done automatically after :meth:`DatabaseConnection.prune`"""
+        for cache in [self._stop_pks, self._line_code_pks, self._train_name_pks, self._origin_destination_pks]:
+            cache.clear()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """like `with self.connection`, but also evicts cached keys of rows which were rolled
+        back, and clears the caches if dictionary entries have been removed in the meantime"""
+        try:
+            with self.connection:
+                # nobody can prune while we hold the write lock, so the check is final
+                generation = self._read_dictionary_generation()
+                if generation != self._dictionary_generation:
+                    self.clear_caches()
+                    self._dictionary_generation = generation
+                yield
+        except BaseException:
+            for cache, key in self._uncommitted:
+                cache.discard(key)
+            raise
+        finally:
+            self._uncommitted.clear()
 
     def persist_watched_stop(self, stop: WatchedStop) -> None:
         # NOTE: can't use INSERT OR REPLACE here, because that might change the rowid primary key
         # and then run into a foreign key constraint violation.
-        with self.connection:
+        with self._transaction():
 
             if stop.active:
                 active = 1
@@ -492,110 +1557,132 @@ class DatabaseAccessor:
 
                 self.connection.exec('UPDATE WatchedStop SET efa_stop_id=:sid, name=:name, active=:active WHERE pk=:pk', pk=pk, sid=stop.backend_stop_id, name=stop.name, active=active)
             else:
-                self.connection.exec('''
+                pk = self.connection.exec('''
                     INSERT INTO WatchedStop (id, efa_stop_id, name, active)
                     VALUES (:uuid, :sid, :name, :active)''',
-                    uuid=stop.id, sid=stop.backend_stop_id, name=stop.name, active=active)
+                    uuid=stop.id, sid=stop.backend_stop_id, name=stop.name, active=active).lastrowid
+                self._uncommitted.append((self._stop_pks, stop.id))
+
+            self._stop_pks.put(stop.id, pk)
 
     def _watched_stop_pk(self, stop: WatchedStop) -> int:
-        stop_pk, = self.connection.exec('SELECT pk FROM WatchedStop WHERE id = :uuid', uuid=stop.id).fetchone()
+        stop_pk = self._stop_pks.get(stop.id)
+        if stop_pk is None:
+            stop_pk, = self.connection.exec('SELECT pk FROM WatchedStop WHERE id = :uuid', uuid=stop.id).fetchone()
+            self._stop_pks.put(stop.id, stop_pk)
+
         return stop_pk
 
+    def _persist_dictionary_entry(self, cache: _LruCache, table: str, column: str, value: str) -> int:
+        pk = cache.get(value)
+        if pk is not None:
+            return pk
+
+        c = self.connection.exec('INSERT OR IGNORE INTO {}({}) VALUES (:value)'.format(table, column), value=value)
+        if c.rowcount > 0:
+            pk = c.lastrowid
+            self._uncommitted.append((cache, value))
+        else:
+            pk, = self.connection.exec('SELECT pk FROM {} WHERE {} = :value'.format(table, column),
+                                       value=value).fetchone()
+
+        cache.put(value, pk)
+        return pk
+
     def _persist_line_code(self, line_code: str) -> int:
-        self.connection.exec('''INSERT OR IGNORE
-                INTO LineCodeDictionary(line_code)
-                VALUES (:lc)''', lc=line_code)
-        line_code_pk, = self.connection.exec('''
-            SELECT pk FROM LineCodeDictionary WHERE line_code = :lc''',
-            lc=line_code).fetchone()
-        return line_code_pk
+        return self._persist_dictionary_entry(self._line_code_pks, 'LineCodeDictionary', 'line_code', line_code)
 
     def _persist_train_name(self, train_name: str) -> int:
-        self.connection.exec('''INSERT OR IGNORE
-                INTO TrainNameDictionary(train_name)
-                VALUES (:name)''', name=train_name)
-        train_name_pk, = self.connection.exec('''
-            SELECT pk FROM TrainNameDictionary WHERE train_name = :tn''',
-            tn=train_name).fetchone()
-        return train_name_pk
+        return self._persist_dictionary_entry(self._train_name_pks, 'TrainNameDictionary', 'train_name', train_name)
 
     def _persist_origin_destination(self, name: str) -> int:
-        self.connection.exec('''INSERT OR IGNORE
-                INTO OriginDestinationDictionary(name)
-                VALUES (:name)''', name=name)
-        name_pk, = self.connection.exec('''
-            SELECT pk FROM OriginDestinationDictionary WHERE name = :name''',
-            name=name).fetchone()
-        return name_pk
-
+        return self._persist_dictionary_entry(self._origin_destination_pks, 'OriginDestinationDictionary', 'name', name)
 
     def persist_departure(self, stop: WatchedStop, dep: Departure) -> None:
-        with self.connection:
-            # save scheduled data, unless it is already saved
+        self.persist_departures(stop, [dep])
+
+    def persist_departures(self, stop: WatchedStop, deps: Iterable[Departure]) -> None:
+        """saves a whole departure board in a single transaction"""
+        deps = list(deps)
+        self._persist_departure_board(stop, deps)
+
+    def _persist_departure_board(self, stop: WatchedStop, deps: List[Departure]) -> None:
+        with self._transaction():
             stop_pk = self._watched_stop_pk(stop)
-            line_code_pk = self._persist_line_code(dep.line_code)
-            train_name_pk = self._persist_train_name(dep.train_name)
-            destination_pk = self._persist_origin_destination(dep.destination)
-
-            self.connection.exec('''INSERT OR IGNORE
-                INTO Departure (stop_pk, time, trip_code, line_code_pk, destination_pk, train_name_pk)
-                VALUES (:sid, :time, :tc, :lc, :dest, :name)''',
-                sid=stop_pk, time=dep.time, tc=dep.trip_code, lc=line_code_pk,
-                dest=destination_pk, name=train_name_pk)
-
-            # then overwrite delay if we have one
-            if dep.delay is not None:
-                self.connection.exec('''UPDATE Departure SET delay = :delay
-                    WHERE stop_pk=:sid AND time=:time AND trip_code=:tc AND line_code_pk=:lc''',
-                    delay=dep.delay, sid=stop_pk, time=dep.time, tc=dep.trip_code, lc=line_code_pk)
+
+            # save scheduled data, unless it is already saved, and overwrite the delay if we have one
+            self.connection.execmany('''INSERT
+                INTO Departure (stop_pk, time, line_code_pk, trip_code, destination_pk, train_name_pk, delay)
+                VALUES (:sid, :time, :lc, :tc, :dest, :name, :delay)
+                ON CONFLICT (stop_pk, time, line_code_pk, trip_code) DO UPDATE SET delay = excluded.delay
+                WHERE excluded.delay IS NOT NULL''',
+                [dict(sid=stop_pk, time=_to_minutes(dep.time), tc=_encode_trip_code(dep.trip_code),
+                      lc=self._persist_line_code(dep.line_code),
+                      dest=self._persist_origin_destination(dep.destination),
+                      name=self._persist_train_name(dep.train_name),
+                      delay=_encode_delay(dep.delay))
+                 for dep in deps])
 
     def departures(self, stop: WatchedStop, datetype:str='any', daterange:int=30):
-        for time, train_name, destination, stopid, trip_code, line_code, delay in self.connection.exec('''
+        since = _daterange_start(daterange)
+        with self.connection.partitions('Departure', since.date()) as source:
+            rows = self.connection.exec('''
                 SELECT Departure.time, TrainNameDictionary.train_name, OriginDestinationDictionary.name,
                         WatchedStop.efa_stop_id, Departure.trip_code, LineCodeDictionary.line_code, Departure.delay
-                FROM Departure
+                FROM ''' + source + '''
                 JOIN WatchedStop ON WatchedStop.pk = Departure.stop_pk
                 JOIN LineCodeDictionary ON LineCodeDictionary.pk = Departure.line_code_pk
                 JOIN TrainNameDictionary ON TrainNameDictionary.pk = Departure.train_name_pk
                 JOIN OriginDestinationDictionary ON OriginDestinationDictionary.pk = Departure.destination_pk
-                WHERE WatchedStop.id = :stopid
-                    AND '''+DATE_TYPE_SQL_CHECK('Departure.time', datetype)+'''
-                    AND JULIANDAY(:today) - :dr < JULIANDAY(time)''', stopid=stop.id, dr=daterange, today=datetime.now().strftime('%Y-%m-%d')):
-            yield Departure(time, train_name, destination, stopid, trip_code, line_code, delay)
+                '''+MINUTES_DATE_TYPE_SQL_JOIN('Departure.time', datetype)+'''
+                WHERE Departure.stop_pk = :stop
+                    AND Departure.time > :since''', stop=self._watched_stop_pk(stop), since=_to_minutes(since)).fetchall()
+
+        for time, train_name, destination, stopid, trip_code, line_code, delay in rows:
+            yield Departure(_from_minutes(time), train_name, destination, stopid, str(trip_code), line_code, _decode_delay(delay))
 
     def arrivals(self, stop: WatchedStop, datetype:str='any', daterange:int=30):
-        for time, train_name, origin, stopid, trip_code, line_code, delay in self.connection.exec('''
+        since = _daterange_start(daterange)
+        with self.connection.partitions('Arrival', since.date()) as source:
+            rows = self.connection.exec('''
                 SELECT Arrival.time, TrainNameDictionary.train_name, OriginDestinationDictionary.name,
                         WatchedStop.efa_stop_id, Arrival.trip_code, LineCodeDictionary.line_code, Arrival.delay
-                FROM Arrival
+                FROM ''' + source + '''
                 JOIN WatchedStop ON WatchedStop.pk = Arrival.stop_pk
                 JOIN LineCodeDictionary ON LineCodeDictionary.pk = Arrival.line_code_pk
                 JOIN TrainNameDictionary ON TrainNameDictionary.pk = Arrival.train_name_pk
                 JOIN OriginDestinationDictionary ON OriginDestinationDictionary.pk = Arrival.origin_pk
-                WHERE WatchedStop.id = :stopid
-                    AND '''+DATE_TYPE_SQL_CHECK('Arrival.time', datetype)+'''
-                    AND JULIANDAY(:today) - :dr < JULIANDAY(time)''', stopid=stop.id, dr=daterange, today=datetime.now().strftime('%Y-%m-%d')):
-            yield Arrival(time, train_name, origin, stopid, trip_code, line_code, delay)
+                '''+MINUTES_DATE_TYPE_SQL_JOIN('Arrival.time', datetype)+'''
+                WHERE Arrival.stop_pk = :stop
+                    AND Arrival.time > :since''', stop=self._watched_stop_pk(stop), since=_to_minutes(since)).fetchall()
+
+        for time, train_name, origin, stopid, trip_code, line_code, delay in rows:
+            yield Arrival(_from_minutes(time), train_name, origin, stopid, str(trip_code), line_code, _decode_delay(delay))
 
     def persist_arrival(self, stop: WatchedStop, arr: Arrival) -> None:
-        with self.connection:
-            # save scheduled data, unless it is already saved
+        self.persist_arrivals(stop, [arr])
+
+    def persist_arrivals(self, stop: WatchedStop, arrs: Iterable[Arrival]) -> None:
+        """saves a whole arrival board in a single transaction"""
+        arrs = list(arrs)
+        self._persist_arrival_board(stop, arrs)
+
+    def _persist_arrival_board(self, stop: WatchedStop, arrs: List[Arrival]) -> None:
+        with self._transaction():
             stop_pk = self._watched_stop_pk(stop)
-            line_code_pk = self._persist_line_code(arr.line_code)
-            train_name_pk = self._persist_train_name(arr.train_name)
-            origin_pk = self._persist_origin_destination(arr.origin)
-
-            self.connection.exec('''INSERT OR IGNORE
-                INTO Arrival (stop_pk, time, trip_code, line_code_pk, origin_pk, train_name_pk)
-                VALUES (:sid, :time, :tc, :lc, :orig, :name)''',
-                sid=stop_pk, time=arr.time, tc=arr.trip_code, lc=line_code_pk,
-                orig=origin_pk, name=train_name_pk)
-
-            # then overwrite delay if we have one
-            if arr.delay is not None:
-                self.connection.exec('''UPDATE Arrival SET delay = :delay
-                    WHERE stop_pk=:sid AND time=:time AND trip_code=:tc AND line_code_pk=:lc''',
-                    delay=arr.delay, sid=stop_pk, time=arr.time, tc=arr.trip_code, lc=line_code_pk)
+
+            # save scheduled data, unless it is already saved, and overwrite the delay if we have one
+            self.connection.execmany('''INSERT
+                INTO Arrival (stop_pk, time, line_code_pk, trip_code, origin_pk, train_name_pk, delay)
+                VALUES (:sid, :time, :lc, :tc, :orig, :name, :delay)
+                ON CONFLICT (stop_pk, time, line_code_pk, trip_code) DO UPDATE SET delay = excluded.delay
+                WHERE excluded.delay IS NOT NULL''',
+                [dict(sid=stop_pk, time=_to_minutes(arr.time), tc=_encode_trip_code(arr.trip_code),
+                      lc=self._persist_line_code(arr.line_code),
+                      orig=self._persist_origin_destination(arr.origin),
+                      name=self._persist_train_name(arr.train_name),
+                      delay=_encode_delay(arr.delay))
+                 for arr in arrs])
 
     def all_watched_stops(self) -> Iterator[WatchedStop]:
         for id, efa_stop_id, name, active in self.connection.exec('SELECT id, efa_stop_id, name, active FROM WatchedStop'):
@@ -606,12 +1693,16 @@ class DatabaseAccessor:
             yield WatchedStop(id, efa_stop_id, name, True)
 
     def active_destinations(self, origin: WatchedStop) -> Iterator[WatchedStop]:
-        for id, efa_stop_id, name in self.connection.exec(
-             '''SELECT DISTINCT WatchedStop.id, WatchedStop.efa_stop_id, WatchedStop.name
+        with self.connection.partitions('TripObservation') as source:
+            rows = self.connection.exec(
+             '''SELECT WatchedStop.id, WatchedStop.efa_stop_id, WatchedStop.name
                 FROM WatchedStop
-                JOIN Trip ON Trip.destination = WatchedStop.id
                 WHERE WatchedStop.active = 1
-                AND Trip.origin = :origin''', origin=origin.id):
+                AND WatchedStop.pk IN (SELECT destination_pk FROM ''' + source + '''
+                                       WHERE origin_pk = :origin)''',
+                origin=self._watched_stop_pk(origin)).fetchall()
+
+        for id, efa_stop_id, name in rows:
             yield WatchedStop(id, efa_stop_id, name, True)
 
     def watched_stop_by_id(self, id) -> WatchedStop:
@@ -620,36 +1711,66 @@ class DatabaseAccessor:
         return WatchedStop(id, efa_stop_id, name, bool(active))
 
     def trips(self, origin: WatchedStop, dest: WatchedStop) -> Iterator[Trip]:
-        for train_name, date, dep_time, dep_delay, arr_time, arr_delay in self.connection.exec(
-                '''SELECT train_name, date, dep_time, dep_delay, arr_time, arr_delay FROM trip
-                   WHERE origin = :origin AND destination = :destination
-                   ORDER BY dep_time ASC''', origin=origin.id, destination=dest.id):
+        with self.connection.partitions('TripObservation') as source:
+            rows = self.connection.exec(
+                '''SELECT TrainNameDictionary.train_name, date(dep_time), strftime('%H:%M', dep_time) AS dep,
+                          dep_delay, strftime('%H:%M', arr_time), arr_delay
+                   FROM ''' + source + '''
+                   JOIN TrainNameDictionary ON TrainNameDictionary.pk = TripObservation.train_name_pk
+                   WHERE origin_pk = :origin AND destination_pk = :destination
+                   ORDER BY dep ASC''', origin=self._watched_stop_pk(origin), destination=self._watched_stop_pk(dest)).fetchall()
+
+        for train_name, date, dep_time, dep_delay, arr_time, arr_delay in rows:
             yield Trip(origin, dest, date, dep_time, dep_delay, arr_time, arr_delay, train_name)
 
+    def _current_rollups(self) -> None:
+        """brings the rollups up to date before they are read. A read-only connection
+        can't do that, so it warns about the groups which the collectors haven't
+        refreshed yet, once per accessor."""
+        conn = self.connection
+        dirty = conn.dirty_rollup_groups()
+        if not dirty:
+            return
+
+        if conn.read_only:
+            if not self._warned_stale_rollups:
+                _log.warning('the rollups miss the changes of {} groups since their last refresh'.format(dirty))
+                self._warned_stale_rollups = True
+        elif conn.conn.in_transaction:
+            conn.refresh_rollups()
+        else:
+            conn.update_rollups()
+
     def aggregated_trips(self, origin: WatchedStop, dest: WatchedStop, datetype:str='any', daterange:int=30) -> Iterator[AggregatedTrip]:
-        for train_name, dep_time, dep_delay, dep_delay_perc, dep_delay_stdev, \
-            arr_time, arr_delay, arr_delay_perc, arr_delay_stdev, count in self.connection.exec(
-                '''SELECT train_name, dep_time, median(dep_delay), percentile(90, dep_delay), stdev(dep_delay),
-                          arr_time, median(arr_delay), percentile(90, arr_delay), stdev(arr_delay), COUNT(*)
-                   FROM trip
-                   WHERE origin = :origin AND destination = :destination
-                   AND''' + DATE_TYPE_SQL_CHECK('date', datetype) +'''
-                   AND (JULIANDAY('now') - :dr - 1) < JULIANDAY(date)
-                   GROUP BY train_name, dep_time, arr_time
-                   ORDER BY dep_time ASC''', origin=origin.id, destination=dest.id, dr=daterange):
+        self._current_rollups()
+        for train_name, dep_time, dep_delays, arr_time, arr_delays, count in self.connection.exec(
+                '''SELECT TrainNameDictionary.train_name, dep, delay_summary_merge(dep_delays),
+                          arr, delay_summary_merge(arr_delays), SUM(count)
+                   FROM TripDailyRollup
+                   JOIN TrainNameDictionary ON TrainNameDictionary.pk = TripDailyRollup.train_name_pk
+                   ''' + DATE_TYPE_SQL_JOIN('TripDailyRollup.date', datetype) + '''
+                   WHERE origin_pk = :origin AND destination_pk = :destination
+                   AND TripDailyRollup.date >= :since
+                   GROUP BY train_name_pk, dep, arr
+                   ORDER BY dep ASC''', origin=self._watched_stop_pk(origin), destination=self._watched_stop_pk(dest),
+                   since=_daterange_start(daterange).date().isoformat()):
+            dep = DelaySummary.from_sql(dep_delays).stats([90])
+            arr = DelaySummary.from_sql(arr_delays).stats([90])
             yield AggregatedTrip(train_name,
                                  datetime.strptime(dep_time, '%H:%M').time(),
-                                 dep_delay, dep_delay_perc, dep_delay_stdev,
+                                 dep.median, dep.quantile(90), dep.stdev,
                                  datetime.strptime(arr_time, '%H:%M').time(),
-                                 arr_delay, arr_delay_perc, arr_delay_stdev, count)
+                                 arr.median, arr.quantile(90), arr.stdev, count)
 
     def aggregated_trip_dates(self, origin: WatchedStop, dest: WatchedStop, datetype:str='any', daterange:int=30) -> AggregateDateRange:
+        self._current_rollups()
         count, min, max = self.connection.exec(
-            '''SELECT COUNT(distinct date), MIN(date), MAX(date) FROM Trip
-               WHERE origin = :origin AND destination = :destination AND'''
-                    + DATE_TYPE_SQL_CHECK('date', datetype) +
-            '''AND (JULIANDAY('now') - :dr - 1) < JULIANDAY(date)''',
-                origin=origin.id, destination=dest.id, dr=daterange).fetchone()
+            '''SELECT COUNT(DISTINCT TripDailyRollup.date), MIN(TripDailyRollup.date), MAX(TripDailyRollup.date)
+               FROM TripDailyRollup''' + DATE_TYPE_SQL_JOIN('TripDailyRollup.date', datetype) + '''
+               WHERE origin_pk = :origin AND destination_pk = :destination
+               AND TripDailyRollup.date >= :since''',
+                origin=self._watched_stop_pk(origin), destination=self._watched_stop_pk(dest),
+                since=_daterange_start(daterange).date().isoformat()).fetchone()
 
         if min is not None:
             min = datetime.strptime(min, '%Y-%m-%d').date()
@@ -659,26 +1780,24 @@ class DatabaseAccessor:
         return AggregateDateRange(int(count), min, max)
 
     def aggregated_departures(self, stop: WatchedStop) -> Iterator[AggregatedDeparture]:
-        for train_name, destination, hour, minute, delay, count in self.connection.exec(
-                '''SELECT train_name, OriginDestinationDictionary.name, strftime('%H', time) as hour,
-                        strftime('%M', time) as minute, median(delay), COUNT(*)
-                   FROM Departure
-                   JOIN WatchedStop ON WatchedStop.pk = Departure.stop_pk
-                   JOIN TrainNameDictionary ON TrainNameDictionary.pk = Departure.train_name_pk
-                   JOIN OriginDestinationDictionary ON OriginDestinationDictionary.pk = Departure.destination_pk
-                   WHERE WatchedStop.id = :stop
-                   GROUP BY train_name, OriginDestinationDictionary.name, hour, minute
-                   ORDER BY hour, minute ASC''', stop=stop.id):
-            yield AggregatedDeparture(train_name, destination, time(hour=int(hour), minute=int(minute)), delay, count)
+        self._current_rollups()
+        for train_name, destination, dep_time, delays, count in self.connection.exec(
+                '''SELECT train_name, OriginDestinationDictionary.name, time, delay_summary_merge(delays), SUM(count)
+                   FROM DepartureDailyRollup
+                   JOIN TrainNameDictionary ON TrainNameDictionary.pk = DepartureDailyRollup.train_name_pk
+                   JOIN OriginDestinationDictionary ON OriginDestinationDictionary.pk = DepartureDailyRollup.destination_pk
+                   WHERE DepartureDailyRollup.stop_pk = :stop
+                   GROUP BY train_name_pk, destination_pk, time
+                   ORDER BY time ASC''', stop=self._watched_stop_pk(stop)):
+            yield AggregatedDeparture(train_name, destination, datetime.strptime(dep_time, '%H:%M').time(),
+                                      DelaySummary.from_sql(delays).stats().median, count)
 
     def aggregated_departure_dates(self, stop: WatchedStop) -> AggregateDateRange:
+        self._current_rollups()
         count, min, max = self.connection.exec(
-                '''SELECT COUNT(distinct strftime('%Y-%m-%d', time)),
-                          MIN(strftime('%Y-%m-%d', time)),
-                          MAX(strftime('%Y-%m-%d', time))
-                   FROM Departure
-                   JOIN WatchedStop ON WatchedStop.pk = Departure.stop_pk
-                   WHERE WatchedStop.id = :stop''', stop=stop.id).fetchone()
+                '''SELECT COUNT(DISTINCT date), MIN(date), MAX(date)
+                   FROM DepartureDailyRollup
+                   WHERE DepartureDailyRollup.stop_pk = :stop''', stop=self._watched_stop_pk(stop)).fetchone()
 
         return AggregateDateRange(int(count),
                                   datetime.strptime(min, '%Y-%m-%d').date(),
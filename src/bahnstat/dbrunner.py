@@ -1,37 +1,92 @@
-from bahnstat.database import DatabaseConnection, DatabaseAccessor
+from bahnstat.database import DatabaseConnection, DatabaseAccessor, DEFAULT_BUSY_TIMEOUT, ROLLUP_INTERVAL
 from bahnstat.datatypes import *
+from bahnstat.apicache import ApiResponseCache
+from bahnstat.changefilter import ChangeFilter
 from bahnstat.dbtimetableclient import DbTimetableClient
+from bahnstat.httppool import HttpConnectionPool
+from bahnstat.scheduling import StalestFirstScheduler, TokenBucket
 
 from datetime import datetime, timedelta
-from time import sleep
 from typing import Optional, Callable, List, Union, Iterable
 import logging
+import time
 
 _log = logging.getLogger(__name__)
 
 class _RunnerWorker:
-    def __init__(self, db: DatabaseAccessor, client: DbTimetableClient) -> None:
+    def __init__(self, db: DatabaseAccessor, client: DbTimetableClient,
+                 departure_filter: ChangeFilter, arrival_filter: ChangeFilter) -> None:
         self.db = db
         self.client = client
+        self.departure_filter = departure_filter
+        self.arrival_filter = arrival_filter
 
-    def perform(self) -> None:
+    def perform(self) -> int:
+        """fetches the current board and saves what changed, returns the number of API requests"""
+        requests = self.client.api_requests
         board = self.client.current_board(datetime.now())
 
-        for dep in board.departures:
-            self.db.persist_departure(self.client.station, dep)
+        self.departure_filter.persist(self.db.persist_departures, self.client.station, board.departures)
+        self.arrival_filter.persist(self.db.persist_arrivals, self.client.station, board.arrivals)
 
-        for arr in board.arrivals:
-            self.db.persist_arrival(self.client.station, arr)
+        return self.client.api_requests - requests
+
+# we have 20 requests / min. A full bucket adds its capacity to the refill of
+# any minute, so the refill rate leaves room for it.
+REQUESTS_PER_MINUTE = 20
+REQUEST_BURST = 2
+
+# a station isn't synced more often than this, even if the budget would allow it
+MIN_SYNC_INTERVAL = 6.0
+
+# a sync is usually a single rchg request, and once per hour, every station also
+# needs a new plan slice and a full change feed
+HOURLY_REQUESTS_PER_STATION = 2
+
+# seconds between the freshness reports in the log
+REPORT_INTERVAL = 3600.0
+
+def sustainable_stations(requests_per_minute: float, interval: float) -> int:
+    """how many stations the budget can sync every `interval` seconds in the long run"""
+    per_station = 3600 / interval + HOURLY_REQUESTS_PER_STATION
+    return int(requests_per_minute * 60 / per_station)
+
+def sync_interval(requests_per_minute: float, stations: int) -> float:
+    """shortest time between two syncs of every station which the budget sustains"""
+    spare = requests_per_minute * 60 / stations - HOURLY_REQUESTS_PER_STATION
+    if spare <= 0:
+        return float('inf')
+
+    return max(MIN_SYNC_INTERVAL, 3600 / spare)
+
+def budget_report(requests_per_minute: float, intervals: Iterable[float] = (15, 30, 60, 120, 300)) -> str:
+    return '\n'.join('sync every {:4.0f} s: up to {:3} stations'.format(i, sustainable_stations(requests_per_minute, i))
+                     for i in intervals)
 
 
 class Runner:
     def __init__(self, dbfile: str, stops: Iterable[WatchedStop],
-                 apikey: str, watchdog_func:Callable=None) -> None:
+                 apikey: str, watchdog_func:Callable=None, *,
+                 wal: bool = False, busy_timeout: float = DEFAULT_BUSY_TIMEOUT, cache_file: str = None) -> None:
         self.apikey = apikey
-        self.db = DatabaseAccessor(DatabaseConnection(dbfile))
+        self.db = DatabaseAccessor(DatabaseConnection(dbfile, wal=wal, busy_timeout=busy_timeout))
+
+        # all stations share the keep-alive connections to the API server, and the request budget
+        self.pool = HttpConnectionPool()
+        self.limiter = TokenBucket((REQUESTS_PER_MINUTE - REQUEST_BURST) / 60, REQUEST_BURST)
+
+        # with a cache file, a restart continues with the plans and changes fetched before
+        self.cache = ApiResponseCache(cache_file) if cache_file is not None else None
+
+        # most polls only bring a few new delays, the rest of the board is saved already
+        self.departure_filter = ChangeFilter()
+        self.arrival_filter = ChangeFilter()
 
         self.stops = list(stops)
-        self._workers = [ _RunnerWorker(self.db, DbTimetableClient(s, auth=self.apikey, lookahead=timedelta(hours=2)))
+        self._workers = [ _RunnerWorker(self.db, DbTimetableClient(s, auth=self.apikey, lookahead=timedelta(hours=2),
+                                                                   pool=self.pool, cache=self.cache,
+                                                                   limiter=self.limiter),
+                                        self.departure_filter, self.arrival_filter)
                          for s in self.stops if s.active ]
 
         self._watchdog_func = watchdog_func
@@ -44,21 +99,39 @@ class Runner:
         for s in self.stops:
             self.db.persist_watched_stop(s)
 
-        for w in self._workers:
-            _log.debug('initial sync for stop {} '.format(w.client.station.name))
+        if not self._workers:
+            _log.warning('no active stops')
+            return
 
-            w.perform()
-            self._watchdog()
+        _log.info('{} stops, the budget allows a sync every {:.0f} s each'.format(
+            len(self._workers), sync_interval(REQUESTS_PER_MINUTE, len(self._workers))))
 
-            # we have 20 request / min, intial sync is 5 requests
-            sleep(15)
+        # every request waits for the limiter, so the stalest stop is always synced next
+        scheduler = StalestFirstScheduler(self._workers, MIN_SYNC_INTERVAL)
+        last_report = time.monotonic()
+        last_rollup = time.monotonic()
+        requests = 0
 
         while True:
-            for w in self._workers:
-                _log.debug('sync for stop {} '.format(w.client.station.name))
+            w = scheduler.next()
+            _log.debug('sync for stop {} '.format(w.client.station.name))
 
-                w.perform()
-                self._watchdog()
+            # usually a single rchg request, up to 5 on the first sync of a stop
+            requests += w.perform()
+            scheduler.done(w)
+            self._watchdog()
 
-                # we have 20 request / min, update is at most 2 requests
-                sleep(6)
+            # saving only marks the rollup groups as dirty, recompute them now and then
+            if time.monotonic() - last_rollup >= ROLLUP_INTERVAL:
+                self.db.connection.update_rollups()
+                last_rollup = time.monotonic()
+
+            if time.monotonic() - last_report >= REPORT_INTERVAL:
+                count, mean, longest = scheduler.interval_stats()
+                _log.info('{} syncs with {} requests, every {:.0f} s on average, at most {:.0f} s'.format(
+                    count, requests, mean, longest))
+                for name, f in (('departures', self.departure_filter), ('arrivals', self.arrival_filter)):
+                    saved, skipped = f.stats()
+                    _log.info('{}: saved {}, skipped {} unchanged'.format(name, saved, skipped))
+                last_report = time.monotonic()
+                requests = 0
@@ -1,9 +1,12 @@
-from urllib.request import urlopen, Request
-from xml.dom.minidom import parse as domparse
+from xml.parsers import expat
 from datetime import datetime, date, timedelta
 from bahnstat.datatypes import *
+from bahnstat.apicache import ApiResponseCache
+from bahnstat.httppool import HttpConnectionPool
+from bahnstat.scheduling import TokenBucket
 from typing import Optional, Dict, Sequence, Iterator, Iterable, List, Set, Tuple, Union
 from functools import lru_cache
+import io
 import re
 import itertools
 import logging
@@ -11,11 +14,15 @@ import time
 
 _log = logging.getLogger(__name__)
 
+_FULLTIME = re.compile('[0-9]{10}')
+_STOP_ID = re.compile('(-?[0-9]+)-([0-9]{10})-([0-9]+)')
+
+# the events of one response share a few dozen distinct times
+@lru_cache(maxsize=1024)
 def _parse_fulltime(timestr):
-    m = re.fullmatch('([0-9][0-9])([0-9][0-9])([0-9][0-9])([0-9][0-9])([0-9][0-9])', timestr)
-    assert m is not None
+    assert _FULLTIME.fullmatch(timestr) is not None
 
-    return datetime(2000 + int(m.group(1)), int(m.group(2)), int(m.group(3)), int(m.group(4)), int(m.group(5)))
+    return datetime(2000 + int(timestr[0:2]), int(timestr[2:4]), int(timestr[4:6]), int(timestr[6:8]), int(timestr[8:10]))
 
 class DbTimetableTripLabel:
     def __init__(self, filter_flags, trip_type, category, number):
@@ -26,10 +33,20 @@ class DbTimetableTripLabel:
 
     @staticmethod
     def from_domnode(tl):
-        return DbTimetableTripLabel(tl.getAttribute('f'), tl.getAttribute('t'),
-                                    tl.getAttribute('c'), tl.getAttribute('n'))
+        return DbTimetableTripLabel.from_attributes(dict(tl.attributes.items()))
+
+    @staticmethod
+    def from_attributes(attrs):
+        return DbTimetableTripLabel(attrs.get('f', ''), attrs.get('t', ''), attrs.get('c', ''), attrs.get('n', ''))
+
+    def __eq__(self, other):
+        return isinstance(other, DbTimetableTripLabel) and vars(self) == vars(other)
 
 class DbTimetableEvent:
+    # in the order of the constructor arguments
+    _FIELDS = ('planned_path', 'changed_path', 'planned_time', 'changed_time', 'planned_status', 'changed_status',
+               'planned_platform', 'changed_platform', 'line', 'cancellation_time')
+
     def __init__(self, planned_path, changed_path, planned_time, changed_time,
                  planned_status, changed_status, planned_platform, changed_platform, line, clt):
         self.planned_path = planned_path
@@ -109,101 +126,54 @@ class DbTimetableEvent:
 
     @classmethod
     def from_domnode(clazz, dp):
-        if dp.hasAttribute('pt'):
-            pt = _parse_fulltime(dp.getAttribute('pt'))
-        else:
-            pt = None
+        return clazz.from_attributes(dict(dp.attributes.items()))
 
-        if dp.hasAttribute('ct'):
-            ct = _parse_fulltime(dp.getAttribute('ct'))
-        else:
-            ct = None
+    @classmethod
+    def from_attributes(clazz, attrs):
+        """builds the event from the attributes of an <ar> or <dp> element"""
+        get = attrs.get
 
-        if dp.hasAttribute('ppth'):
-            ppth = dp.getAttribute('ppth').split('|')
-        else:
-            ppth = None
+        pt = get('pt')
+        if pt is not None:
+            pt = _parse_fulltime(pt)
 
-        if dp.hasAttribute('cpth'):
-            cpth = dp.getAttribute('cpth').split('|')
-        else:
-            cpth = None
+        ct = get('ct')
+        if ct is not None:
+            ct = _parse_fulltime(ct)
 
-        if dp.hasAttribute('ps'):
-            ps = dp.getAttribute('ps')
-        else:
-            ps = None
+        ppth = get('ppth')
+        if ppth is not None:
+            ppth = ppth.split('|')
 
-        if dp.hasAttribute('cs'):
-            cs = dp.getAttribute('cs')
-        else:
-            cs = None
+        cpth = get('cpth')
+        if cpth is not None:
+            cpth = cpth.split('|')
 
-        if dp.hasAttribute('pp'):
-            pp = dp.getAttribute('pp')
-        else:
-            pp = None
+        clt = get('clt')
+        if clt is not None:
+            clt = _parse_fulltime(clt)
 
-        if dp.hasAttribute('cp'):
-            cp = dp.getAttribute('cp')
-        else:
-            cp = None
+        return clazz(ppth, cpth, pt, ct, get('ps'), get('cs'), get('pp'), get('cp'), get('l'), clt)
 
-        if dp.hasAttribute('l'):
-            l = dp.getAttribute('l')
-        else:
-            l = None
+    def copy(self):
+        return type(self)(*(getattr(self, f) for f in self._FIELDS))
 
-        if dp.hasAttribute('clt'):
-            clt = _parse_fulltime(dp.getAttribute('clt'))
-        else:
-            clt = None
+    def merge(self, change) -> bool:
+        """takes over the fields which are set in `change`, returns whether any of them differed"""
+        changed = False
+        for f in self._FIELDS:
+            v = getattr(change, f)
+            if v is not None and v != getattr(self, f):
+                setattr(self, f, v)
+                changed = True
 
-        return clazz(ppth, cpth, pt, ct, ps, cs, pp, cp, l, clt)
+        return changed
 
     @classmethod
     def merged(clazz, base, change):
-        pt = base.planned_time
-        if change.planned_time is not None:
-            pt = change.planned_time
-
-        ct = base.changed_time
-        if change.changed_time is not None:
-            ct = change.changed_time
-
-        ppth = base.planned_path
-        if change.planned_path is not None:
-            ppth = change.planned_path
-
-        cpth = base.changed_path
-        if change.changed_path is not None:
-            cpth = change.changed_path
-
-        ps = base.planned_status
-        if change.planned_status is not None:
-            ps = change.planned_status
-
-        cs = base.changed_status
-        if change.changed_status is not None:
-            cs = change.changed_status
-
-        pp = base.planned_platform
-        if change.planned_platform is not None:
-            pp = change.planned_platform
-
-        cp = base.changed_platform
-        if change.changed_platform is not None:
-            cp = change.changed_platform
-
-        l = base.line
-        if change.line is not None:
-            l = change.line
-
-        clt = base.cancellation_time
-        if change.cancellation_time is not None:
-            clt = change.cancellation_time
-
-        return clazz(ppth, cpth, pt, ct, ps, cs, pp, cp, l, clt)
+        m = clazz.copy(base)
+        m.merge(change)
+        return m
 
 class DbTimetableDeparture(DbTimetableEvent):
     def __init__(self, *args, **kwargs):
@@ -238,19 +208,18 @@ class DbTimetableStop:
 
     @staticmethod
     def from_domnode(s):
-        idstr = s.getAttribute('id')
-        m = re.fullmatch('(-?[0-9]+)-([0-9][0-9])([0-9][0-9])([0-9][0-9])([0-9][0-9])([0-9][0-9])-([0-9]+)', idstr)
-        assert m is not None
-
-        tripid = int(m.group(1))
-        startdate = datetime(2000 + int(m.group(2)), int(m.group(3)), int(m.group(4)), int(m.group(5)), int(m.group(6)))
-        stopno = int(m.group(7))
-
         departures = next((DbTimetableDeparture.from_domnode(dp) for dp in s.getElementsByTagName('dp')), None)
         arrivals = next((DbTimetableArrival.from_domnode(ar) for ar in s.getElementsByTagName('ar')), None)
         label = next((DbTimetableTripLabel.from_domnode(tl) for tl in s.getElementsByTagName('tl')), None)
 
-        return DbTimetableStop(tripid, startdate, stopno, arrivals, departures, label)
+        return DbTimetableStop.from_parts(s.getAttribute('id'), arrivals, departures, label)
+
+    @staticmethod
+    def from_parts(idstr, arrival, departure, label):
+        m = _STOP_ID.fullmatch(idstr)
+        assert m is not None
+
+        return DbTimetableStop(int(m.group(1)), _parse_fulltime(m.group(2)), int(m.group(3)), arrival, departure, label)
 
     @property
     def id(self):
@@ -279,67 +248,151 @@ class DbTimetableStop:
 
         return end
 
+    def copy(self):
+        """a copy which can be merged with changes, without touching this stop and its events"""
+        return DbTimetableStop(self.id_trip, self.id_start, self.id_stop,
+                               self.arrival.copy() if self.arrival is not None else None,
+                               self.departure.copy() if self.departure is not None else None,
+                               self.label)
+
+    def merge(self, change) -> bool:
+        """applies the `change` of this stop in place, returns whether anything changed.
+
+        Events which this stop doesn't have yet are copied from the change."""
+        assert (self.id_trip, self.id_start, self.id_stop) == (change.id_trip, change.id_start, change.id_stop)
+        changed = False
+
+        # FIXME! actually merge trip label
+        if change.label is not None and change.label != self.label:
+            self.label = change.label
+            changed = True
+
+        if change.arrival is not None:
+            if self.arrival is None:
+                self.arrival = change.arrival.copy()
+                changed = True
+            elif self.arrival.merge(change.arrival):
+                changed = True
+
+        if change.departure is not None:
+            if self.departure is None:
+                self.departure = change.departure.copy()
+                changed = True
+            elif self.departure.merge(change.departure):
+                changed = True
+
+        return changed
+
     @staticmethod
     def merged(base, change):
-        assert base.id == change.id
+        m = base.copy()
+        m.merge(change)
+        return m
 
-        # FIXME! actually merge trip label
-        l = base.label
-        if change.label is not None:
-            l = change.label
-
-        if base.arrival is not None and change.arrival is None:
-            arr = base.arrival
-        elif base.arrival is None and change.arrival is not None:
-            arr = change.arrival
-        elif base.arrival is not None and change.arrival is not None:
-            arr = DbTimetableArrival.merged(base.arrival, change.arrival)
-        else:
-            arr = None
-
-        if base.departure is not None and change.departure is None:
-            dep = base.departure
-        elif base.departure is None and change.departure is not None:
-            dep = change.departure
-        elif base.departure is not None and change.departure is not None:
-            dep = DbTimetableDeparture.merged(base.departure, change.departure)
-        else:
-            dep = None
+class _StopParser:
+    """builds the DbTimetableStop objects of a plan, fchg or rchg response straight from
+    the expat events, without a DOM tree.
 
-        return DbTimetableStop(base.id_trip, base.id_start, base.id_stop, arr, dep, l)
+    The result is the same as DbTimetableStop.from_domnode() for every <s> element:
+    each stop takes the first <ar>, <dp> and <tl> element inside of it.
+    """
+    _PARTS = {
+        'ar': (1, DbTimetableArrival.from_attributes),
+        'dp': (2, DbTimetableDeparture.from_attributes),
+        'tl': (3, DbTimetableTripLabel.from_attributes),
+    }
+
+    def __init__(self) -> None:
+        # [id, arrival, departure, label] of all stops in document order, and of the open ones
+        self._stops = [] # type: List[list]
+        self._open = [] # type: List[list]
+
+    def _start(self, name, attrs):
+        if name == 's':
+            stop = [attrs.get('id', ''), None, None, None]
+            self._stops.append(stop)
+            self._open.append(stop)
+        elif self._open and name in self._PARTS:
+            slot, make = self._PARTS[name]
+            for stop in self._open:
+                if stop[slot] is None:
+                    stop[slot] = make(attrs)
+
+    def _end(self, name):
+        if name == 's':
+            self._open.pop()
+
+    def parse(self, f) -> List[DbTimetableStop]:
+        p = expat.ParserCreate()
+        p.StartElementHandler = self._start
+        p.EndElementHandler = self._end
+        p.ParseFile(f)
+
+        return [DbTimetableStop.from_parts(*stop) for stop in self._stops]
+
+def _parse_stops(f) -> List[DbTimetableStop]:
+    """parses the <s> elements of an API response read from the file object `f`"""
+    return _StopParser().parse(f)
 
 class _ApiClient:
-    def __init__(self, eva_id: int, apiurl: str, apikey: str = None) -> None:
+    def __init__(self, eva_id: int, apiurl: str, apikey: str = None, pool: HttpConnectionPool = None,
+                 cache: ApiResponseCache = None, limiter: TokenBucket = None) -> None:
         self.eva_id = eva_id
         self.apiurl = apiurl
         self.headers = {'User-Agent': 'db-timetable-api-client/0.01 (dbclient@genosse-einhorn.de)'}
+        self.pool = pool if pool is not None else HttpConnectionPool()
+        self.cache = cache
+        self.limiter = limiter
+
+        # number of requests sent to the API, for staying within the rate limit
+        self.requests = 0
 
         self.plan = lru_cache(maxsize=12)(self._plan) # type: ignore
 
         if apikey is not None:
             self.headers['Authorization'] = 'Bearer ' + apikey
 
+    def _get(self, url: str) -> bytes:
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+        self.requests += 1
+        return self.pool.get(url, self.headers).body
+
+    def cached_plan(self, timeslice: datetime) -> Optional[Sequence[DbTimetableStop]]:
+        """the plan slice from the persistent cache, without asking the API"""
+        body = self.cache.plan(self.eva_id, timeslice) if self.cache is not None else None
+        return _parse_stops(io.BytesIO(body)) if body is not None else None
+
     def _plan(self, timeslice: datetime) -> Sequence[DbTimetableStop]:
-        _log.debug('{}/plan/{}/{:02}{:02}{:02}/{:02}'.format(self.apiurl,
+        stops = self.cached_plan(timeslice)
+        if stops is not None:
+            return stops
+
+        body = self._get('{}/plan/{}/{:02}{:02}{:02}/{:02}'.format(self.apiurl,
                 self.eva_id, timeslice.year % 100, timeslice.month, timeslice.day, timeslice.hour))
-        with urlopen(Request('{}/plan/{}/{:02}{:02}{:02}/{:02}'.format(self.apiurl,
-                self.eva_id, timeslice.year % 100, timeslice.month, timeslice.day, timeslice.hour),
-                headers=self.headers)) as u:
-            d = domparse(u)
-            return [DbTimetableStop.from_domnode(s) for s in d.getElementsByTagName('s')]
+        if self.cache is not None:
+            self.cache.put_plan(self.eva_id, timeslice, body)
+
+        return _parse_stops(io.BytesIO(body))
+
+    def changes(self, kind: str) -> Tuple[bytes, Sequence[DbTimetableStop]]:
+        """the raw `fchg` or `rchg` response, and its stops"""
+        body = self._get('{}/{}/{}'.format(self.apiurl, kind, self.eva_id))
+        return body, _parse_stops(io.BytesIO(body))
 
     def fchg(self) -> Sequence[DbTimetableStop]:
         # TODO: time-based cache
-        _log.debug('{}/fchg/{}'.format(self.apiurl, self.eva_id))
-        with urlopen(Request('{}/fchg/{}'.format(self.apiurl, self.eva_id), headers=self.headers)) as u:
-            d = domparse(u)
-            return [DbTimetableStop.from_domnode(s) for s in d.getElementsByTagName('s')]
+        return self.changes('fchg')[1]
 
     def rchg(self) -> Sequence[DbTimetableStop]:
-        _log.debug('{}/rchg/{}'.format(self.apiurl, self.eva_id))
-        with urlopen(Request('{}/rchg/{}'.format(self.apiurl, self.eva_id), headers=self.headers)) as u:
-            d = domparse(u)
-            return [DbTimetableStop.from_domnode(s) for s in d.getElementsByTagName('s')]
+        return self.changes('rchg')[1]
+
+DB_API_URL = 'https://api.deutschebahn.com/timetables/v1'
+
+# rchg only contains the changes of the last two minutes, so it can only continue
+# a state which is younger than that
+RECENT_CHANGES_VALIDITY = 90
 
 class _TimetableChangeIntegrator:
     def __init__(self, client: _ApiClient) -> None:
@@ -348,40 +401,107 @@ class _TimetableChangeIntegrator:
         self._timeslices = set() # type: Set[datetime]
         self._stop_cache = dict() # type: Dict[str, DbTimetableStop]
 
+        # ids of the stops which changed in the last poll
+        self.changed = set() # type: Set[str]
+
+        if client.cache is not None:
+            self._restore()
+
+    def _restore(self) -> None:
+        """continues with the state saved in the persistent cache, if it is recent enough"""
+        saved = self._api.cache.changes(self._api.eva_id)
+        if saved is None:
+            return
+
+        timeslices, journal = saved
+        age = time.time() - journal[-1][0]
+        if not 0 <= age < RECENT_CHANGES_VALIDITY:
+            return
+
+        stops = dict() # type: Dict[str, DbTimetableStop]
+        for t in timeslices:
+            plan = self._api.cached_plan(t)
+            if plan is None:
+                return
+            self._integrate_changes(stops, plan)
+
+        for fetched, body in journal:
+            self._integrate_changes(stops, _parse_stops(io.BytesIO(body)))
+
+        _log.debug('station {}: continuing with the changes of {:.0f} s ago'.format(self._api.eva_id, age))
+        self._stop_cache = stops
+        self._timeslices = timeslices
+        self._last_change_time = time.monotonic() - age
+
     @staticmethod
-    def _integrate_changes(stops: Dict[str, DbTimetableStop], chg: Iterable[DbTimetableStop]) -> Dict[str, DbTimetableStop]:
-        stops = dict(stops)
+    def _integrate_changes(stops: Dict[str, DbTimetableStop], chg: Iterable[DbTimetableStop]) -> Set[str]:
+        """merges the changes into `stops` in place, and returns the ids of the stops which changed.
+
+        New stops are copies, since the plans are cached and must stay as they are."""
+        changed = set() # type: Set[str]
 
         for c in chg:
-            if c.id in stops:
-                stops[c.id] = DbTimetableStop.merged(stops[c.id], c)
+            id = c.id
+            s = stops.get(id)
+            if s is not None:
+                if s.merge(c):
+                    changed.add(id)
             elif c.complete:
-                stops[c.id] = c
+                stops[id] = c.copy()
+                changed.add(id)
+
+        return changed
+
+    def _evict(self, before: datetime) -> int:
+        """drops the stops which are hidden since before the given time"""
+        expired = [id for id, s in self._stop_cache.items() if s.hide_after_timestamp < before]
+        for id in expired:
+            del self._stop_cache[id]
 
-        return stops
+        return len(expired)
 
-    def stops_with_changes(self, timeslices: Set[datetime]) -> Sequence[DbTimetableStop]:
+    def stops_with_changes(self, timeslices: Set[datetime], expired_before: datetime = None) -> Sequence[DbTimetableStop]:
+        """the stops of the given plan slices with all changes. With `expired_before`,
+        stops which are hidden since before that time are dropped."""
         now = time.monotonic()
-        if self._timeslices == timeslices and self._last_change_time is not None and now - self._last_change_time < 90:
-            self._stop_cache = self._integrate_changes(self._stop_cache, self._api.rchg())
+        if self._timeslices == timeslices and self._last_change_time is not None and now - self._last_change_time < RECENT_CHANGES_VALIDITY:
+            body, changes = self._api.changes('rchg')
+            self.changed = self._integrate_changes(self._stop_cache, changes)
             self._last_change_time = now
+
+            if self._api.cache is not None:
+                self._api.cache.add_changes(self._api.eva_id, body)
         else:
             stops = dict() # type: Dict[str, DbTimetableStop]
 
             for t in timeslices:
-                stops = self._integrate_changes(stops, self._api.plan(t))
+                self._integrate_changes(stops, self._api.plan(t))
 
-            self._stop_cache = self._integrate_changes(stops, self._api.fchg())
+            body, changes = self._api.changes('fchg')
+            self._integrate_changes(stops, changes)
+            self._stop_cache = stops
+            self.changed = set(stops)
             self._last_change_time = now
             self._timeslices = set(timeslices)
 
-        return [v for c,v in self._stop_cache.items()]
+            if self._api.cache is not None:
+                self._api.cache.start_changes(self._api.eva_id, self._timeslices, body)
+
+        if expired_before is not None:
+            evicted = self._evict(expired_before)
+            if evicted:
+                self.changed.intersection_update(self._stop_cache)
+                _log.debug('station {}: dropped {} expired stops'.format(self._api.eva_id, evicted))
+
+        return list(self._stop_cache.values())
 
 class DbTimetableBoard:
     """Timetable query result"""
     def __init__(self, raw: Iterable[DbTimetableStop], time_range: Tuple[datetime, datetime],
-                 departures: Iterable[Departure], arrivals: Iterable[Arrival]) -> None:
+                 departures: Iterable[Departure], arrivals: Iterable[Arrival], changed: Iterable[str] = ()) -> None:
         self.raw = list(raw)
+        # ids of the raw stops which changed since the previous board
+        self.changed = set(changed)
         self.time_range = time_range
         self.arrivals = sorted(arrivals, key=lambda a: a.time)
         self.departures = sorted(departures, key=lambda d: d.time)
@@ -390,15 +510,32 @@ class DbTimetableBoard:
 class DbTimetableClient:
     """Client for the DB timetable API
 
+    Clients of several stations should share one `pool`, so that they reuse the
+    same keep-alive connections to the API server.
+
+    Every request takes a token from the `limiter`, which should also be shared,
+    since the request budget belongs to the API key.
+
+    With a `cache`, plan slices and the change state are also kept on disk, so that
+    a restarted client only needs the recent changes, if it was stopped shortly before.
+
     TODO: document how plan range and changes work
     """
     def __init__(self, station: WatchedStop, *,
                  lookbehind: timedelta = timedelta(hours=1), lookahead: timedelta = timedelta(hours=1),
-                 apiurl:str='https://api.deutschebahn.com/timetables/v1', auth:str=None) -> None:
+                 apiurl:str=DB_API_URL, auth:str=None,
+                 pool: HttpConnectionPool = None, cache: ApiResponseCache = None,
+                 limiter: TokenBucket = None) -> None:
         self.station = station
         self.lookahead = lookahead
         self.lookbehind = lookbehind
-        self._timetable_retriever = _TimetableChangeIntegrator(_ApiClient(station.backend_stop_id, apiurl, auth))
+        self._api = _ApiClient(station.backend_stop_id, apiurl, auth, pool, cache, limiter)
+        self._timetable_retriever = _TimetableChangeIntegrator(self._api)
+
+    @property
+    def api_requests(self) -> int:
+        """number of requests sent to the API so far"""
+        return self._api.requests
 
     @staticmethod
     def _timeslices(range_min: datetime, range_max: datetime) -> Set[datetime]:
@@ -418,13 +555,14 @@ class DbTimetableClient:
         timerange_max = current_time + self.lookahead
         t = self._timeslices(timerange_min, timerange_max)
 
-        # retrieve raw data
-        s = self._timetable_retriever.stops_with_changes(t)
+        # retrieve raw data. Stops hidden since before the time range won't show up again.
+        s = self._timetable_retriever.stops_with_changes(t, timerange_min)
 
         # build response
         return DbTimetableBoard(s, (timerange_min, timerange_max),
                                 self._departures(s, current_time),
-                                self._arrivals(s, current_time))
+                                self._arrivals(s, current_time),
+                                self._timetable_retriever.changed)
 
     def _departures(self, stops: Iterable[DbTimetableStop], current_time: datetime) -> Iterator[Departure]:
         for s in stops:
@@ -0,0 +1,234 @@
+import json
+import math
+import struct
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+__all__ = [ 'DelayStats', 'DelaySummary' ]
+
+def _quantile_ranks(n: int, q: float) -> List[int]:
+    """0-based ranks of the sorted values that the q-th percentile of n values is taken from.
+
+    If the rank falls between two values, their mean is taken. For q=50, this is the
+    ordinary median.
+    """
+    if n < 1:
+        return []
+
+    k = n * q / 100
+    c = math.ceil(k)
+
+    if k == c and 0 < c < n:
+        return [c - 1, c]
+    else:
+        return [min(max(c, 1), n) - 1]
+
+def _quantile_at(n: int, at: Callable[[int], float], q: float) -> Optional[float]:
+    """q-th percentile of n sorted values, where at(i) returns the i-th value"""
+    ranks = _quantile_ranks(n, q)
+    if not ranks:
+        return None
+    elif len(ranks) == 2:
+        return (at(ranks[0]) + at(ranks[1])) / 2
+    else:
+        return at(ranks[0])
+
+def _select(values: List[float], ranks: Iterable[int]) -> Dict[int, float]:
+    """the values at the given 0-based ranks of the sorted `values`, without sorting them.
+
+    A quickselect for several ranks at once: each pass splits the values three ways around
+    a pivot and only descends into the parts that still contain a wanted rank. Delays are
+    whole minutes, so the part equal to the pivot is large and settles many ranks at once.
+    """
+    result = {} # type: Dict[int, float]
+    wanted = sorted(set(ranks))
+    pending = [(values, 0, wanted)] if wanted else []
+
+    while pending:
+        vs, offset, rs = pending.pop()
+        pivot = vs[len(vs) // 2]
+        lower = [v for v in vs if v < pivot]
+        upper = [v for v in vs if v > pivot]
+        equal_end = offset + len(vs) - len(upper)
+
+        lower_ranks = [] # type: List[int]
+        upper_ranks = [] # type: List[int]
+        for r in rs:
+            if r < offset + len(lower):
+                lower_ranks.append(r)
+            elif r < equal_end:
+                result[r] = pivot
+            else:
+                upper_ranks.append(r)
+
+        if lower_ranks:
+            pending.append((lower, offset, lower_ranks))
+        if upper_ranks:
+            pending.append((upper, equal_end, upper_ranks))
+
+    return result
+
+class DelayStats:
+    """Statistics over a group of delays: count, cancellations, median, quantiles and stdev.
+
+    Cancelled trains are counted as infinite delay. They take part in the median and the
+    quantiles, but not in the standard deviation.
+    """
+    def __init__(self, count: int, nonfinite: int, quantiles: Dict[float, Optional[float]],
+                 stdev: Optional[float]) -> None:
+        self.count = count
+        self.nonfinite = nonfinite
+        self.quantiles = quantiles
+        self.stdev = stdev
+
+    @property
+    def median(self) -> Optional[float]:
+        return self.quantiles[50]
+
+    def quantile(self, q: float) -> Optional[float]:
+        return self.quantiles[q]
+
+    @classmethod
+    def from_values(clazz, values: Iterable[float], quantiles: Sequence[float] = ()) -> 'DelayStats':
+        finite = [] # type: List[float]
+        nonfinite = 0
+        for v in values:
+            if math.isfinite(v):
+                finite.append(v)
+            else:
+                nonfinite += 1
+
+        return clazz.from_finite(finite, nonfinite, quantiles)
+
+    @classmethod
+    def from_finite(clazz, finite: List[float], nonfinite: int, quantiles: Sequence[float] = ()) -> 'DelayStats':
+        n = len(finite) + nonfinite
+        wanted = [50] + list(quantiles)
+
+        # cancellations sort last, so only the ranks below len(finite) need a selection
+        selected = _select(finite, [r for q in wanted for r in _quantile_ranks(n, q) if r < len(finite)])
+
+        def at(i: int) -> float:
+            if i < len(finite):
+                return selected[i]
+            else:
+                return math.inf
+
+        qs = { q: _quantile_at(n, at, q) for q in wanted } # type: Dict[float, Optional[float]]
+
+        stdev = None # type: Optional[float]
+        if len(finite) >= 2:
+            mean = math.fsum(finite) / len(finite)
+            stdev = math.sqrt(math.fsum((v - mean)**2 for v in finite) / (len(finite) - 1))
+
+        return clazz(n, nonfinite, qs, stdev)
+
+    def to_sql(self) -> str:
+        """serializes the statistics, so that a single SQL aggregate can return them"""
+        return json.dumps([self.count, self.nonfinite, list(self.quantiles.items()), self.stdev])
+
+    @classmethod
+    def from_sql(clazz, s: Optional[str]) -> Optional['DelayStats']:
+        if s is None:
+            return None
+
+        count, nonfinite, quantiles, stdev = json.loads(s)
+        return clazz(count, nonfinite, {q: v for q, v in quantiles}, stdev)
+
+# delays up to this many minutes get a bin for every whole minute
+EXACT_BIN_LIMIT = 120
+
+# beyond that, each bin is this factor wider than the previous one
+BIN_GROWTH = 1.02
+
+_MAX_BIN = 0x7fff
+
+def _bin(value: float) -> int:
+    r = math.floor(value + 0.5)
+    if abs(r) <= EXACT_BIN_LIMIT:
+        return r
+
+    k = int(math.log(abs(value) / (EXACT_BIN_LIMIT + 0.5), BIN_GROWTH))
+    return int(math.copysign(min(EXACT_BIN_LIMIT + 1 + k, _MAX_BIN), value))
+
+def _bin_value(b: int) -> float:
+    """representative value of a bin: the whole minute, or the geometric middle of the bin"""
+    if abs(b) <= EXACT_BIN_LIMIT:
+        return float(b)
+
+    k = abs(b) - EXACT_BIN_LIMIT - 1
+    return math.copysign((EXACT_BIN_LIMIT + 0.5) * BIN_GROWTH**(k + 0.5), b)
+
+class DelaySummary:
+    """Mergeable quantile sketch of a group of delays, e.g. of one train on one day.
+
+    This is a histogram with fixed bins, so sketches of any number of days can be
+    merged without losing more accuracy. Delays between -120 and 120 minutes get a bin
+    per whole minute, larger ones get geometrically growing bins. The median, quantiles
+    and standard deviation are therefore
+
+    - exact, if all delays are whole minutes within ±120 minutes (the usual case),
+    - off by at most 0.5 minutes for fractional delays within that range,
+    - off by less than 1% of the delay beyond it.
+
+    Cancellations (infinite delays) are counted separately and are exact.
+    """
+    _HEADER = struct.Struct('<I')
+    _ENTRY = struct.Struct('<hI')
+
+    def __init__(self, counts: Dict[int, int] = None, nonfinite: int = 0) -> None:
+        self.counts = counts if counts is not None else {} # type: Dict[int, int]
+        self.nonfinite = nonfinite
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts.values()) + self.nonfinite
+
+    def add(self, value: Optional[float]) -> None:
+        if value is None:
+            return
+        elif math.isfinite(value):
+            b = _bin(value)
+            self.counts[b] = self.counts.get(b, 0) + 1
+        else:
+            self.nonfinite += 1
+
+    def merge(self, other: 'DelaySummary') -> None:
+        for b, c in other.counts.items():
+            self.counts[b] = self.counts.get(b, 0) + c
+        self.nonfinite += other.nonfinite
+
+    def stats(self, quantiles: Sequence[float] = ()) -> DelayStats:
+        bins = sorted(self.counts)
+        cumulative = list(accumulate(self.counts[b] for b in bins))
+        finite = cumulative[-1] if cumulative else 0
+
+        def at(i: int) -> float:
+            if i < finite:
+                return _bin_value(bins[bisect_right(cumulative, i)])
+            else:
+                return math.inf
+
+        qs = { 50: _quantile_at(finite + self.nonfinite, at, 50) } # type: Dict[float, Optional[float]]
+        for q in quantiles:
+            qs[q] = _quantile_at(finite + self.nonfinite, at, q)
+
+        stdev = None # type: Optional[float]
+        if finite >= 2:
+            mean = math.fsum(_bin_value(b) * c for b, c in self.counts.items()) / finite
+            stdev = math.sqrt(math.fsum(c * (_bin_value(b) - mean)**2 for b, c in self.counts.items()) / (finite - 1))
+
+        return DelayStats(finite + self.nonfinite, self.nonfinite, qs, stdev)
+
+    def to_sql(self) -> bytes:
+        """serializes the sketch into a BLOB of 4 + 6 bytes per occupied bin"""
+        return self._HEADER.pack(self.nonfinite) + b''.join(self._ENTRY.pack(b, c) for b, c in sorted(self.counts.items()))
+
+    @classmethod
+    def from_sql(clazz, blob: Optional[bytes]) -> 'DelaySummary':
+        if blob is None:
+            return clazz()
+
+        nonfinite, = clazz._HEADER.unpack_from(blob)
+        return clazz(dict(clazz._ENTRY.iter_unpack(blob[clazz._HEADER.size:])), nonfinite)
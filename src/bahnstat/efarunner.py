@@ -1,5 +1,6 @@
 from bahnstat.mechanize_mini import Browser
-from bahnstat.database import DatabaseConnection, DatabaseAccessor
+from bahnstat.changefilter import ChangeFilter
+from bahnstat.database import DatabaseConnection, DatabaseAccessor, DEFAULT_BUSY_TIMEOUT, ROLLUP_INTERVAL
 from bahnstat.datatypes import *
 from bahnstat.efaxmlclient import *
 
@@ -12,50 +13,58 @@ import random
 
 _log = logging.getLogger(__name__)
 
+# seconds between the reports in the log
+REPORT_INTERVAL = 3600.0
+
 class DepartureWatcher:
-    def __init__(self, stop: WatchedStop, client: EfaXmlClient, db: DatabaseAccessor) -> None:
+    def __init__(self, stop: WatchedStop, client: EfaXmlClient, db: DatabaseAccessor, changes: ChangeFilter) -> None:
         self.stop = stop
         self.next_check = datetime.utcnow().timestamp() + random.randrange(0, 60*2)
         self.client = client
         self.db = db
+        self.changes = changes
 
     def perform(self) -> None:
         dm = self.client.departure_monitor(self.stop)
         _log.debug('retrieved departure monitor for {} at {}'.format(dm.stop_name, dm.now))
 
-        for dep in dm.departures:
-            self.db.persist_departure(self.stop, dep)
+        self.changes.persist(self.db.persist_departures, self.stop, dm.departures)
 
     def reschedule(self) -> None:
         self.next_check = self.next_check + 60*2 + random.randrange(0, 15)
 
 class ArrivalWatcher:
-    def __init__(self, stop: WatchedStop, client: EfaXmlClient, db: DatabaseAccessor) -> None:
+    def __init__(self, stop: WatchedStop, client: EfaXmlClient, db: DatabaseAccessor, changes: ChangeFilter) -> None:
         self.stop = stop
         self.next_check = datetime.utcnow().timestamp() + random.randrange(0, 60*2)
         self.client = client
         self.db = db
+        self.changes = changes
 
     def perform(self) -> None:
         dm = self.client.arrival_monitor(self.stop)
         _log.debug('retrieved arrival monitor for {} at {}'.format(dm.stop_name, dm.now))
 
-        for dep in dm.arrivals:
-            self.db.persist_arrival(self.stop, dep)
+        self.changes.persist(self.db.persist_arrivals, self.stop, dm.arrivals)
 
     def reschedule(self) -> None:
         self.next_check = self.next_check + 60*2 + random.randrange(0, 15)
 
 class Runner:
     def __init__(self, dbfile: str, stops: Iterable[WatchedStop],
-                 user_agent: str, watchdog_func:Callable=None) -> None:
+                 user_agent: str, watchdog_func:Callable=None, *,
+                 wal: bool = False, busy_timeout: float = DEFAULT_BUSY_TIMEOUT) -> None:
         self.client = EfaXmlClient(user_agent)
-        self.db = DatabaseAccessor(DatabaseConnection(dbfile))
+        self.db = DatabaseAccessor(DatabaseConnection(dbfile, wal=wal, busy_timeout=busy_timeout))
+
+        # most polls only bring a few new delays, the rest of the monitor is saved already
+        self.departure_filter = ChangeFilter()
+        self.arrival_filter = ChangeFilter()
 
         self.stops = list(stops)
         self.watchers = [] # type: List[Union[DepartureWatcher, ArrivalWatcher]]
-        self.watchers.extend(DepartureWatcher(s, self.client, self.db) for s in self.stops if s.active)
-        self.watchers.extend(ArrivalWatcher(s, self.client, self.db) for s in self.stops if s.active)
+        self.watchers.extend(DepartureWatcher(s, self.client, self.db, self.departure_filter) for s in self.stops if s.active)
+        self.watchers.extend(ArrivalWatcher(s, self.client, self.db, self.arrival_filter) for s in self.stops if s.active)
         self._watchdog_func = watchdog_func
 
     def _watchdog(self) -> None:
@@ -70,6 +79,9 @@ class Runner:
         for m in self.watchers:
             m.perform()
 
+        last_report = time.monotonic()
+        last_rollup = time.monotonic()
+
         while True:
             now = datetime.utcnow().timestamp()
 
@@ -79,5 +91,16 @@ class Runner:
                     m.reschedule()
                     self._watchdog()
 
+            # saving only marks the rollup groups as dirty, recompute them now and then
+            if time.monotonic() - last_rollup >= ROLLUP_INTERVAL:
+                self.db.connection.update_rollups()
+                last_rollup = time.monotonic()
+
+            if time.monotonic() - last_report >= REPORT_INTERVAL:
+                for name, f in (('departures', self.departure_filter), ('arrivals', self.arrival_filter)):
+                    saved, skipped = f.stats()
+                    _log.info('{}: saved {}, skipped {} unchanged'.format(name, saved, skipped))
+                last_report = time.monotonic()
+
 
             time.sleep(1)
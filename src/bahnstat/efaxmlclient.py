@@ -1,7 +1,9 @@
+from xml.parsers import expat
 from datetime import datetime, date, timedelta
-from typing import Optional, Iterable
+from typing import Optional, Iterable, List, Union
 from bahnstat.datatypes import *
 from bahnstat.mechanize_mini import Browser
+import re
 
 class DepartureMonitor:
     def __init__(self, now: datetime, gid: str, name: str, departures: Iterable[Departure]) -> None:
@@ -17,11 +19,8 @@ class ArrivalMonitor:
         self.stop_name = name
         self.arrivals = list(arrivals)
 
-def _datetime_from_itdDateTime(itdDateTime) -> datetime:
-    itdDate = itdDateTime.query_selector('itdDate')
+def _datetime_from_attributes(itdDate, itdTime) -> datetime:
     assert itdDate is not None
-
-    itdTime = itdDateTime.query_selector('itdTime')
     assert itdTime is not None
 
     year = int(itdDate.get('year') or 0)
@@ -34,53 +33,60 @@ def _datetime_from_itdDateTime(itdDateTime) -> datetime:
 
     return datetime(year, month, day, hour, minute)
 
-def _departure_from_itdDeparture(itdDeparture) -> Departure:
-    if itdDeparture.query_selector('itdServingLine').get('trainType') is not None:
-        train_name = '{} {}'.format(itdDeparture.query_selector('itdServingLine').get('trainType', ''),
-                itdDeparture.query_selector('itdServingLine').get('trainNum', ''))
-    elif itdDeparture.query_selector('itdServingLine').get('symbol') is not None:
-        train_name = itdDeparture.query_selector('itdServingLine').get('symbol')
+def _datetime_from_itdDateTime(itdDateTime) -> datetime:
+    return _datetime_from_attributes(itdDateTime.query_selector('itdDate'), itdDateTime.query_selector('itdTime'))
+
+# The builders below get the elements of an itdDeparture or itdArrival as anything
+# with a get() method for the attributes: tree elements, or the dicts from expat.
+
+def _train_name(itdServingLine) -> str:
+    if itdServingLine.get('trainType') is not None:
+        return '{} {}'.format(itdServingLine.get('trainType', ''), itdServingLine.get('trainNum', ''))
+    elif itdServingLine.get('symbol') is not None:
+        return itdServingLine.get('symbol')
     else:
-        train_name = ''
+        return ''
 
+def _delay(itdNoTrain) -> Optional[float]:
     delay = None # type: Optional[float]
-    if itdDeparture.query_selector('itdNoTrain').get('delay') is not None:
-        delay = int(itdDeparture.query_selector('itdNoTrain').get('delay'))
+    if itdNoTrain.get('delay') is not None:
+        delay = int(itdNoTrain.get('delay'))
         if delay == -9999: # train canceled -> we model it as infinite delay
             delay = float('inf')
 
+    return delay
+
+def _departure_from_parts(itdDeparture, itdServingLine, itdNoTrain, itdDate, itdTime) -> Departure:
     return Departure(
-        _datetime_from_itdDateTime(itdDeparture.query_selector('itdDateTime')),
-        train_name,
-        itdDeparture.query_selector('itdServingLine').get('direction'),
+        _datetime_from_attributes(itdDate, itdTime),
+        _train_name(itdServingLine),
+        itdServingLine.get('direction'),
         itdDeparture.get('stopID'),
-        itdDeparture.query_selector('itdServingLine').get('key'),
-        itdDeparture.query_selector('itdServingLine').get('stateless'),
-        delay)
-
-def _arrival_from_itdArrival(itdArrival) -> Arrival:
-    if itdArrival.query_selector('itdServingLine').get('trainType') is not None:
-        train_name = '{} {}'.format(itdArrival.query_selector('itdServingLine').get('trainType', ''),
-                itdArrival.query_selector('itdServingLine').get('trainNum', ''))
-    elif itdArrival.query_selector('itdServingLine').get('symbol') is not None:
-        train_name = itdArrival.query_selector('itdServingLine').get('symbol')
-    else:
-        train_name = ''
-
-    delay = None # type: Optional[float]
-    if itdArrival.query_selector('itdNoTrain').get('delay') is not None:
-        delay = int(itdArrival.query_selector('itdNoTrain').get('delay'))
-        if delay == -9999: # train canceled -> we model it as infinite delay
-            delay = float('inf')
+        itdServingLine.get('key'),
+        itdServingLine.get('stateless'),
+        _delay(itdNoTrain))
 
+def _arrival_from_parts(itdArrival, itdServingLine, itdNoTrain, itdDate, itdTime) -> Arrival:
     return Arrival(
-        _datetime_from_itdDateTime(itdArrival.query_selector('itdDateTime')),
-        train_name,
-        itdArrival.query_selector('itdServingLine').get('directionFrom'),
+        _datetime_from_attributes(itdDate, itdTime),
+        _train_name(itdServingLine),
+        itdServingLine.get('directionFrom'),
         itdArrival.get('stopID'),
-        itdArrival.query_selector('itdServingLine').get('key'),
-        itdArrival.query_selector('itdServingLine').get('stateless'),
-        delay)
+        itdServingLine.get('key'),
+        itdServingLine.get('stateless'),
+        _delay(itdNoTrain))
+
+def _departure_from_itdDeparture(itdDeparture) -> Departure:
+    itdDateTime = itdDeparture.query_selector('itdDateTime')
+    return _departure_from_parts(itdDeparture, itdDeparture.query_selector('itdServingLine'),
+                                 itdDeparture.query_selector('itdNoTrain'),
+                                 itdDateTime.query_selector('itdDate'), itdDateTime.query_selector('itdTime'))
+
+def _arrival_from_itdArrival(itdArrival) -> Arrival:
+    itdDateTime = itdArrival.query_selector('itdDateTime')
+    return _arrival_from_parts(itdArrival, itdArrival.query_selector('itdServingLine'),
+                               itdArrival.query_selector('itdNoTrain'),
+                               itdDateTime.query_selector('itdDate'), itdDateTime.query_selector('itdTime'))
 
 def _departure_monitor_from_response(xmlnode) -> DepartureMonitor:
     if xmlnode.tag != 'itdrequest':
@@ -124,19 +130,157 @@ def _arrival_monitor_from_response(xmlnode) -> ArrivalMonitor:
 
     return ArrivalMonitor(time, stop_gid, stop_name, deps)
 
-def _stop_dm_url(stop: WatchedStop, *, mode:str='dep') -> str:
-        return 'https://www.efa-bw.de/nvbw/XML_DM_REQUEST?language=de&name_dm={}&type_dm=any&mode=direct&useRealtime=1&itdDateTimeDepArr={}'.format(stop.backend_stop_id, mode)
+class _MonitorParser:
+    """builds the DepartureMonitor or ArrivalMonitor of an XML_DM_REQUEST response
+    straight from the expat events, without a tree. Each departure or arrival is built
+    when its element closes, until then only the attributes it needs are kept.
+
+    The result is the same as that of _departure_monitor_from_response() resp.
+    _arrival_monitor_from_response() for the parsed document: where those take the
+    first match of query_selector(), so does the parser.
+    """
+    def __init__(self, mode: str) -> None:
+        self.mode = mode
+        if mode == 'dep':
+            self._list, self._item, self._build = 'itdDepartureList', 'itdDeparture', _departure_from_parts
+        else:
+            self._list, self._item, self._build = 'itdArrivalList', 'itdArrival', _arrival_from_parts
+
+        self.now = None # type: Optional[str]
+        self.stop_gid = None # type: Optional[str]
+        self.items = [] # type: list
+
+        # number of open elements of the selectors, and the depth of the open element
+        self._ancestors = dict.fromkeys(['itdDepartureMonitorRequest', 'itdOdv', 'itdOdvName', self._list], 0)
+        self._depth = 0
+
+        # text of the odvNameElem with the stop name, with a space at each tag like text_content
+        self._name_depth = None # type: Optional[int]
+        self._name_text = [] # type: List[str]
+
+        # [item, itdServingLine, itdNoTrain, itdDate, itdTime] of the open item, the depth
+        # of the item and of its first itdDateTime
+        self._current = None # type: Optional[list]
+        self._item_depth = 0
+        self._datetime_depth = None # type: Optional[int]
+        self._datetime_seen = False
+
+    def _start(self, name, attrs):
+        self._depth += 1
+        if name in self._ancestors:
+            self._ancestors[name] += 1
+        if self._name_depth is not None:
+            self._name_text.append(' ')
+
+        current = self._current
+        if current is not None:
+            if name == 'itdServingLine':
+                if current[1] is None:
+                    current[1] = attrs
+            elif name == 'itdNoTrain':
+                if current[2] is None:
+                    current[2] = attrs
+            elif name == 'itdDateTime':
+                if not self._datetime_seen:
+                    self._datetime_seen = True
+                    self._datetime_depth = self._depth
+            elif self._datetime_depth is not None:
+                if name == 'itdDate' and current[3] is None:
+                    current[3] = attrs
+                elif name == 'itdTime' and current[4] is None:
+                    current[4] = attrs
+        elif name == self._item:
+            if self._ancestors[self._list]:
+                self._current = [attrs, None, None, None, None]
+                self._item_depth = self._depth
+                self._datetime_seen = False
+        elif name == 'itdRequest':
+            if self.now is None:
+                self.now = attrs.get('now')
+        elif name == 'odvNameElem':
+            if self.stop_gid is None and self._ancestors['itdDepartureMonitorRequest'] \
+                    and self._ancestors['itdOdv'] and self._ancestors['itdOdvName']:
+                self.stop_gid = attrs.get('gid') or ''
+                self._name_depth = self._depth
+
+    def _end(self, name):
+        depth = self._depth
+        if self._current is not None:
+            if depth == self._item_depth:
+                self.items.append(self._build(*self._current))
+                self._current = None
+            elif depth == self._datetime_depth:
+                self._datetime_depth = None
+
+        if self._name_depth is not None:
+            if depth == self._name_depth:
+                self._name_depth = None
+            else:
+                self._name_text.append(' ')
+
+        if name in self._ancestors:
+            self._ancestors[name] -= 1
+        self._depth = depth - 1
+
+    def _text(self, data):
+        if self._name_depth is not None:
+            self._name_text.append(data)
+
+    def parse(self, f, charset: str = None) -> Union[DepartureMonitor, ArrivalMonitor]:
+        """parses the response read from the file object `f`. A `charset` from the
+        HTTP headers overrides the XML declaration."""
+        p = expat.ParserCreate(charset)
+        p.buffer_text = True
+        p.StartElementHandler = self._start
+        p.EndElementHandler = self._end
+        p.CharacterDataHandler = self._text
+        p.ParseFile(f)
+
+        assert self.now is not None
+        assert self.stop_gid is not None
+
+        now = datetime.strptime(self.now, '%Y-%m-%dT%H:%M:%S')
+        name = ' '.join(x for x in re.split('[ \t\r\n\f]+', ''.join(self._name_text)) if x != '')
+
+        if self.mode == 'dep':
+            return DepartureMonitor(now, self.stop_gid, name, self.items)
+        else:
+            return ArrivalMonitor(now, self.stop_gid, name, self.items)
+
+def parse_monitor(f, mode: str, charset: str = None) -> Union[DepartureMonitor, ArrivalMonitor]:
+    """parses a departure (`mode` 'dep') or arrival ('arr') monitor from the file object `f`"""
+    return _MonitorParser(mode).parse(f, charset)
+
+EFA_URL = 'https://www.efa-bw.de/nvbw/XML_DM_REQUEST'
+
+def stop_dm_url(stop: WatchedStop, *, mode:str='dep', baseurl:str=EFA_URL) -> str:
+        return '{}?language=de&name_dm={}&type_dm=any&mode=direct&useRealtime=1&itdDateTimeDepArr={}'.format(baseurl, stop.backend_stop_id, mode)
+
+def _is_xml(content_type: str) -> bool:
+    return content_type in ('text/xml', 'application/xml') or content_type.endswith('+xml')
 
 class EfaXmlClient:
-    def __init__(self, user_agent: str) -> None:
+    """Client for the XML interface of the EFA
+
+    The responses are parsed while they are received, without building a tree.
+    """
+    def __init__(self, user_agent: str, baseurl: str = EFA_URL) -> None:
         self.user_agent = user_agent
+        self.baseurl = baseurl
         self._browser = Browser(user_agent)
 
+    def _monitor(self, stop: WatchedStop, mode: str) -> Union[DepartureMonitor, ArrivalMonitor]:
+        url = stop_dm_url(stop, mode=mode, baseurl=self.baseurl)
+        with self._browser.open_stream(url) as r:
+            content_type = r.info().get_content_type()
+            if not _is_xml(content_type):
+                raise ValueError('expected an XML response from {}, got {}'.format(r.geturl(), content_type))
+
+            # expat reads the body in chunks while it is received
+            return parse_monitor(r, mode, r.info().get_content_charset())
+
     def departure_monitor(self, stop: WatchedStop) -> DepartureMonitor:
-        doc = self._browser.open(_stop_dm_url(stop, mode='dep'))
-        return _departure_monitor_from_response(doc.document_element)
+        return self._monitor(stop, 'dep') # type: ignore
 
     def arrival_monitor(self, stop: WatchedStop) -> ArrivalMonitor:
-        doc = self._browser.open(_stop_dm_url(stop, mode='arr'))
-        return _arrival_monitor_from_response(doc.document_element)
-
+        return self._monitor(stop, 'arr') # type: ignore
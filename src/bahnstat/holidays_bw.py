@@ -1,31 +1,64 @@
-from datetime import date
-
-
-HOLIDAYS = {
-    # Feiertage 2018 in Baden-Württemberg:
-    date(2018, 1, 1),   #Neujahr
-    date(2018, 1, 6),   #Heilige Drei Könige
-    date(2018, 3, 30),  #Karfreitag
-    date(2018, 4, 2),   #Ostermontag
-    date(2018, 5, 1),   #Tag der Arbeit
-    date(2018, 5, 10),  #Christi Himmelfahrt
-    date(2018, 5, 21),  #Pfingstmontag
-    date(2018, 5, 31),  #Fronleichnam
-    date(2018, 10, 3),  #Tag der Deutschen Einheit
-    date(2018, 11, 1),  #Allerheiligen
-    date(2018, 12, 25), #1. Weihnachtsfeiertag
-    date(2018, 12, 26), #2. Weihnachtsfeiertag
-    # Feiertage 2019 in Baden-Württemberg:
-    date(2019, 1, 1),   #Neujahr
-    date(2019, 1, 6),   #Heilige Drei Könige
-    date(2019, 4, 19),  #Karfreitag
-    date(2019, 4, 22),  #Ostermontag
-    date(2019, 5, 1),   #Tag der Arbeit
-    date(2019, 5, 30),  #Christi Himmelfahrt
-    date(2019, 6, 10),  #Pfingstmontag
-    date(2019, 6, 20),  #Fronleichnam
-    date(2019, 10, 3),  #Tag der Deutschen Einheit
-    date(2019, 11, 1),  #Allerheiligen
-    date(2019, 12, 25), #1. Weihnachtsfeiertag
-    date(2019, 12, 26), #2. Weihnachtsfeiertag
-}
+from datetime import date, timedelta
+from functools import lru_cache
+from typing import Dict
+
+__all__ = [ 'easter_sunday', 'holidays', 'is_holiday', 'day_type', 'DAY_TYPES' ]
+
+DAY_TYPES = ('mofr', 'sat', 'sun')
+
+def easter_sunday(year: int) -> date:
+    """date of Easter Sunday in the Gregorian calendar (anonymous Gregorian algorithm)"""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19*a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2*e + 2*i - h - k) % 7
+    m = (a + 11*h + 22*l) // 451
+    month, day = divmod(h + l - 7*m + 114, 31)
+
+    return date(year, month, day + 1)
+
+@lru_cache(maxsize=64)
+def holidays(year: int) -> Dict[date, str]:
+    """public holidays in Baden-Württemberg"""
+    easter = easter_sunday(year)
+
+    h = {
+        date(year, 1, 1):               'Neujahr',
+        date(year, 1, 6):               'Heilige Drei Könige',
+        easter - timedelta(days=2):     'Karfreitag',
+        easter + timedelta(days=1):     'Ostermontag',
+        date(year, 5, 1):               'Tag der Arbeit',
+        easter + timedelta(days=39):    'Christi Himmelfahrt',
+        easter + timedelta(days=50):    'Pfingstmontag',
+        easter + timedelta(days=60):    'Fronleichnam',
+        date(year, 10, 3):              'Tag der Deutschen Einheit',
+        date(year, 11, 1):              'Allerheiligen',
+        date(year, 12, 25):             '1. Weihnachtsfeiertag',
+        date(year, 12, 26):             '2. Weihnachtsfeiertag',
+    }
+
+    if year == 2017:
+        # 500 years of reformation, a one-time holiday all over Germany
+        h[date(2017, 10, 31)] = 'Reformationstag'
+
+    return h
+
+def is_holiday(d: date) -> bool:
+    return d in holidays(d.year)
+
+def day_type(d: date) -> str:
+    """classifies the day for the timetable: 'mofr', 'sat' or 'sun' (which includes holidays)"""
+    if is_holiday(d):
+        return 'sun'
+
+    wd = d.weekday()
+    if 0 <= wd <= 4:
+        return 'mofr'
+    elif wd == 5:
+        return 'sat'
+    else:
+        return 'sun'
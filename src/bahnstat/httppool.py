@@ -0,0 +1,124 @@
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from typing import Dict, List, Mapping, Optional, Tuple
+import gzip
+import io
+import logging
+import threading
+import time
+
+__all__ = [ 'HttpConnectionPool', 'PooledResponse' ]
+
+_log = logging.getLogger(__name__)
+
+# errors of a kept-alive connection which the server has closed in the meantime
+_STALE_ERRORS = (ConnectionError, HTTPException)
+
+class PooledResponse:
+    """a completely read response, with the timing of its request"""
+    def __init__(self, url: str, status: int, headers: Mapping[str, str], body: bytes,
+                 elapsed: float, reused: bool) -> None:
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+        # seconds from sending the request until the body was read, and whether
+        # an idle connection was used instead of opening a new one
+        self.elapsed = elapsed
+        self.reused = reused
+
+class HttpConnectionPool:
+    """keep-alive HTTP(S) connections, shared by all clients of an API.
+
+    Opening a TLS connection takes several round trips, which would dominate the
+    polling requests. Idle connections are kept per host, up to `maxidle` of them.
+    Servers drop idle connections after a while, so connections idle for longer
+    than `idle_timeout` seconds are closed instead of reused, and a request which
+    fails on a reused connection is repeated on another one.
+    """
+    def __init__(self, *, maxidle: int = 4, idle_timeout: float = 30.0, timeout: float = 60.0) -> None:
+        self.maxidle = maxidle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        # (scheme, host, port) -> (connection, time it became idle), most recent last
+        self._idle = dict() # type: Dict[Tuple[str, str, int], List[Tuple[HTTPConnection, float]]]
+        self._lock = threading.Lock()
+
+    def _connection(self, key: Tuple[str, str, int]) -> Tuple[HTTPConnection, bool]:
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, since = idle.pop()
+                if now - since < self.idle_timeout:
+                    return conn, True
+                conn.close()
+
+        scheme, host, port = key
+        if scheme == 'https':
+            return HTTPSConnection(host, port, timeout=self.timeout), False
+        else:
+            return HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _release(self, key: Tuple[str, str, int], conn: HTTPConnection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxidle:
+                idle.append((conn, time.monotonic()))
+                return
+
+        conn.close()
+
+    def close(self) -> None:
+        """closes all idle connections"""
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, since in idle:
+                    conn.close()
+            self._idle.clear()
+
+    def get(self, url: str, headers: Optional[Mapping[str, str]] = None) -> PooledResponse:
+        """GETs `url`, and raises HTTPError for error responses like urlopen()"""
+        u = urlsplit(url)
+        key = (u.scheme, u.hostname, u.port or (443 if u.scheme == 'https' else 80))
+        path = u.path + ('?' + u.query if u.query else '')
+        request_headers = dict(headers or {})
+        request_headers['Accept-Encoding'] = 'gzip'
+
+        while True:
+            conn, reused = self._connection(key)
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path, headers=request_headers)
+                r = conn.getresponse()
+                body = r.read()
+            except _STALE_ERRORS:
+                conn.close()
+                if reused:
+                    _log.debug('stale connection to {}, reconnecting'.format(u.hostname))
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            break
+
+        elapsed = time.perf_counter() - start
+
+        if r.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        if r.getheader('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+
+        _log.debug('GET {} {} in {:.0f} ms{}'.format(url, r.status, elapsed * 1000, ' (reused)' if reused else ''))
+
+        if r.status >= 400:
+            raise HTTPError(url, r.status, r.reason, r.msg, io.BytesIO(body))
+
+        return PooledResponse(url, r.status, r.msg, body, elapsed, reused)
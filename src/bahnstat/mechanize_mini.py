@@ -1,20 +1,28 @@
 import http.cookiejar
 import urllib.request
+import urllib.response
 import urllib.error
 from urllib.parse import urljoin, urldefrag, urlencode
 import re
 import codecs
 import warnings
 import html
+import sys
+import io
+from types import MappingProxyType
 from html.parser import HTMLParser
-from functools import partial
+from functools import partial, lru_cache
+from bisect import bisect_left, bisect_right
 
 from typing import List, Set, Dict, Tuple, Text, Optional, AnyStr, Union, Iterator, \
-    IO, Sequence, Iterable, TypeVar, KeysView, ItemsView, cast, Callable, overload
+    IO, Sequence, Iterable, TypeVar, KeysView, ItemsView, Mapping, MutableMapping, cast, Callable, overload, Type
 
 
 THtmlElement = TypeVar('THtmlElement', bound='HtmlElement')
 T = TypeVar('T')
+_NO_ATTRIBUTES = MappingProxyType({}) # type: Mapping[str, str]
+_NO_CHILDREN = () # type: Tuple[HtmlElement, ...]
+
 class HtmlElement(Sequence['HtmlElement']):
     """
     An HTML Element
@@ -47,26 +55,16 @@ class HtmlElement(Sequence['HtmlElement']):
         attached to the same :any:`Document`, and they cannot change the document they are attached to.
     """
 
-    def __new__(cls, *args, **kwargs) -> 'HtmlElement':
-        tag = args[0].lower()
-
-        if (tag == 'option') and not issubclass(cls, HtmlOptionElement):
-            return HtmlOptionElement(*args, **kwargs)
-
-        if (tag == 'input') and not issubclass(cls, HtmlInputElement):
-            return HtmlInputElement(*args, **kwargs)
-
-        if (tag == 'textarea') and not issubclass(cls, HtmlTextareaElement):
-            return HtmlTextareaElement(*args, **kwargs)
-
-        if (tag == 'select') and not issubclass(cls, HtmlSelectElement):
-            return HtmlSelectElement(*args, **kwargs)
+    __slots__ = ('_backend', '_tag', '_attrib', 'text', 'tail', '_children')
 
-        if (tag in ['form']) and not issubclass(cls, HtmlFormElement):
-            return HtmlFormElement(*args, **kwargs)
+    def __new__(cls, *args, **kwargs) -> 'HtmlElement':
+        sub = _ELEMENT_CLASSES.get(args[0].lower())
 
-        if (tag in ['a']) and not issubclass(cls, HtmlAnchorElement):
-            return HtmlAnchorElement(*args, **kwargs)
+        if sub is not None and not issubclass(cls, sub):
+            if issubclass(sub, cls):
+                # still an instance of cls, so __init__ runs once
+                return super().__new__(sub)
+            return sub(*args, **kwargs)
 
         return super().__new__(cls)
 
@@ -84,14 +82,13 @@ class HtmlElement(Sequence['HtmlElement']):
 
         self._backend = backend
 
-        self.tag = tag # type: str
-        """The element tag name (:any:`str`)"""
-
-        self.attrib = {} # type: Dict[str,str]
-        """The element's attributes (dictionary of :any:`str`, :any:`str`)"""
+        self._tag = sys.intern(tag) # type: str
 
-        for key, val in attrib.items():
-            self.attrib[key.casefold()] = val
+        # elements without attributes or children share the empty containers
+        # until they are changed
+        self._attrib = _NO_ATTRIBUTES # type: Mapping[str,str]
+        if attrib:
+            self._attrib = { sys.intern(key.casefold()): val for key, val in attrib.items() }
 
         self.text = '' # type: str
         """
@@ -103,7 +100,36 @@ class HtmlElement(Sequence['HtmlElement']):
         Text after this element's end tag up until the next sibling tag (:any:`str`)
         """
 
-        self._children = [] # type: List[HtmlElement]
+        self._children = _NO_CHILDREN # type: Sequence[HtmlElement]
+
+    @property
+    def tag(self) -> str:
+        """The element tag name (:any:`str`)"""
+        return self._tag
+
+    @tag.setter
+    def tag(self, tag: str) -> None:
+        self._tag = sys.intern(tag)
+        self._changed()
+
+    @property
+    def attrib(self) -> MutableMapping[str,str]:
+        """The element's attributes (mapping of :any:`str`, :any:`str`)"""
+        return _Attributes(self)
+
+    def _attrib_dict(self) -> Dict[str,str]:
+        """the attributes for changing them, replacing the shared empty mapping"""
+        attrib = self._attrib
+        if not isinstance(attrib, dict):
+            attrib = self._attrib = {}
+        return attrib
+
+    def _child_list(self) -> List['HtmlElement']:
+        """the children for changing them, replacing the shared empty tuple"""
+        children = self._children
+        if not isinstance(children, list):
+            children = self._children = []
+        return children
 
     def append(self, subelement: 'HtmlElement') -> None:
         """
@@ -118,7 +144,8 @@ class HtmlElement(Sequence['HtmlElement']):
         """
         assert subelement._backend == self._backend
 
-        self._children.append(subelement)
+        self._child_list().append(subelement)
+        self._changed()
 
     def extend(self, elements: Iterable['HtmlElement']) -> None:
         """
@@ -146,7 +173,8 @@ class HtmlElement(Sequence['HtmlElement']):
         """
         assert subelement._backend == self._backend
 
-        self._children.insert(index, subelement)
+        self._child_list().insert(index, subelement)
+        self._changed()
 
     def remove(self, subelement: 'HtmlElement') -> None:
         """
@@ -158,7 +186,13 @@ class HtmlElement(Sequence['HtmlElement']):
         >>> el.outer_html
         '<ul><li>b</li><li>c</li></ul>'
         """
-        self._children.remove(subelement)
+        self._child_list().remove(subelement)
+        self._changed()
+
+    def _changed(self) -> None:
+        # the index of the document is rebuilt on the next lookup
+        if self._backend is not None:
+            self._backend.index = None
 
     def get(self, key: str, default:T=None) -> Union[str,T,None]:
         """
@@ -175,13 +209,14 @@ class HtmlElement(Sequence['HtmlElement']):
         >>> el.get('data-foo', 'bar')
         'bar'
         """
-        return self.attrib.get(key.casefold(), default)
+        return self._attrib.get(key.casefold(), default)
 
     def set(self, key: str, value: str) -> None:
         """
         Set an attribute value
         """
-        self.attrib[key.casefold()] = value
+        self._attrib_dict()[sys.intern(key.casefold())] = value
+        self._changed()
 
     def keys(self) -> KeysView[str]:
         """
@@ -194,24 +229,26 @@ class HtmlElement(Sequence['HtmlElement']):
         >>> list(el.keys())
         ['href', 'name']
         """
-        return self.attrib.keys()
+        return self._attrib.keys()
 
     def items(self) -> ItemsView[str,str]:
         """
         Attributes as (key, value) sequence
         """
-        return self.attrib.items()
+        return self._attrib.items()
 
     def iter(self, tag:str=None) -> Iterator['HtmlElement']:
         """
         Returns an iterator over the current element and all its descendants
         which have the given tag (or any tag, if :code:`tag` is :any:`None`).
         """
-        if tag is None or self.tag == tag:
-            yield self
+        stack = [self]
+        while stack:
+            el = stack.pop()
+            if tag is None or el.tag == tag:
+                yield el
 
-        for e in self._children:
-            yield from e.iter(tag)
+            stack.extend(reversed(el._children))
 
     def itertext(self) -> Iterator[str]:
         """
@@ -290,6 +327,7 @@ class HtmlElement(Sequence['HtmlElement']):
 
         self.text = htmlel.text
         self._children = list(htmlel)
+        self._changed()
 
     @property
     def outer_html(self) -> str:
@@ -443,8 +481,7 @@ class HtmlElement(Sequence['HtmlElement']):
         * child combination selector (``div > p``)
         * jQuery text selector (``span:contains(foo)``)
         """
-        selector = _build_css_selector(lambda el: el, sel)
-        yield from selector(self)
+        return compile_selector(sel).select_all(self)
 
     def query_selector(self, sel: str) -> Optional['HtmlElement']:
         """
@@ -453,135 +490,380 @@ class HtmlElement(Sequence['HtmlElement']):
 
         See :any:`HtmlElement.query_selector_all` for the supported selectors.
         """
-        return next(self.query_selector_all(sel), None)
+        return compile_selector(sel).select(self)
 
     def __len__(self) -> int:
         return len(self._children)
 
+    @overload
+    def __getitem__(self, index: int) -> 'HtmlElement':
+        pass # pragma: no cover
+
+    @overload
+    def __getitem__(self, s: slice) -> List['HtmlElement']:
+        pass # pragma: no cover
+
     def __getitem__(self, index):
+        if isinstance(index, slice):
+            # a list, whether the children are still the shared empty tuple or not
+            return list(self._children[index])
         return self._children[index]
 
     def __setitem__(self, index: int, element: 'HtmlElement') -> None:
-        self._children[index] = element
+        self._child_list()[index] = element
+        self._changed()
 
     def __delitem__(self, index: int) -> None:
-        del self._children[index]
+        del self._child_list()[index]
+        self._changed()
 
     def __repr__(self) -> str:
         return '<{} {!r} at {:#x}>'.format(self.__class__.__name__, self.tag, id(self))
 
-def _assign_elements_to_backend(el: HtmlElement, backend: Optional['_DocumentBackend']) -> None:
-    assert el._backend is None
+class _Attributes(MutableMapping[str, str]):
+    """
+    The attributes of an element, as returned by :any:`HtmlElement.attrib`.
+    Changes go to the element, and keep the index of its document up to date.
+    """
+    __slots__ = ('_element',)
 
-    el._backend = backend
-    for sub in el:
-        _assign_elements_to_backend(sub, backend)
+    def __init__(self, element: HtmlElement) -> None:
+        self._element = element
 
-### CSS Selectors
-_TMatcher = Callable[[HtmlElement], bool]
-_TSelector = Callable[[HtmlElement], Iterable[HtmlElement]]
+    def __getitem__(self, key: str) -> str:
+        return self._element._attrib[key]
 
-def _chain_selector(a: _TSelector, b: _TSelector) -> _TSelector:
-    def wrap(el: HtmlElement) -> Iterator[HtmlElement]:
-        for e in a(el):
-            yield from b(e)
-    return wrap
+    def __setitem__(self, key: str, value: str) -> None:
+        self._element._attrib_dict()[sys.intern(key)] = value
+        self._element._changed()
 
-def _descendant_selector(match: _TMatcher) -> _TSelector:
-    return _chain_selector(lambda el: el, _descendant_or_self_selector(match))
+    def __delitem__(self, key: str) -> None:
+        del self._element._attrib_dict()[key]
+        self._element._changed()
 
-def _descendant_or_self_selector(match: _TMatcher) -> _TSelector:
-    def sel(el: HtmlElement) -> Iterator[HtmlElement]:
-        if match(el):
-            yield el
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._element._attrib)
 
-        for child in el:
-            yield from sel(child)
-    return sel
+    def __len__(self) -> int:
+        return len(self._element._attrib)
 
-def _immediate_child_selector(match: _TMatcher) -> _TSelector:
-    def sel(el: HtmlElement) -> Iterator[HtmlElement]:
-        for child in el:
-            if match(child):
-                yield child
+    def __contains__(self, key: object) -> bool:
+        return key in self._element._attrib
 
-    return sel
+    def __repr__(self) -> str:
+        return repr(dict(self._element._attrib))
 
-def _uniqueify_selector(inp: _TSelector) -> _TSelector:
-    def sel(el: HtmlElement) -> Iterator[HtmlElement]:
-        seen = set() # type: Set[int]
+def _assign_elements_to_backend(el: HtmlElement, backend: Optional['_DocumentBackend']) -> None:
+    assert el._backend is None
 
-        for f in inp(el):
-            if id(f) not in seen:
-                seen |= {id(f)}
-                yield f
+    el._backend = backend
+    for sub in el:
+        _assign_elements_to_backend(sub, backend)
 
-    return sel
+### CSS Selectors
 
 class InvalidSelectorError(Exception):
     """ The specified CSS selector is invalid """
 
-def _matcher_and(a: Optional[_TMatcher], b: _TMatcher) -> _TMatcher:
-    if a is not None: return lambda el: cast(_TMatcher, a)(el) and b(el)
-    else: return b
-
-def _matcher_tagname(tag: str) -> _TMatcher:
-    return lambda el: el.tag.casefold() == tag.casefold()
-def _matcher_class(classname: str) -> _TMatcher:
-    return lambda el: classname in el.class_list
-def _matcher_id(id: str) -> _TMatcher:
-    return lambda el: el.id == id
-def _matcher_contains(text: str) -> _TMatcher:
-    return lambda el: text in el.text_content
-
-def _build_css_selector(start: _TSelector, s: str) -> _TSelector:
+class _Compound:
+    """
+    The simple selectors of one step of a CSS selector, like ``div.foo#bar``
+    """
+    def __init__(self) -> None:
+        self.tags = [] # type: List[str]
+        self.ids = [] # type: List[str]
+        self.classes = [] # type: List[str]
+        self.contains = [] # type: List[str]
+
+    def matches(self, el: HtmlElement) -> bool:
+        for tag in self.tags:
+            if el._tag != tag and el._tag.casefold() != tag:
+                return False
+
+        for id in self.ids:
+            if el._attrib.get('id') != id:
+                return False
+
+        if self.classes:
+            classes = (el._attrib.get('class') or '').split()
+            for classname in self.classes:
+                if classname not in classes:
+                    return False
+
+        if self.contains:
+            text = el.text_content
+            for t in self.contains:
+                if t not in text:
+                    return False
+
+        return True
+
+_RE_UNIVERSAL = re.compile(r'\*')
+_RE_TAG = re.compile(r'[\w_-]+')
+_RE_CLASS = re.compile(r'\.([\w_-]+)')
+_RE_ID = re.compile(r'#([\w_-]+)')
+_RE_CONTAINS = re.compile(r':contains\(("([^"]+)"|([^")]+))\)')
+_RE_CHILD = re.compile(r'\s*\>\s*')
+_RE_DESCENDANT = re.compile(r'\s+')
+
+_TStep = Tuple[str, _Compound]
+
+def _parse_css_selector(s: str) -> List[_TStep]:
+    """
+    Parses `s` into its steps: the combinator to the previous step ('' for the first
+    step, ' ' or '>') and the compound selector. The empty selector has no steps.
+    """
+    steps = [] # type: List[_TStep]
+    combinator = ''
+    compound = None # type: Optional[_Compound]
     i = 0
-    selgen = _descendant_or_self_selector
-    sel = start
-    matcher = None # type: Optional[_TMatcher]
     while i < len(s):
-        match = re.match('''\*''', s[i:])
+        match = _RE_UNIVERSAL.match(s, i)
         if match: # universal selector
-            matcher = _matcher_and(matcher, lambda el: True)
-            i += len(match.group(0)); continue
-        match = re.match('''[\w_-]+''', s[i:])
+            compound = compound or _Compound()
+            i = match.end(); continue
+        match = _RE_TAG.match(s, i)
         if match: # tag selector
-            matcher = _matcher_and(matcher, _matcher_tagname(match.group(0)))
-            i += len(match.group(0)); continue
-        match = re.match('''\.([\w_-]+)''', s[i:])
+            compound = compound or _Compound()
+            compound.tags.append(match.group(0).casefold())
+            i = match.end(); continue
+        match = _RE_CLASS.match(s, i)
         if match: # class selector
-            matcher = _matcher_and(matcher, _matcher_class(match.group(1)))
-            i += len(match.group(0)); continue
-        match = re.match('''#([\w_-]+)''', s[i:])
+            compound = compound or _Compound()
+            compound.classes.append(match.group(1))
+            i = match.end(); continue
+        match = _RE_ID.match(s, i)
         if match: # id selector
-            matcher = _matcher_and(matcher, _matcher_id(match.group(1)))
-            i += len(match.group(0)); continue
-        match = re.match(''':contains\(("([^"]+)"|([^")]+))\)''', s[i:])
+            compound = compound or _Compound()
+            compound.ids.append(match.group(1))
+            i = match.end(); continue
+        match = _RE_CONTAINS.match(s, i)
         if match: # jQuery :contains selector
-            matcher = _matcher_and(matcher, _matcher_contains(str(match.group(2) or match.group(3))))
-            i += len(match.group(0)); continue
-        match = re.match('''\s*\>\s*''', s[i:])
-        if match and matcher: # immediate child
-            sel = _chain_selector(sel, selgen(matcher))
-            selgen = _immediate_child_selector
-            matcher = None
-            i += len(match.group(0)); continue
-        match = re.match('''\s+''', s[i:])
-        if match and matcher: # descendant
-            sel = _chain_selector(sel, selgen(matcher))
-            selgen = _descendant_selector
-            matcher = None
-            i += len(match.group(0)); continue;
+            compound = compound or _Compound()
+            compound.contains.append(str(match.group(2) or match.group(3)))
+            i = match.end(); continue
+        match = _RE_CHILD.match(s, i)
+        if match and compound: # immediate child
+            steps.append((combinator, compound))
+            combinator = '>'
+            compound = None
+            i = match.end(); continue
+        match = _RE_DESCENDANT.match(s, i)
+        if match and compound: # descendant
+            steps.append((combinator, compound))
+            combinator = ' '
+            compound = None
+            i = match.end(); continue;
 
         raise InvalidSelectorError("Unexpected selector at position {0}".format(i))
 
-    if matcher is not None:
-        sel = _chain_selector(sel, selgen(matcher))
+    if compound is not None:
+        steps.append((combinator, compound))
+
+    return steps
+
+def _match_steps(steps: List[_TStep], k: int, path: List[HtmlElement], i: int) -> bool:
+    """
+    Whether the steps up to `k` match, with step `k` on ``path[i]``. The path holds an
+    element and its ancestors up to (excluding) the element the selector is used on.
+    """
+    combinator, compound = steps[k]
+    if not compound.matches(path[i]):
+        return False
+
+    if k == 0:
+        return True
+    elif combinator == '>':
+        return i > 0 and _match_steps(steps, k - 1, path, i - 1)
+    else:
+        return any(_match_steps(steps, k - 1, path, j) for j in range(i - 1, -1, -1))
+
+def _walk(el: HtmlElement, include_self: bool = False) -> Iterator[List[HtmlElement]]:
+    """
+    The descendants of `el` in document order, each as the path from the child of `el`
+    down to the descendant. The same list is reused for every path.
+
+    With `include_self`, `el` itself comes first and starts every path.
+    """
+    path = [] # type: List[HtmlElement]
+    if include_self:
+        path.append(el)
+        yield path
+    stack = [iter(el._children)]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            if path:
+                path.pop()
+            continue
+
+        path.append(child)
+        yield path
+        stack.append(iter(child._children))
+
+class _ElementIndex:
+    """
+    The elements of a document tree in document order, and their numbers by tag name
+    (casefolded), id and class. Built on the first lookup after a change of the tree.
+    """
+    def __init__(self, root: HtmlElement) -> None:
+        self.order = [root] # type: List[HtmlElement]
+        self.span = {} # type: Dict[int, Tuple[int, int]]
+        self.parent = {} # type: Dict[int, HtmlElement]
+        self.keys = { 'tag': {}, 'id': {}, 'class': {} } # type: Dict[str, Dict[str, List[int]]]
+
+        tags, ids, classes = self.keys['tag'], self.keys['id'], self.keys['class']
+
+        # iterative, so deep documents don't hit the recursion limit
+        stack = [(root, 0, iter(root._children))]
+        self._add(root, 0)
+        while stack:
+            el, number, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                self.span[id(el)] = (number, len(self.order) - 1)
+                stack.pop()
+                continue
+
+            self.parent[id(child)] = el
+            self.order.append(child)
+            self._add(child, len(self.order) - 1)
+            stack.append((child, len(self.order) - 1, iter(child._children)))
+
+    def _add(self, el: HtmlElement, number: int) -> None:
+        self.keys['tag'].setdefault(el._tag.casefold(), []).append(number)
+        if el._attrib.get('id') is not None:
+            self.keys['id'].setdefault(el._attrib['id'], []).append(number)
+        for classname in set((el._attrib.get('class') or '').split()):
+            self.keys['class'].setdefault(classname, []).append(number)
+
+    def descendants(self, el: HtmlElement, kind: str, key: str,
+                    include_self: bool = False) -> Optional[Iterator[HtmlElement]]:
+        """
+        The descendants of `el` (and `el` itself with `include_self`) with the given
+        tag name, id or class, in document order. None if `el` is not part of the tree.
+        """
+        span = self.span.get(id(el))
+        if span is None or self.order[span[0]] is not el:
+            return None
+
+        numbers = self.keys[kind].get(key, [])
+        if include_self:
+            lo = bisect_left(numbers, span[0])
+        else:
+            lo = bisect_right(numbers, span[0])
+        hi = bisect_right(numbers, span[1])
+        return (self.order[n] for n in numbers[lo:hi])
+
+    def path(self, el: HtmlElement, top: HtmlElement,
+             include_top: bool = False) -> List[HtmlElement]:
+        """ `el` and its ancestors below `top` (and `top` with `include_top`), from the top down """
+        path = [] # type: List[HtmlElement]
+        while el is not top:
+            path.append(el)
+            el = self.parent[id(el)]
+        if include_top:
+            path.append(top)
+
+        path.reverse()
+        return path
+
+def _document_index(el: HtmlElement) -> Optional[_ElementIndex]:
+    backend = el._backend
+    if backend is None or backend.root is None:
+        return None
+
+    if backend.index is None:
+        backend.index = _ElementIndex(backend.root)
+
+    return backend.index
+
+class CompiledSelector:
+    """
+    A CSS selector, parsed once by :any:`compile_selector` and usable on any element.
+
+    Elements of a :any:`Document` are looked up in an index of the document tree by the
+    tag name, id or class of the last step of the selector, so the cost grows with the
+    number of matches and not with the size of the document. Other elements are found
+    by walking the tree.
+    """
+    def __init__(self, sel: str) -> None:
+        self.selector = sel
+        self._steps = _parse_css_selector(sel)
+
+        # the most selective index key of the last step
+        self._key = None # type: Optional[Tuple[str, str]]
+        if self._steps:
+            last = self._steps[-1][1]
+            if last.ids:
+                self._key = ('id', last.ids[0])
+            elif last.classes:
+                self._key = ('class', last.classes[0])
+            elif last.tags:
+                self._key = ('tag', last.tags[0])
+
+    def _walk(self, el: HtmlElement, include_self: bool) -> Iterator[HtmlElement]:
+        steps = self._steps
+        last = len(steps) - 1
+        for path in _walk(el, include_self):
+            if _match_steps(steps, last, path, len(path) - 1):
+                yield path[-1]
+
+    def _lookup(self, el: HtmlElement, index: _ElementIndex,
+                candidates: Iterator[HtmlElement], include_self: bool) -> Iterator[HtmlElement]:
+        steps = self._steps
+        last = len(steps) - 1
+        compound = steps[last][1]
+        for c in candidates:
+            if not compound.matches(c):
+                continue
+            if last == 0:
+                yield c
+                continue
+
+            path = index.path(c, el, include_self)
+            if _match_steps(steps, last, path, len(path) - 1):
+                yield c
+
+    def select_all(self, el: HtmlElement, include_self: bool = False) -> Iterator[HtmlElement]:
+        """
+        All descendants of `el` matching the selector, see :any:`HtmlElement.query_selector_all`
+
+        With `include_self`, `el` itself is a candidate as well and the selector may
+        start at `el` (as for :any:`Document.query_selector_all`, where `el` is the root).
+        """
+        if not self._steps: # empty selector - return nothing
+            return iter(())
+
+        if self._key is not None:
+            index = _document_index(el)
+            if index is not None:
+                candidates = index.descendants(el, *self._key, include_self=include_self)
+                if candidates is not None:
+                    return self._lookup(el, index, candidates, include_self)
+
+        return self._walk(el, include_self)
+
+    def select(self, el: HtmlElement, include_self: bool = False) -> Optional[HtmlElement]:
+        """
+        The first descendant of `el` (or `el` itself with `include_self`) matching the
+        selector, or :any:`None`
+        """
+        return next(self.select_all(el, include_self), None)
+
+    def __repr__(self) -> str:
+        return '<{} {!r}>'.format(self.__class__.__name__, self.selector)
+
+@lru_cache(maxsize=256)
+def compile_selector(sel: str) -> CompiledSelector:
+    """
+    Parses the CSS selector `sel`, or returns it from the cache of recently used selectors.
+    Raises :any:`InvalidSelectorError` for an invalid selector.
 
-    if sel is not start:
-        return _uniqueify_selector(sel)
-    else: # empty selector - return nothing
-        return lambda el: []
+    See :any:`HtmlElement.query_selector_all` for the supported selectors.
+    """
+    return CompiledSelector(sel)
 
 class InputNotFoundError(Exception):
     """
@@ -601,6 +883,9 @@ class HtmlOptionElement(HtmlElement):
     """
     An ``<option>`` element
     """
+
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -734,6 +1019,9 @@ class HtmlInputElement(HtmlElement):
 
     Additionally, ``<select>`` and ``<textarea>`` elements are inherited from this class.
     """
+
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -830,6 +1118,9 @@ class HtmlTextareaElement(HtmlInputElement):
     """
     Wraps a ``<textarea>`` element
     """
+
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -854,6 +1145,9 @@ class HtmlSelectElement(HtmlInputElement):
     """
     Wraps a ``<select>`` element
     """
+
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -953,6 +1247,8 @@ class HtmlFormElement(HtmlElement):
     A ``<form>`` element inside a document.
     """
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs) -> None:
         """
         Constructs a new :any:`HtmlFormElement` instance.
@@ -1209,6 +1505,8 @@ class HtmlAnchorElement(HtmlElement):
     An ``<a>`` element
     """
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -1240,6 +1538,16 @@ class HtmlAnchorElement(HtmlElement):
         return self.follow()
 
 
+# the element classes for special tags, see HtmlElement.__new__
+_ELEMENT_CLASSES = {
+    'option': HtmlOptionElement,
+    'input': HtmlInputElement,
+    'textarea': HtmlTextareaElement,
+    'select': HtmlSelectElement,
+    'form': HtmlFormElement,
+    'a': HtmlAnchorElement,
+} # type: Dict[str, Type[HtmlElement]]
+
 class _TreeBuildingHTMLParser(HTMLParser):
     """
     A parser to parse a HTML document into an :any:`xml.etree.ElementTree`
@@ -1525,12 +1833,19 @@ class _CharsetDetectingHTMLParser(HTMLParser):
                 self.charset = None
 
 
+_RE_XML_DECLARATION = re.compile(rb'''<\?xml[ \t\r\n]+version=(['"])1.0\1[ \t\r\n]+encoding=(['"])(?P<enc>[a-zA-Z0-9_\-]+)\2''')
+
+# like the prescan of the WHATWG encoding sniffing algorithm, only the start of a document
+# is searched for an XML declaration or <meta> tag
+_PRESCAN_BYTES = 1024
+
 def detect_charset(html: bytes, charset: str = None) -> str:
     """
     Detects the character set of the given html file.
 
-    This function will search for a BOM or the charset <meta> tag
-    and return the name of the appropriate python codec.
+    This function will search for a BOM, then for an XML declaration or
+    the charset <meta> tag within the first 1024 bytes, and return the
+    name of the appropriate python codec.
 
     :param charset:
         Charset information obtained via external means, e.g. HTTP header.
@@ -1554,20 +1869,25 @@ def detect_charset(html: bytes, charset: str = None) -> str:
         if html[0:2] == b'\xFF\xFE':
             charset = 'utf-16-le'
 
+    prefix = html[:_PRESCAN_BYTES]
+
+    if charset is None:
+        # check for XML declaration
+        match = _RE_XML_DECLARATION.match(prefix)
+        if match is not None:
+            try:
+                charset = codecs.lookup(str(match['enc'], 'ascii', 'replace')).name
+            except LookupError:
+                pass # look for a meta tag instead
+
     if charset is None:
         # check meta tag
         parser = _CharsetDetectingHTMLParser()
-        parser.feed(str(html, 'ascii', 'replace'))
+        parser.feed(str(prefix, 'ascii', 'replace'))
         parser.close()
 
         charset = parser.charset
 
-    if charset is None:
-        # check for XML declaration
-        match = re.match(rb'''<\?xml[ \t\r\n]+version=(['"])1.0\1[ \t\r\n]+encoding=(['"])(?P<enc>[a-zA-Z0-9_\-]+)\2''', html)
-        if match is not None:
-            charset = str(match['enc'], 'ascii', 'replace')
-
     if charset is None:
         # default: windows-1252
         charset = 'cp1252'
@@ -1768,6 +2088,60 @@ class Browser:
 
         """
 
+        page = Document(self, self._send(url, additional_headers, data))
+        redirect_to, additional_headers = _redirect_target(page, additional_headers)
+
+        if redirect_to:
+            if maximum_redirects > 0:
+                return page.open(redirect_to, additional_headers=additional_headers, maximum_redirects=maximum_redirects-1)
+            else:
+                raise TooManyRedirectsException(page.status, page)
+        elif page.status == 200:
+            return page
+        else:
+            raise HTTPException(page.status, page)
+
+    def open_stream(self, url: str, *, additional_headers: Dict[str, str] = {},
+                    maximum_redirects: int = 10, data: bytes = None) -> urllib.response.addinfourl:
+        """
+        Navigates to :code:`url` like :any:`open`, but returns the response instead of a
+        parsed :any:`Document`, so that the body can be processed while it is received.
+
+        Parameters are the same as for :any:`open`.
+
+        Notes
+        -----
+
+        *   Only a final HTTP/200 response which is not an HTML page is streamed. Everything else
+            is read and handled like :any:`open` does: redirects are followed, including those in
+            ``<meta>`` tags, and anything but HTTP/200 raises an :any:`HTTPException`.
+        *   An HTML page without redirect is returned as well, with its body buffered. Check the
+            content type if you expect something else.
+
+        """
+
+        response = self._send(url, additional_headers, data)
+        if response.getcode() == 200 and response.info().get_content_type() != 'text/html' \
+                and 'Refresh' not in response.info():
+            return response
+
+        page = Document(self, response)
+        redirect_to, additional_headers = _redirect_target(page, additional_headers)
+
+        if redirect_to:
+            if maximum_redirects > 0:
+                return self.open_stream(urljoin(page.baseuri, redirect_to),
+                                        additional_headers={'Referer': urldefrag(page.url).url, **additional_headers},
+                                        maximum_redirects=maximum_redirects-1)
+            else:
+                raise TooManyRedirectsException(page.status, page)
+        elif page.status == 200:
+            return urllib.response.addinfourl(io.BytesIO(page.response_bytes), response.info(), page.url, page.status)
+        else:
+            raise HTTPException(page.status, page)
+
+    def _send(self, url: str, additional_headers: Dict[str, str], data: Optional[bytes]) -> urllib.response.addinfourl:
+        """sends the request, and returns the response without reading its body"""
         opener = urllib.request.build_opener(_NoHttpRedirectHandler, urllib.request.HTTPCookieProcessor(self.cookiejar))
 
         request = urllib.request.Request(url, data=data)
@@ -1778,47 +2152,40 @@ class Browser:
             request.add_header(header, val)
 
         try:
-            response = opener.open(request) # type: Union[http.client.HTTPResponse, urllib.error.HTTPError, urllib.response.addinfourl]
+            return opener.open(request)
         except urllib.error.HTTPError as r:
-            response = r
-
-        page = Document(self, response)
-        redirect_to = None # type: Union[None, str]
-        if (page.status in [301, 302, 303, 307]) and ('Location' in page.headers):
-            # standard redirects
-            redirect_to = page.headers['Location'].strip()
-
-        if (page.status == 200) and (('Refresh' in page.headers)):
-            # really brainded Refresh redirect
-            match = re.fullmatch('\s*\d+\s*;\s*[uU][rR][lL]\s*=(.+)', page.headers['Refresh'])
-            if match:
+            return r
+
+def _redirect_target(page: 'Document', additional_headers: Dict[str, str]) -> Tuple[Optional[str], Dict[str, str]]:
+    """where `page` redirects to, if anywhere, and the headers to send there"""
+    redirect_to = None # type: Union[None, str]
+    if (page.status in [301, 302, 303, 307]) and ('Location' in page.headers):
+        # standard redirects
+        redirect_to = page.headers['Location'].strip()
+
+    if (page.status == 200) and (('Refresh' in page.headers)):
+        # really brainded Refresh redirect
+        match = re.fullmatch('\s*\d+\s*;\s*[uU][rR][lL]\s*=(.+)', page.headers['Refresh'])
+        if match:
+            redirect_to = match.group(1).strip()
+
+            # referer change
+            additional_headers = {**additional_headers, 'Referer': urldefrag(page.url).url}
+
+    if ((page.status == 200) and not (page.document_element is None)):
+        # look for meta tag
+        for i in page.document_element.iter('meta'):
+            h = str(i.get('http-equiv') or '')
+            c = str(i.get('content') or '')
+            match = re.fullmatch('\s*\d+\s*;\s*[uU][rR][lL]\s*=(.+)', c)
+            if h.lower() == 'refresh' and match:
+                # still shitty meta redirect
                 redirect_to = match.group(1).strip()
 
                 # referer change
                 additional_headers = {**additional_headers, 'Referer': urldefrag(page.url).url}
 
-        if ((page.status == 200) and not (page.document_element is None)):
-            # look for meta tag
-            for i in page.document_element.iter('meta'):
-                h = str(i.get('http-equiv') or '')
-                c = str(i.get('content') or '')
-                match = re.fullmatch('\s*\d+\s*;\s*[uU][rR][lL]\s*=(.+)', c)
-                if h.lower() == 'refresh' and match:
-                    # still shitty meta redirect
-                    redirect_to = match.group(1).strip()
-
-                    # referer change
-                    additional_headers = {**additional_headers, 'Referer': urldefrag(page.url).url}
-
-        if redirect_to:
-            if maximum_redirects > 0:
-                return page.open(redirect_to, additional_headers=additional_headers, maximum_redirects=maximum_redirects-1)
-            else:
-                raise TooManyRedirectsException(page.status, page)
-        elif page.status == 200:
-            return page
-        else:
-            raise HTTPException(page.status, page)
+    return redirect_to, additional_headers
 
 class _DocumentBackend:
     """
@@ -1838,6 +2205,10 @@ class _DocumentBackend:
 
         self.baseuri = response.geturl()
 
+        # the document tree, and its index for CSS selectors
+        self.root = None # type: Optional[HtmlElement]
+        self.index = None # type: Optional[_ElementIndex]
+
     def open(self, url: str, **kwargs) -> 'Document':
         headers = { 'Referer': urldefrag(self.response.geturl()).url }
         if ('additional_headers' in kwargs):
@@ -1869,20 +2240,31 @@ class Document:
     def __init__(self, browser: Browser, response) -> None:
         self._backend = _DocumentBackend(browser, response)
 
-        self.document_element = parsehtmlstr(str(self.response_bytes, self.charset, 'replace')) # type: HtmlElement
-        """
-        The root node of the parsed html content (:any:`HtmlElement`)
-        """
+        document_element = parsehtmlstr(str(self.response_bytes, self.charset, 'replace'))
 
         base = self.url
 
-        bases = [x for x in self.document_element.query_selector_all('base') if x.get('href') is not None]
+        bases = [x for x in document_element.query_selector_all('base') if x.get('href') is not None]
         if len(bases) > 0:
             base = urljoin(self.url, (bases[0].get('href') or '').strip())
 
         self._backend.baseuri = urldefrag(base).url
 
-        self.adopt_element(self.document_element)
+        self.document_element = self.adopt_element(document_element)
+
+    @property
+    def document_element(self) -> HtmlElement:
+        """
+        The root node of the parsed html content (:any:`HtmlElement`)
+        """
+        return cast(HtmlElement, self._backend.root)
+
+    @document_element.setter
+    def document_element(self, el: HtmlElement) -> None:
+        assert el._backend == self._backend
+
+        self._backend.root = el
+        self._backend.index = None
 
     @property
     def browser(self) -> Browser:
@@ -1959,7 +2341,7 @@ class Document:
 
         See: :any:`HtmlElement.query_selector`
         """
-        return next(self.query_selector_all(sel), None)
+        return compile_selector(sel).select(self.document_element, include_self=True)
 
     def query_selector_all(self, sel: str) -> Iterator[HtmlElement]:
         """
@@ -1967,8 +2349,7 @@ class Document:
 
         See: :any:`HtmlElement.query_selector_all`
         """
-        selector = _build_css_selector(lambda el: [el], sel)
-        yield from selector(self.document_element)
+        return compile_selector(sel).select_all(self.document_element, include_self=True)
 
     @property
     def forms(self) -> 'HtmlFormsCollection':
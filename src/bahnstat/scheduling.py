@@ -0,0 +1,116 @@
+from typing import Callable, Dict, Generic, Hashable, Iterable, List, Tuple, TypeVar
+import heapq
+import itertools
+import threading
+import time
+
+__all__ = [ 'TokenBucket', 'StalestFirstScheduler' ]
+
+T = TypeVar('T', bound=Hashable)
+
+class TokenBucket:
+    """rate limiter: tokens are refilled at `rate` per second, up to `capacity`.
+
+    Every request takes a token, so at most `capacity + rate * t` requests are sent
+    within any `t` seconds. The clock and sleep functions can be replaced for testing.
+    """
+    def __init__(self, rate: float, capacity: float, *,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep) -> None:
+        assert rate > 0 and capacity >= 1
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(capacity)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def try_acquire(self, n: float = 1) -> bool:
+        """takes `n` tokens if they are available right now"""
+        with self._lock:
+            self._refill()
+            if self._tokens < n:
+                return False
+
+            self._tokens -= n
+            return True
+
+    def reserve(self, n: float = 1) -> float:
+        """takes `n` tokens right away, and returns how long to wait before using them.
+
+        The bucket may go into debt, so that later callers queue up behind this one.
+        This is for callers which wait by other means, e.g. asyncio.sleep().
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= n
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, n: float = 1) -> float:
+        """takes `n` tokens, waiting for them if necessary. Returns the waiting time."""
+        wait = self.reserve(n)
+        if wait > 0:
+            self._sleep(wait)
+
+        return wait
+
+class StalestFirstScheduler(Generic[T]):
+    """hands out the item which has been served longest ago, but none of them more
+    often than every `min_interval` seconds.
+
+    Together with a rate limiter, which slows down the serving itself, this spreads
+    the budget evenly: every item ends up with the same time between its updates.
+    """
+    def __init__(self, items: Iterable[T], min_interval: float = 0.0, *,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep) -> None:
+        self.min_interval = min_interval
+        self._clock = clock
+        self._sleep = sleep
+
+        # items which were never served come first, in their original order
+        self._order = itertools.count()
+        self._queue = [(float('-inf'), next(self._order), item) for item in items] # type: List[Tuple[float, int, T]]
+        self._last = dict() # type: Dict[T, float]
+
+        # count, sum and maximum of the times between two updates of the same item
+        self._intervals = (0, 0.0, 0.0)
+
+    def next(self) -> T:
+        """removes the stalest item, after waiting until it is due"""
+        last, order, item = heapq.heappop(self._queue)
+
+        wait = last + self.min_interval - self._clock()
+        if wait > 0:
+            self._sleep(wait)
+
+        return item
+
+    def done(self, item: T) -> None:
+        """puts the item back, as just served"""
+        now = self._clock()
+        if item in self._last:
+            count, total, longest = self._intervals
+            interval = now - self._last[item]
+            self._intervals = (count + 1, total + interval, max(longest, interval))
+        self._last[item] = now
+
+        heapq.heappush(self._queue, (now, next(self._order), item))
+
+    def interval_stats(self) -> Tuple[int, float, float]:
+        """number, mean and maximum of the times between two updates of the same item,
+        in seconds, since the last call"""
+        count, total, longest = self._intervals
+        self._intervals = (0, 0.0, 0.0)
+
+        return count, (total / count if count else 0.0), longest
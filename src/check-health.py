@@ -8,10 +8,11 @@ from datetime import datetime
 
 ap = ArgumentParser()
 ap.add_argument('--db-file', required=True)
+ap.add_argument('--busy-timeout', type=float, default=DEFAULT_BUSY_TIMEOUT)
 args = ap.parse_args()
 
 
-db = DatabaseAccessor(DatabaseConnection(args.db_file))
+db = DatabaseAccessor(DatabaseConnection(args.db_file, read_only=True, busy_timeout=args.busy_timeout))
 
 stations = list(db.all_watched_stops())
 
@@ -6,6 +6,7 @@ from bahnstat.htmlstatgen import *
 
 import os
 import logging
+import sqlite3
 from argparse import ArgumentParser
 
 def writefile(path, text):
@@ -21,6 +22,7 @@ ap = ArgumentParser()
 ap.add_argument('--db-file', required=True)
 ap.add_argument('--outdir', required=True)
 ap.add_argument('--log', default='WARN')
+ap.add_argument('--busy-timeout', type=float, default=DEFAULT_BUSY_TIMEOUT)
 
 args = ap.parse_args()
 
@@ -30,14 +32,12 @@ if not isinstance(num_loglevel, int):
 
 logging.basicConfig(level=num_loglevel)
 
-db = DatabaseAccessor(DatabaseConnection(args.db_file))
+# the collectors keep the rollups up to date, changes since their last refresh are
+# only reported as a warning
+db =DatabaseAccessor(DatabaseConnection(args.db_file, read_only=True, busy_timeout=args.busy_timeout))
 outdir = args.outdir
 gen = HtmlStatGen(db)
 
-logging.debug('materializing trip view')
-db.materialize_trips()
-logging.debug('done materializing trip view')
-
 stations = list(db.all_watched_stops())
 
 writefile(os.path.join(outdir, 'index.html'), gen.station_list())
@@ -53,3 +53,12 @@ for s in stations:
                 writefile(os.path.join(outdir, str(s.id), str(d.id), '{}-{}.html'.format(r, t)), gen.trip_list(s, d, t, r))
 
 
+
+# the collectors only do passive checkpoints, which can't make progress while we
+# are reading. Now that we're done, give the write-ahead log a chance to shrink.
+# A plain connection is enough for that, it doesn't need the schema.
+db.connection.conn.close()
+conn = sqlite3.connect(args.db_file, timeout=args.busy_timeout)
+busy, log, checkpointed = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+conn.close()
+logging.debug('checkpoint: busy={} log={} checkpointed={}'.format(busy, log, checkpointed))
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+from bahnstat.database import *
+
+from argparse import ArgumentParser
+
+ap = ArgumentParser(description='delete old raw observations, keeping their daily rollups')
+ap.add_argument('--db-file', required=True)
+ap.add_argument('--days', type=int, default=RETENTION_DAYS,
+                help='keep the raw observations of this many days (default: %(default)s)')
+ap.add_argument('--rollup-days', type=int,
+                help='also delete the daily rollups older than this many days (default: keep them)')
+ap.add_argument('--busy-timeout', type=float, default=DEFAULT_BUSY_TIMEOUT)
+args = ap.parse_args()
+
+db = DatabaseConnection(args.db_file, busy_timeout=args.busy_timeout)
+
+deleted = db.prune(args.days, args.rollup_days)
+print(', '.join('{} {}'.format(n, t) for t, n in deleted.items()))
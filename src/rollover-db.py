@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+from bahnstat.database import *
+
+from argparse import ArgumentParser
+from datetime import date
+
+ap = ArgumentParser(description='move the observations of past years into yearly archive files')
+ap.add_argument('--db-file', required=True)
+ap.add_argument('--year', type=int, action='append',
+                help='year to roll over, can be given multiple times (default: all past years and existing archives)')
+ap.add_argument('--vacuum', action='store_true', help='shrink the database file afterwards')
+ap.add_argument('--busy-timeout', type=float, default=DEFAULT_BUSY_TIMEOUT)
+args = ap.parse_args()
+
+db = DatabaseConnection(args.db_file, busy_timeout=args.busy_timeout)
+
+years = args.year
+if years is None:
+    first, = db.exec("SELECT CAST(strftime('%Y', MIN(time) * 60, 'unixepoch') AS INTEGER) FROM Departure").fetchone()
+    years = range(first, date.today().year) if first is not None else []
+    # existing archives are upgraded to the current layout, even if nothing is left to move
+    years = sorted(set(years) | set(archive_years(args.db_file)))
+
+for year in years:
+    moved = db.roll_over(year)
+    print('{}: {} -> {}'.format(year, ', '.join('{} {}'.format(n, t) for t, n in moved.items()),
+                                archive_path(args.db_file, year)))
+
+if args.vacuum:
+    db.vacuum()
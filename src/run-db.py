@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 from bahnstat.datatypes import WatchedStop
-from bahnstat.dbrunner import Runner
+from bahnstat.apicache import ApiResponseCache
+from bahnstat.collector import Collector, db_jobs
+from bahnstat.dbrunner import Runner, REQUESTS_PER_MINUTE, budget_report
+from bahnstat.database import DEFAULT_BUSY_TIMEOUT
 from bahnstat.sdnotify import SystemdNotifier
 from config import *
 
+import asyncio
 import logging
 from argparse import ArgumentParser
 from uuid import UUID
@@ -14,15 +18,33 @@ ap = ArgumentParser()
 ap.add_argument('--db-file', required=True)
 ap.add_argument('--log', default='WARN')
 ap.add_argument('--api-key', default=DB_API_KEY)
+ap.add_argument('--wal', action='store_true', help='switch the database to write-ahead-log mode')
+ap.add_argument('--busy-timeout', type=float, default=DEFAULT_BUSY_TIMEOUT)
+ap.add_argument('--cache-file', help='keep API responses in this file, for quick restarts')
+ap.add_argument('--asyncio', action='store_true', help='sync the stops concurrently')
+ap.add_argument('--budget-report', action='store_true', help='print how many stops the request budget can sync, and exit')
 
 args = ap.parse_args()
 
+if args.budget_report:
+    print(budget_report(REQUESTS_PER_MINUTE))
+    raise SystemExit()
+
 num_loglevel = getattr(logging, args.log.upper(), None)
 if not isinstance(num_loglevel, int):
     raise ValueError('Invalid log level: {}'.format(args.log))
 
 logging.basicConfig(level=num_loglevel)
 
-r = Runner(args.db_file, [WatchedStop(UUID(a),b,c,d) for a,b,c,d in DB_STOPS], args.api_key, SystemdNotifier().watchdog)
-r.run()
+stops = [WatchedStop(UUID(a),b,c,d) for a,b,c,d in DB_STOPS]
+
+if args.asyncio:
+    cache = ApiResponseCache(args.cache_file) if args.cache_file is not None else None
+    c = Collector(args.db_file, stops, db_jobs(stops, args.api_key, cache=cache), wal=args.wal, busy_timeout=args.busy_timeout,
+                  watchdog_func=SystemdNotifier().watchdog)
+    asyncio.run(c.run())
+else:
+    r = Runner(args.db_file, stops, args.api_key, SystemdNotifier().watchdog,
+               wal=args.wal, busy_timeout=args.busy_timeout, cache_file=args.cache_file)
+    r.run()
 
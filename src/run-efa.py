@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
 from bahnstat.datatypes import WatchedStop
+from bahnstat.collector import Collector, efa_jobs
 from bahnstat.efarunner import Runner
+from bahnstat.database import DEFAULT_BUSY_TIMEOUT
 from bahnstat.sdnotify import SystemdNotifier
 from config import *
 
+import asyncio
 import logging
 from argparse import ArgumentParser
 from uuid import UUID
@@ -13,6 +16,9 @@ ap = ArgumentParser()
 
 ap.add_argument('--db-file', required=True)
 ap.add_argument('--log', default='WARN')
+ap.add_argument('--wal', action='store_true', help='switch the database to write-ahead-log mode')
+ap.add_argument('--busy-timeout', type=float, default=DEFAULT_BUSY_TIMEOUT)
+ap.add_argument('--asyncio', action='store_true', help='sync the stops concurrently')
 
 args = ap.parse_args()
 
@@ -22,6 +28,14 @@ if not isinstance(num_loglevel, int):
 
 logging.basicConfig(level=num_loglevel)
 
-r = Runner(args.db_file, [WatchedStop(UUID(a),b,c,d) for a,b,c,d in EFA_STOPS], EFA_USER_AGENT, SystemdNotifier().watchdog)
-r.run()
+stops = [WatchedStop(UUID(a),b,c,d) for a,b,c,d in EFA_STOPS]
+
+if args.asyncio:
+    c = Collector(args.db_file, stops, efa_jobs(stops, EFA_USER_AGENT), wal=args.wal, busy_timeout=args.busy_timeout,
+                  watchdog_func=SystemdNotifier().watchdog)
+    asyncio.run(c.run())
+else:
+    r = Runner(args.db_file, stops, EFA_USER_AGENT, SystemdNotifier().watchdog,
+               wal=args.wal, busy_timeout=args.busy_timeout)
+    r.run()
 
@@ -0,0 +1,31 @@
+import sqlite3
+
+__all__ = [ 'make_v6_db' ]
+
+# the tables of schema v6, as written by the versions before the batched migrations.
+# The migration tests and the schema benchmark start from this layout.
+V6_SCHEMA = '''
+    CREATE TABLE WatchedStop(pk INTEGER PRIMARY KEY, id UUID NOT NULL UNIQUE, efa_stop_id INTEGER NOT NULL,
+                             name TEXT NOT NULL, active INTEGER NOT NULL DEFAULT 0);
+    CREATE TABLE LineCodeDictionary(pk INTEGER PRIMARY KEY, line_code TEXT UNIQUE NOT NULL);
+    CREATE TABLE OriginDestinationDictionary(pk INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+    CREATE TABLE TrainNameDictionary(pk INTEGER PRIMARY KEY, train_name TEXT UNIQUE NOT NULL);
+    CREATE TABLE Departure(stop_pk INTEGER REFERENCES WatchedStop(pk), time TIMESTAMP NOT NULL, delay REAL,
+                           trip_code TEXT NOT NULL, line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
+                           destination_pk INTEGER REFERENCES OriginDestinationDictionary(pk),
+                           train_name_pk INTEGER REFERENCES TrainNameDictionary(pk),
+                           UNIQUE(stop_pk,time,trip_code,line_code_pk));
+    CREATE TABLE Arrival(stop_pk INTEGER REFERENCES WatchedStop(pk), time TIMESTAMP NOT NULL, delay REAL,
+                         trip_code TEXT NOT NULL, line_code_pk INTEGER REFERENCES LineCodeDictionary(pk),
+                         origin_pk INTEGER REFERENCES OriginDestinationDictionary(pk),
+                         train_name_pk INTEGER REFERENCES TrainNameDictionary(pk),
+                         UNIQUE(stop_pk,time,trip_code,line_code_pk));
+    PRAGMA user_version = 6;
+    '''
+
+def make_v6_db(dbfile: str) -> sqlite3.Connection:
+    """creates an empty database in the layout of schema v6, and returns a plain
+    sqlite3 connection to fill it"""
+    conn = sqlite3.connect(dbfile)
+    conn.executescript(V6_SCHEMA)
+    return conn
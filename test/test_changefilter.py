@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import unittest
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from bahnstat.changefilter import ChangeFilter
+from bahnstat.database import DatabaseConnection, DatabaseAccessor
+from bahnstat.datatypes import Departure, WatchedStop
+
+NOW = datetime(2018, 5, 22, 8, 15)
+
+def board(delays):
+    return [Departure(NOW + timedelta(minutes=10 * i), 'RB {}'.format(38800 + i), 'Mannheim Hbf', '7000090',
+                      38800 + i, 'ddb:90700: :R:j18', d)
+            for i, d in enumerate(delays)]
+
+class TestChangeFilter(unittest.TestCase):
+    def setUp(self):
+        self.now = NOW
+        self.filter = ChangeFilter(clock=lambda: self.now)
+        self.stop = WatchedStop(uuid4(), 7000090, 'Karlsruhe Hbf')
+        self.db = DatabaseAccessor(DatabaseConnection(':memory:'))
+        self.db.persist_watched_stop(self.stop)
+
+    def saved(self):
+        return self.db.connection.exec('SELECT delay FROM Departure ORDER BY time').fetchall()
+
+    def test_changes_only(self):
+        self.assertEqual(self.filter.persist(self.db.persist_departures, self.stop, board([None, 0, 2])), 3)
+        self.assertEqual(self.filter.persist(self.db.persist_departures, self.stop, board([None, 0, 2])), 0)
+
+        # a known delay going missing doesn't change the saved row
+        self.assertEqual(self.filter.persist(self.db.persist_departures, self.stop, board([1, None, 5, 3])), 3)
+        self.assertEqual(self.saved(), [(1,), (0,), (5,), (3,)])
+        self.assertEqual(self.filter.stats(), (6, 4))
+        self.assertEqual(self.filter.stats(), (0, 0))
+
+        # the same rows for another stop are new
+        other = WatchedStop(uuid4(), 7000091, 'Durlach')
+        self.db.persist_watched_stop(other)
+        self.assertEqual(len(self.filter.changed(other, board([1, 0]))), 2)
+
+    def test_failed_write(self):
+        def fail(stop, deps):
+            raise RuntimeError()
+
+        with self.assertRaises(RuntimeError):
+            self.filter.persist(fail, self.stop, board([0]))
+
+        # nothing was recorded, so the next poll tries again
+        self.assertEqual(self.filter.persist(self.db.persist_departures, self.stop, board([0])), 1)
+
+    def test_eviction(self):
+        self.filter.persist(self.db.persist_departures, self.stop, board([0, 1, 2]))
+        self.assertEqual(len(self.filter), 3)
+
+        self.now = NOW + timedelta(hours=6, minutes=15)
+        self.filter.mark_saved(self.stop, [])
+        self.assertEqual(len(self.filter), 1)
+
+if __name__ == '__main__':
+    unittest.main()
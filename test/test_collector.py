@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import unittest
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from uuid import uuid4
+
+from bahnstat.collector import AsyncFetcher, Collector, DbTimetableJob, HostLimit, efa_jobs
+from bahnstat.database import DatabaseConnection
+from bahnstat.datatypes import WatchedStop
+from bahnstat.dbtimetableclient import DbTimetableClient
+from bahnstat.httppool import HttpConnectionPool
+
+NOW = datetime(2018, 5, 22, 8, 15)
+
+def TestCaseBytes(filename):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testcases', filename), 'rb') as f:
+        return f.read()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """EFA and DB Timetables API in one, answering after `server.latency` seconds"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        kind = self.path.split('/')[-1].split('?')[0] if self.path.startswith('/nvbw/') else self.path.split('/')[1]
+        with self.server.lock:
+            self.server.requests[kind] += 1
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+
+        time.sleep(self.server.latency)
+
+        if kind == 'XML_DM_REQUEST':
+            body = TestCaseBytes('XML_DM_REQUEST zugausfall rb neustadt.xml')
+        elif kind == 'plan':
+            body = TestCaseBytes('dbtimetable plan karlsruhe.xml')
+        elif kind == 'fchg':
+            body = TestCaseBytes('dbtimetable fchg karlsruhe.xml')
+        else:
+            body = b"<?xml version='1.0' encoding='UTF-8'?><timetable station='Karlsruhe Hbf'/>"
+
+        with self.server.lock:
+            self.server.active -= 1
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestCollector(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = Counter()
+        self.server.active = self.server.max_active = 0
+        self.server.latency = 0.2
+        threading.Thread(target=self.server.serve_forever, kwargs=dict(poll_interval=0.01), daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dbfile = os.path.join(tmpdir.name, 'collector.sqlite')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def collect_once(self, stops, jobs, concurrency):
+        fetcher = AsyncFetcher(default_limit=HostLimit(concurrency), max_workers=concurrency)
+        collector = Collector(self.dbfile, stops, jobs, fetcher)
+        try:
+            return asyncio.run(collector.collect_once())
+        finally:
+            collector.close()
+
+    def saved(self, table):
+        db = DatabaseConnection(self.dbfile, read_only=True)
+        try:
+            return db.exec('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+        finally:
+            db.conn.close()
+
+    def test_concurrent(self):
+        stops = [WatchedStop(uuid4(), 8000191 + i, 'Station {}'.format(i)) for i in range(12)]
+        jobs = [DbTimetableJob(s, 60, now=lambda: NOW, apiurl=self.url) for s in stops]
+        elapsed = self.collect_once(stops, jobs, 12)
+
+        # one after another, the 4 requests of each station would take 12 * 4 * 0.2 s
+        self.assertEqual(self.server.requests, Counter(plan=12 * 3, fchg=12))
+        self.assertLess(elapsed, 3.0)
+        self.assertGreater(self.server.max_active, 1)
+
+        pool = HttpConnectionPool()
+        board = DbTimetableClient(stops[0], apiurl=self.url, pool=pool).current_board(NOW)
+        pool.close()
+        self.assertTrue(board.departures)
+        self.assertEqual(self.saved('Departure'), 12 * len(board.departures))
+        self.assertEqual(self.saved('Arrival'), 12 * len(board.arrivals))
+
+    def test_efa(self):
+        self.server.latency = 0.05
+        stops = [WatchedStop(uuid4(), 7000090 + i, 'Stop {}'.format(i)) for i in range(3)]
+        self.collect_once(stops, efa_jobs(stops, 'test', baseurl=self.url + '/nvbw/XML_DM_REQUEST'), 2)
+
+        self.assertEqual(self.server.requests, Counter(XML_DM_REQUEST=6))
+        self.assertEqual(self.server.max_active, 2)
+        self.assertEqual(self.saved('Departure'), 3 * 40)
+
+    def test_database_thread(self):
+        threads = set()
+        persist = Collector._persist
+        def recording_persist(collector, *args):
+            threads.add(threading.current_thread().name)
+            persist(collector, *args)
+
+        self.server.latency = 0.0
+        stops = [WatchedStop(uuid4(), 7000090, 'Stop')]
+        with patch.object(Collector, '_persist', recording_persist):
+            self.collect_once(stops, efa_jobs(stops, 'test', baseurl=self.url + '/nvbw/XML_DM_REQUEST'), 2)
+
+        # the boards are saved outside of the event loop, always by the same thread
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads.pop().startswith('db'))
+        self.assertEqual(self.saved('Departure'), 40)
+
+    def test_rollups(self):
+        self.server.latency = 0.0
+        stops = [WatchedStop(uuid4(), 7000090, 'Stop')]
+        collector = Collector(self.dbfile, stops, efa_jobs(stops, 'test', baseurl=self.url + '/nvbw/XML_DM_REQUEST'),
+                              rollup_interval=0.05)
+
+        async def collect_and_refresh():
+            await collector.collect_once()
+            try:
+                await asyncio.wait_for(collector._rollups(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+
+        try:
+            asyncio.run(collect_and_refresh())
+        finally:
+            collector.close()
+
+        # the saved departures are in the rollups without anyone reading them
+        self.assertEqual(self.saved('DepartureRollupDirty'), 0)
+        self.assertGreater(self.saved('DepartureDailyRollup'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+
+import unittest
+import math
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, date, time, timedelta
+from uuid import UUID
+from unittest.mock import patch
+
+from bahnstat.database import DatabaseConnection, DatabaseAccessor, DBVER_CURRENT, archive_path
+from bahnstat.datatypes import *
+from bahnstat.holidays_bw import day_type
+import legacyschema
+
+KARLSRUHE = WatchedStop(UUID('3ab3112f-ae16-4d68-9925-a9156dcffb00'), 7000090, 'Karlsruhe Hbf')
+MANNHEIM = WatchedStop(UUID('9a2f4c7e-3b8d-4f61-8e0a-5d2c1b7f6e93'), 6002417, 'Mannheim Hbf')
+
+def TestDb():
+    db = DatabaseAccessor(DatabaseConnection(':memory:'))
+    db.persist_watched_stop(KARLSRUHE)
+    return db
+
+class TestPersist(unittest.TestCase):
+    def test_batch(self):
+        db = TestDb()
+        t = datetime.now().replace(second=0, microsecond=0)
+
+        db.persist_departures(KARLSRUHE, [
+            Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', 0),
+            Departure(t + timedelta(minutes=8), 'RB 12438', 'Neustadt, Hauptbahnhof', 7000090, '12438', 'ddb:90S51: :R:j18', math.inf),
+            Departure(t + timedelta(minutes=18), 'S81 (AVG)', 'S81 Rastatt', 7000090, '19506', 'kvv:22081:E:H:j18', None),
+        ])
+
+        # a later board without delay must not erase a known delay, but a new delay replaces it
+        db.persist_departures(KARLSRUHE, [
+            Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', None),
+            Departure(t + timedelta(minutes=18), 'S81 (AVG)', 'S81 Rastatt', 7000090, '19506', 'kvv:22081:E:H:j18', 3),
+        ])
+
+        deps = sorted(db.departures(KARLSRUHE, daterange=1), key=lambda d: d.time)
+        self.assertEqual([d.train_name for d in deps], ['RB 38824', 'RB 12438', 'S81 (AVG)'])
+        self.assertEqual([d.delay for d in deps], [0, math.inf, 3])
+        self.assertEqual(deps[1].destination, 'Neustadt, Hauptbahnhof')
+        self.assertEqual(deps[2].line_code, 'kvv:22081:E:H:j18')
+
+    def test_single_arrival(self):
+        db = TestDb()
+        t = datetime.now().replace(second=0, microsecond=0)
+
+        db.persist_arrival(KARLSRUHE, Arrival(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', 2))
+
+        arrs = list(db.arrivals(KARLSRUHE, daterange=1))
+        self.assertEqual(len(arrs), 1)
+        self.assertEqual(arrs[0].origin, 'Mannheim, Hauptbahnhof')
+        self.assertEqual(arrs[0].delay, 2)
+
+class TestAggregates(unittest.TestCase):
+    def test_aggregated_trips(self):
+        db = TestDb()
+        db.persist_watched_stop(MANNHEIM)
+
+        for days_ago, dep_delay, arr_delay in [(1, 0, 2), (2, 1, 3), (3, 0, math.inf), (9, 10, 12)]:
+            t = datetime.combine(date.today() - timedelta(days=days_ago), time(8, 25))
+            db.persist_departure(KARLSRUHE, Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', dep_delay))
+            db.persist_arrival(MANNHEIM, Arrival(t + timedelta(minutes=52), 'RB 38824', 'Karlsruhe Hbf', 6002417, '38824', 'ddb:90700: :R:j18', arr_delay))
+
+        trips = list(db.aggregated_trips(KARLSRUHE, MANNHEIM, 'all', 7))
+        self.assertEqual(len(trips), 1)
+        self.assertEqual(trips[0].train_name, 'RB 38824')
+        self.assertEqual(trips[0].dep_time, time(8, 25))
+        self.assertEqual(trips[0].arr_time, time(9, 17))
+        self.assertEqual(trips[0].count, 3)
+        self.assertEqual(trips[0].dep_delay_median, 0)
+        self.assertEqual(trips[0].arr_delay_median, 3)
+        self.assertEqual(trips[0].arr_delay_90perc, math.inf)
+        self.assertEqual(trips[0].arr_delay_stdev, math.sqrt(0.5))
+
+        dates = db.aggregated_trip_dates(KARLSRUHE, MANNHEIM, 'all', 30)
+        self.assertEqual(dates.count, 4)
+        self.assertEqual(dates.last, date.today() - timedelta(days=1))
+
+        for t in ['mofr', 'sat', 'sun']:
+            expected = [d for d in [1, 2, 3, 9] if day_type(date.today() - timedelta(days=d)) == t]
+            self.assertEqual(db.aggregated_trip_dates(KARLSRUHE, MANNHEIM, t, 30).count, len(expected))
+            self.assertEqual(sum(a.count for a in db.aggregated_trips(KARLSRUHE, MANNHEIM, t, 30)), len(expected))
+
+        deps = list(db.aggregated_departures(KARLSRUHE))
+        self.assertEqual(len(deps), 1)
+        self.assertEqual(deps[0].time, time(8, 25))
+        self.assertEqual(deps[0].delay_median, 0.5)
+        self.assertEqual(deps[0].count, 4)
+
+class TestQueryPlans(unittest.TestCase):
+    def test_no_fact_table_scans(self):
+        db = TestDb()
+        db.persist_watched_stop(MANNHEIM)
+        t = datetime.combine(date.today() - timedelta(days=1), time(8, 25))
+        db.persist_departure(KARLSRUHE, Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', 0))
+        db.persist_arrival(MANNHEIM, Arrival(t + timedelta(minutes=52), 'RB 38824', 'Karlsruhe Hbf', 6002417, '38824', 'ddb:90700: :R:j18', 2))
+        db.connection.update_rollups()
+
+        statements = []
+        db.connection.conn.set_trace_callback(statements.append)
+        for datetype in ['all', 'sun']:
+            list(db.departures(KARLSRUHE, datetype, 30))
+            list(db.arrivals(MANNHEIM, datetype, 30))
+        list(db.trips(KARLSRUHE, MANNHEIM))
+        list(db.active_destinations(KARLSRUHE))
+        for datetype in ['all', 'mofr']:
+            list(db.aggregated_trips(KARLSRUHE, MANNHEIM, datetype, 30))
+            db.aggregated_trip_dates(KARLSRUHE, MANNHEIM, datetype, 30)
+        list(db.aggregated_departures(KARLSRUHE))
+        db.aggregated_departure_dates(KARLSRUHE)
+        db.connection.conn.set_trace_callback(None)
+
+        selects = [s for s in statements if s.lstrip().upper().startswith('SELECT')]
+        self.assertTrue(selects)
+        for s in selects:
+            for row in db.connection.exec('EXPLAIN QUERY PLAN ' + s):
+                self.assertNotRegex(row[-1], r'^SCAN (Departure|Arrival|TripObservation|TripDailyRollup|DepartureDailyRollup|Calendar)\b', s)
+
+class TestCalendar(unittest.TestCase):
+    def test_day_boundaries(self):
+        db = TestDb()
+        sunday = date.today() - timedelta(days=date.today().isoweekday() % 7 or 7)
+        for t in [time(0, 0), time(23, 59)]:
+            for d in [sunday - timedelta(days=1), sunday, sunday + timedelta(days=1)]:
+                db.persist_departure(KARLSRUHE, Departure(datetime.combine(d, t), 'RB 38824', 'Mannheim, Hauptbahnhof',
+                                                          7000090, str(d.day), 'ddb:90700: :R:j18', 0))
+
+        for datetype in ['mofr', 'sat', 'sun']:
+            self.assertEqual(sorted(x.time for x in db.departures(KARLSRUHE, datetype, 30)),
+                             sorted(datetime.combine(d, t) for d in [sunday - timedelta(days=1), sunday, sunday + timedelta(days=1)]
+                                    for t in [time(0, 0), time(23, 59)] if day_type(d) == datetype))
+
+    def test_stored(self):
+        with tempfile.TemporaryDirectory() as d:
+            dbfile = os.path.join(d, 'calendar.sqlite')
+            db = DatabaseConnection(dbfile)
+            db.exec("DELETE FROM Calendar WHERE date >= '2018-01-01'")
+            db.conn.close()
+
+            # read-only connections use the calendar as it is
+            with self.assertLogs('bahnstat.database', 'WARNING'):
+                db = DatabaseConnection(dbfile, read_only=True)
+            self.assertEqual(db.exec('SELECT MAX(date) FROM Calendar').fetchone()[0], '2017-12-31')
+            db.conn.close()
+
+            db = DatabaseConnection(dbfile)
+            self.assertEqual(db.exec('SELECT MAX(date) FROM Calendar').fetchone()[0],
+                             '{}-12-31'.format(date.today().year + 1))
+            self.assertEqual(db.exec("SELECT date_type, start_minute FROM Calendar WHERE date = '2018-05-21'").fetchone(),
+                             ('sun', 25447680))
+
+class TestTripObservation(unittest.TestCase):
+    def persist_trip(self, db, t, dep_delay, arr_delay):
+        db.persist_arrival(MANNHEIM, Arrival(t + timedelta(minutes=52), 'RB 38824', 'Karlsruhe Hbf', 6002417, '38824', 'ddb:90700: :R:j18', arr_delay))
+        db.persist_departure(KARLSRUHE, Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', dep_delay))
+
+    def test_triggers(self):
+        db = TestDb()
+        db.persist_watched_stop(MANNHEIM)
+        t = datetime.combine(date.today(), time(8, 25))
+
+        self.persist_trip(db, t, None, None)
+        self.assertEqual([(x.dep_delay, x.arr_delay) for x in db.trips(KARLSRUHE, MANNHEIM)], [(None, None)])
+
+        self.persist_trip(db, t, 2, math.inf)
+        self.assertEqual([(x.dep_delay, x.arr_delay) for x in db.trips(KARLSRUHE, MANNHEIM)], [(2, math.inf)])
+
+        # same trip code on the next day is a different trip
+        self.persist_trip(db, t + timedelta(days=1), 1, 1)
+        self.assertEqual(len(list(db.trips(KARLSRUHE, MANNHEIM))), 2)
+        self.assertEqual(list(db.trips(MANNHEIM, KARLSRUHE)), [])
+        self.assertEqual([s.name for s in db.active_destinations(KARLSRUHE)], ['Mannheim Hbf'])
+
+class TestRollups(unittest.TestCase):
+    def test_refresh(self):
+        db = TestDb()
+        db.persist_watched_stop(MANNHEIM)
+        t = datetime.combine(date.today() - timedelta(days=1), time(8, 25))
+
+        db.persist_departure(KARLSRUHE, Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', None))
+        db.persist_arrival(MANNHEIM, Arrival(t + timedelta(minutes=52), 'RB 38824', 'Karlsruhe Hbf', 6002417, '38824', 'ddb:90700: :R:j18', None))
+
+        # ingesting only marks the rollups as dirty, the accessors bring them up to date
+        self.assertEqual(db.connection.dirty_rollup_groups(), 2)
+        trip, = db.aggregated_trips(KARLSRUHE, MANNHEIM)
+        self.assertEqual(db.connection.dirty_rollup_groups(), 0)
+        self.assertEqual((trip.count, trip.dep_delay_median, trip.arr_delay_median), (1, None, None))
+
+        # a later delay update replaces the day's summary instead of adding to it
+        db.persist_departure(KARLSRUHE, Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', 4))
+        db.persist_arrival(MANNHEIM, Arrival(t + timedelta(minutes=52), 'RB 38824', 'Karlsruhe Hbf', 6002417, '38824', 'ddb:90700: :R:j18', 5))
+        with db.connection:
+            db.connection.refresh_rollups()
+        trip, = db.aggregated_trips(KARLSRUHE, MANNHEIM)
+        self.assertEqual((trip.count, trip.dep_delay_median, trip.arr_delay_median), (1, 4, 5))
+        dep, = db.aggregated_departures(KARLSRUHE)
+        self.assertEqual((dep.count, dep.delay_median), (1, 4))
+
+        self.assertEqual(db.connection.exec('SELECT COUNT(*) FROM TripRollupDirty').fetchone()[0], 0)
+        self.assertEqual(db.connection.exec('SELECT COUNT(*) FROM DepartureRollupDirty').fetchone()[0], 0)
+
+    def test_read_only_warns(self):
+        with tempfile.TemporaryDirectory() as d:
+            dbfile = os.path.join(d, 'db.sqlite')
+            db = DatabaseAccessor(DatabaseConnection(dbfile))
+            db.persist_watched_stop(KARLSRUHE)
+            db.persist_watched_stop(MANNHEIM)
+            t = datetime.combine(date.today() - timedelta(days=1), time(8, 25))
+            db.persist_departure(KARLSRUHE, Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', 1))
+            db.persist_arrival(MANNHEIM, Arrival(t + timedelta(minutes=52), 'RB 38824', 'Karlsruhe Hbf', 6002417, '38824', 'ddb:90700: :R:j18', 2))
+
+            # a report connection can't refresh the rollups, but says that they are behind
+            report = DatabaseAccessor(DatabaseConnection(dbfile, read_only=True))
+            with self.assertLogs('bahnstat.database', 'WARNING') as cm:
+                self.assertEqual(list(report.aggregated_trips(KARLSRUHE, MANNHEIM)), [])
+            self.assertIn('2 groups', cm.output[0])
+
+            db.connection.update_rollups()
+            trip, = report.aggregated_trips(KARLSRUHE, MANNHEIM)
+            self.assertEqual(trip.count, 1)
+
+def make_v6_db(dbfile):
+    """creates a database in the layout of schema v6, with the stops and dictionaries of the tests"""
+    conn = legacyschema.make_v6_db(dbfile)
+    conn.execute('INSERT INTO WatchedStop VALUES (1, ?, ?, ?, 1)', (str(KARLSRUHE.id), KARLSRUHE.backend_stop_id, KARLSRUHE.name))
+    conn.execute('INSERT INTO WatchedStop VALUES (2, ?, ?, ?, 1)', (str(MANNHEIM.id), MANNHEIM.backend_stop_id, MANNHEIM.name))
+    conn.execute("INSERT INTO LineCodeDictionary VALUES (1, 'ddb:90700: :R:j18')")
+    conn.execute("INSERT INTO OriginDestinationDictionary VALUES (1, 'Mannheim, Hauptbahnhof'), (2, 'Karlsruhe Hbf')")
+    conn.execute("INSERT INTO TrainNameDictionary VALUES (1, 'RB 38824')")
+    return conn
+
+class TestMigration(unittest.TestCase):
+    def test_from_v6(self):
+        with tempfile.TemporaryDirectory() as d:
+            dbfile = os.path.join(d, 'v6.sqlite')
+            conn = make_v6_db(dbfile)
+            days = [(1, 0.0, 2.0, '38824'), (2, 1.0, 3.0, '38824'), (3, 0.0, math.inf, '38824'), (4, None, None, '038824')]
+            for days_ago, dep_delay, arr_delay, trip_code in days:
+                t = datetime.combine(date.today() - timedelta(days=days_ago), time(8, 25))
+                conn.execute('INSERT INTO Departure VALUES (1, ?, ?, ?, 1, 1, 1)', (str(t), dep_delay, trip_code))
+                conn.execute('INSERT INTO Arrival VALUES (2, ?, ?, ?, 1, 2, 1)', (str(t + timedelta(minutes=52)), arr_delay, trip_code))
+            conn.commit()
+            conn.close()
+
+            db = DatabaseAccessor(DatabaseConnection(dbfile))
+
+            deps = sorted(db.departures(KARLSRUHE, daterange=30), key=lambda d: d.time)
+            self.assertEqual([d.time for d in deps], [datetime.combine(date.today() - timedelta(days=x[0]), time(8, 25)) for x in reversed(days)])
+            self.assertEqual([d.delay for d in deps], [x[1] for x in reversed(days)])
+            self.assertEqual([d.trip_code for d in deps], [x[3] for x in reversed(days)])
+            self.assertEqual(deps[0].train_name, 'RB 38824')
+            self.assertEqual([a.delay for a in sorted(db.arrivals(MANNHEIM, daterange=30), key=lambda a: a.time)],
+                             [x[2] for x in reversed(days)])
+
+            self.assertEqual(sorted((x.dep_delay, x.arr_delay) for x in db.trips(KARLSRUHE, MANNHEIM) if x.dep_delay is not None),
+                             [(0, 2), (0, math.inf), (1, 3)])
+
+            trip, = db.aggregated_trips(KARLSRUHE, MANNHEIM, 'all', 30)
+            self.assertEqual((trip.count, trip.dep_delay_median, trip.arr_delay_median), (4, 0, 3))
+            self.assertEqual(db.aggregated_departure_dates(KARLSRUHE).count, 4)
+
+            # later observations continue the converted rows
+            t = datetime.combine(date.today() - timedelta(days=1), time(8, 25))
+            db.persist_departure(KARLSRUHE, Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, 38824, 'ddb:90700: :R:j18', 5))
+            self.assertEqual(len(list(db.departures(KARLSRUHE, daterange=30))), 4)
+            trip, = db.aggregated_trips(KARLSRUHE, MANNHEIM, 'all', 30)
+            self.assertEqual(trip.dep_delay_median, 1)
+
+    def test_resume(self):
+        class Crash(Exception):
+            pass
+
+        class CrashingConnection(DatabaseConnection):
+            # fails on the n-th batch of a chunked copy
+            batches = 0
+            def exec(self, sql, **params):
+                if 'lo' in params:
+                    CrashingConnection.batches += 1
+                    if CrashingConnection.batches == self.crash_at:
+                        raise Crash()
+                return super().exec(sql, **params)
+
+        # with 10 rows in batches of 3, 2 crashes in the v7 trip backfill,
+        # 6 and 10 in the v10 copies of Departure and Arrival
+        for crash_at in [2, 6, 10]:
+            with self.subTest(crash_at=crash_at), tempfile.TemporaryDirectory() as d, \
+                    patch('bahnstat.database.MIGRATION_BATCH_SIZE', 3):
+                dbfile = os.path.join(d, 'v6.sqlite')
+                conn = make_v6_db(dbfile)
+                for days_ago in range(1, 11):
+                    t = datetime.combine(date.today() - timedelta(days=days_ago), time(8, 25))
+                    conn.execute('INSERT INTO Departure VALUES (1, ?, ?, 38824, 1, 1, 1)', (str(t), days_ago))
+                    conn.execute('INSERT INTO Arrival VALUES (2, ?, ?, 38824, 1, 2, 1)', (str(t + timedelta(minutes=52)), days_ago))
+                conn.commit()
+                conn.close()
+
+                CrashingConnection.batches = 0
+                CrashingConnection.crash_at = crash_at
+                with self.assertRaises(Crash):
+                    CrashingConnection(dbfile)
+
+                with self.assertRaises(sqlite3.OperationalError):
+                    DatabaseConnection(dbfile, read_only=True)
+
+                db = DatabaseAccessor(DatabaseConnection(dbfile))
+                self.assertEqual(db.connection.exec('PRAGMA user_version').fetchone()[0], DBVER_CURRENT)
+                self.assertEqual(db.connection.exec('SELECT COUNT(*) FROM MigrationProgress').fetchone()[0], 0)
+                self.assertEqual(sorted(x.delay for x in db.departures(KARLSRUHE, daterange=30)), list(range(1, 11)))
+                self.assertEqual(sorted(x.delay for x in db.arrivals(MANNHEIM, daterange=30)), list(range(1, 11)))
+                self.assertEqual(len(list(db.trips(KARLSRUHE, MANNHEIM))), 10)
+                trip, = db.aggregated_trips(KARLSRUHE, MANNHEIM, 'all', 30)
+                self.assertEqual(trip.count, 10)
+
+    def test_concurrent(self):
+        class InterruptedConnection(DatabaseConnection):
+            # lets a second connection migrate the database after the n-th transaction
+            transactions = 0
+            def __exit__(self, type, value, traceback):
+                result = super().__exit__(type, value, traceback)
+                InterruptedConnection.transactions += 1
+                if InterruptedConnection.transactions == self.interrupt_at:
+                    DatabaseConnection(self.dbfile).conn.close()
+                return result
+
+        # the migration of 10 rows in batches of 3 takes 30 transactions
+        for interrupt_at in [1, 2, 5, 9, 14, 20, 25, 29]:
+            with self.subTest(interrupt_at=interrupt_at), tempfile.TemporaryDirectory() as d, \
+                    patch('bahnstat.database.MIGRATION_BATCH_SIZE', 3):
+                dbfile = os.path.join(d, 'v6.sqlite')
+                conn = make_v6_db(dbfile)
+                for days_ago in range(1, 11):
+                    t = datetime.combine(date.today() - timedelta(days=days_ago), time(8, 25))
+                    conn.execute('INSERT INTO Departure VALUES (1, ?, ?, 38824, 1, 1, 1)', (str(t), days_ago))
+                    conn.execute('INSERT INTO Arrival VALUES (2, ?, ?, 38824, 1, 2, 1)', (str(t + timedelta(minutes=52)), days_ago))
+                conn.commit()
+                conn.close()
+
+                InterruptedConnection.transactions = 0
+                InterruptedConnection.interrupt_at = interrupt_at
+                db = DatabaseAccessor(InterruptedConnection(dbfile))
+
+                self.assertEqual(db.connection.exec('PRAGMA user_version').fetchone()[0], DBVER_CURRENT)
+                self.assertEqual(db.connection.exec('SELECT COUNT(*) FROM MigrationProgress').fetchone()[0], 0)
+                self.assertEqual(sorted(x.delay for x in db.departures(KARLSRUHE, daterange=30)), list(range(1, 11)))
+                self.assertEqual(sorted(x.delay for x in db.arrivals(MANNHEIM, daterange=30)), list(range(1, 11)))
+                self.assertEqual(len(list(db.trips(KARLSRUHE, MANNHEIM))), 10)
+                trip, = db.aggregated_trips(KARLSRUHE, MANNHEIM, 'all', 30)
+                self.assertEqual(trip.count, 10)
+
+    def test_auto_vacuum(self):
+        with tempfile.TemporaryDirectory() as d:
+            # new databases can give back free pages without a full VACUUM
+            db = DatabaseConnection(os.path.join(d, 'new.sqlite'), wal=True)
+            self.assertEqual(db.exec('PRAGMA auto_vacuum').fetchone()[0], 2)
+
+            dbfile = os.path.join(d, 'v6.sqlite')
+            make_v6_db(dbfile).close()
+            db = DatabaseConnection(dbfile)
+            self.assertEqual(db.exec('PRAGMA auto_vacuum').fetchone()[0], 0)
+            self.assertEqual(db.incremental_vacuum(), 0)
+            db.vacuum()
+            self.assertEqual(db.exec('PRAGMA auto_vacuum').fetchone()[0], 2)
+
+            db.exec('CREATE TABLE Filler(x BLOB)')
+            db.exec('INSERT INTO Filler SELECT randomblob(1000) FROM Calendar')
+            db.exec('DROP TABLE Filler')
+            self.assertGreater(db.incremental_vacuum(pages=16), 0)
+            self.assertEqual(db.exec('PRAGMA freelist_count').fetchone()[0], 0)
+
+class TestDictionaryCache(unittest.TestCase):
+    def test_warm(self):
+        db = TestDb()
+        db.persist_departure(KARLSRUHE, Departure(datetime.now(), 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', 0))
+
+        db2 = DatabaseAccessor(db.connection)
+        self.assertIn('RB 38824', db2._train_name_pks)
+        self.assertIn('ddb:90700: :R:j18', db2._line_code_pks)
+        self.assertIn('Mannheim, Hauptbahnhof', db2._origin_destination_pks)
+
+    def test_rollback(self):
+        db = TestDb()
+        with db._transaction():
+            db._persist_line_code('kvv:22081:E:H:j18')
+
+        with self.assertRaises(ValueError):
+            with db._transaction():
+                self.assertEqual(db._persist_line_code('kvv:22081:E:H:j18'), 1)
+                self.assertEqual(db._persist_line_code('ddb:90700: :R:j18'), 2)
+                raise ValueError()
+
+        self.assertIn('kvv:22081:E:H:j18', db._line_code_pks)
+        self.assertNotIn('ddb:90700: :R:j18', db._line_code_pks)
+
+        with db._transaction():
+            self.assertEqual(db._persist_line_code('ddb:90700: :R:j18'), 2)
+        self.assertEqual(db.connection.exec('SELECT COUNT(*) FROM LineCodeDictionary').fetchone()[0], 2)
+
+class TestPartitions(unittest.TestCase):
+    def test_roll_over(self):
+        with tempfile.TemporaryDirectory() as d:
+            dbfile = os.path.join(d, 'bahnstat.sqlite')
+            db = DatabaseAccessor(DatabaseConnection(dbfile))
+            db.persist_watched_stop(KARLSRUHE)
+            db.persist_watched_stop(MANNHEIM)
+
+            old = datetime(date.today().year - 1, 6, 1, 8, 25)
+            new = datetime.combine(date.today() - timedelta(days=1), time(8, 25))
+            for t in [old, new]:
+                db.persist_departure(KARLSRUHE, Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', 1))
+                db.persist_arrival(MANNHEIM, Arrival(t + timedelta(minutes=52), 'RB 38824', 'Karlsruhe Hbf', 6002417, '38824', 'ddb:90700: :R:j18', 2))
+
+            with self.assertRaises(ValueError):
+                db.connection.roll_over(date.today().year)
+
+            moved = db.connection.roll_over(old.year)
+            self.assertEqual(dict(moved), {'Departure': 1, 'Arrival': 1, 'TripObservation': 1})
+
+            # the rollups are computed from the archive, if the rows were rolled over before
+            self.assertEqual(db.connection.update_rollups(), 4)
+            self.assertEqual(list(db.connection.archives), [])
+            self.assertTrue(os.path.exists(os.path.join(d, 'bahnstat.{}.sqlite'.format(old.year))))
+            self.assertEqual(db.connection.exec('SELECT COUNT(*) FROM main.Departure').fetchone()[0], 1)
+
+            # short windows don't touch the archive, and archives are only attached while in use
+            with db.connection.partitions('Departure', date.today()) as source:
+                self.assertNotIn('archive_', source)
+                self.assertEqual(list(db.connection.archives), [])
+            with db.connection.partitions('Departure') as source:
+                self.assertIn('archive_', source)
+                self.assertEqual(list(db.connection.archives), [old.year])
+            self.assertEqual(list(db.connection.archives), [])
+
+            reader = DatabaseAccessor(DatabaseConnection(dbfile, read_only=True))
+            self.assertEqual(list(reader.connection.archives), [])
+            self.assertEqual([x.time for x in reader.departures(KARLSRUHE, daterange=1)], [new])
+            self.assertEqual(sorted(x.time for x in reader.departures(KARLSRUHE, daterange=800)), [old, new])
+            self.assertEqual(len(list(reader.trips(KARLSRUHE, MANNHEIM))), 2)
+            self.assertEqual([s.name for s in reader.active_destinations(KARLSRUHE)], ['Mannheim Hbf'])
+
+            # the rollups stay in the main file
+            self.assertEqual(sum(a.count for a in reader.aggregated_trips(KARLSRUHE, MANNHEIM, 'all', 800)), 2)
+            self.assertEqual(list(reader.connection.archives), [])
+
+            # late rows are moved by another rollover
+            db.persist_departure(KARLSRUHE, Departure(old + timedelta(days=1), 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', 1))
+            self.assertEqual(db.connection.roll_over(old.year)['Departure'], 1)
+            self.assertEqual(len(list(db.departures(KARLSRUHE, daterange=800))), 3)
+
+    def test_outdated_archive(self):
+        with tempfile.TemporaryDirectory() as d:
+            dbfile = os.path.join(d, 'bahnstat.sqlite')
+            DatabaseConnection(dbfile).conn.close()
+            year = date.today().year - 1
+            archive = sqlite3.connect(archive_path(dbfile, year))
+            archive.execute('CREATE TABLE Unrelated(x)')
+            archive.close()
+
+            # opening the database leaves the archive alone, only queries using it fail
+            db = DatabaseAccessor(DatabaseConnection(dbfile))
+            db.persist_watched_stop(KARLSRUHE)
+            self.assertEqual(list(db.departures(KARLSRUHE, daterange=1)), [])
+            with self.assertRaises(sqlite3.OperationalError):
+                list(db.departures(KARLSRUHE, daterange=800))
+            self.assertEqual(list(db.connection.archives), [])
+
+            db.connection.roll_over(year)
+            self.assertEqual(list(db.departures(KARLSRUHE, daterange=800)), [])
+
+class TestRetention(unittest.TestCase):
+    def test_prune(self):
+        db = DatabaseAccessor(DatabaseConnection(':memory:'))
+        db.persist_watched_stop(KARLSRUHE)
+        db.persist_watched_stop(MANNHEIM)
+
+        old = datetime.combine(date.today() - timedelta(days=500), time(8, 25))
+        new = datetime.combine(date.today() - timedelta(days=1), time(8, 25))
+        for t, line_code in [(old, 'ddb:90700: :R:j18'), (new, 'kvv:22081:E:H:j18')]:
+            db.persist_departure(KARLSRUHE, Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', line_code, 1))
+            db.persist_arrival(MANNHEIM, Arrival(t + timedelta(minutes=52), 'RB 38824', 'Karlsruhe Hbf', 6002417, '38824', line_code, 2))
+
+        # another process, which has the soon removed line code in its cache
+        collector = DatabaseAccessor(db.connection)
+        self.assertIn('ddb:90700: :R:j18', collector._line_code_pks)
+
+        with self.assertRaises(ValueError):
+            db.connection.prune(400, rollup_days=30)
+
+        deleted = db.connection.prune()
+        self.assertEqual((deleted['Departure'], deleted['Arrival'], deleted['TripObservation']), (1, 1, 1))
+        self.assertEqual(deleted['LineCodeDictionary'], 1)
+        self.assertEqual(deleted['OriginDestinationDictionary'], 0)
+
+        self.assertEqual([d.time for d in db.departures(KARLSRUHE, daterange=800)], [new])
+        self.assertEqual(len(list(db.trips(KARLSRUHE, MANNHEIM))), 1)
+
+        # the rollups still know the old observations
+        self.assertEqual(db.aggregated_departure_dates(KARLSRUHE).count, 2)
+        self.assertEqual(sum(a.count for a in db.aggregated_trips(KARLSRUHE, MANNHEIM, 'all', 800)), 2)
+
+        # removing dictionary entries is announced, and the other process clears its
+        # caches when it writes next
+        self.assertEqual(db.connection.exec('SELECT generation FROM DictionaryGeneration').fetchone()[0], 1)
+        self.assertIn('ddb:90700: :R:j18', collector._line_code_pks)
+        collector.persist_departure(KARLSRUHE, Departure(new + timedelta(days=1), 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', 0))
+        self.assertEqual(collector._line_code_pks.get('ddb:90700: :R:j18'), 3)
+        self.assertEqual(len(list(db.departures(KARLSRUHE, daterange=800))), 2)
+
+        deleted = db.connection.prune(rollup_days=400)
+        self.assertEqual(deleted['DepartureDailyRollup'], 1)
+        self.assertEqual(db.aggregated_departure_dates(KARLSRUHE).count, 2)
+
+class TestWal(unittest.TestCase):
+    def test_read_while_writing(self):
+        with tempfile.TemporaryDirectory() as d:
+            dbfile = os.path.join(d, 'wal.sqlite')
+            writer = DatabaseAccessor(DatabaseConnection(dbfile, wal=True, busy_timeout=0.1))
+            writer.persist_watched_stop(KARLSRUHE)
+            self.assertEqual(writer.connection.journal_mode, 'wal')
+
+            reader = DatabaseAccessor(DatabaseConnection(dbfile, read_only=True, busy_timeout=0.1))
+            reader.connection.exec('BEGIN')
+            self.assertEqual(len(list(reader.all_watched_stops())), 1)
+
+            # an open read transaction must neither block nor see the writer
+            t = datetime.now()
+            writer.persist_departure(KARLSRUHE, Departure(t, 'RB 38824', 'Mannheim, Hauptbahnhof', 7000090, '38824', 'ddb:90700: :R:j18', 0))
+            self.assertEqual(len(list(reader.departures(KARLSRUHE, daterange=1))), 0)
+            reader.connection.exec('COMMIT')
+            self.assertEqual(len(list(reader.departures(KARLSRUHE, daterange=1))), 1)
+
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.persist_watched_stop(KARLSRUHE)
+
+            busy, log, checkpointed = writer.connection.checkpoint('TRUNCATE')
+            self.assertEqual(busy, 0)
+
+if __name__ == '__main__':
+    unittest.main()
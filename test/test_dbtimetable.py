@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import unittest
+import io
+import os
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import UUID
+
+from bahnstat.apicache import ApiResponseCache
+from bahnstat.datatypes import WatchedStop
+from bahnstat.dbtimetableclient import DbTimetableClient, _TimetableChangeIntegrator, _parse_stops
+from bahnstat.httppool import HttpConnectionPool
+
+KARLSRUHE = WatchedStop(UUID('ec5ff5c2-1c7a-4d4e-9e56-e6cabdd2ce29'), 8000191, 'Karlsruhe Hbf')
+NOW = datetime(2018, 5, 22, 8, 15)
+
+def TestCaseBytes(filename):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testcases', filename), 'rb') as f:
+        return f.read()
+
+class ApiStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        kind = self.path.split('/')[1]
+        self.server.requests[kind] += 1
+
+        if kind == 'plan':
+            body = TestCaseBytes('dbtimetable plan karlsruhe.xml')
+        elif kind == 'fchg':
+            body = TestCaseBytes('dbtimetable fchg karlsruhe.xml')
+        else:
+            body = b"<?xml version='1.0' encoding='UTF-8'?><timetable station='Karlsruhe Hbf'/>"
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def board_key(board):
+    return [(d.time, d.train_name, d.destination, d.delay) for d in board.departures]
+
+class TestWarmRestart(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ApiStandInHandler)
+        self.server.requests = Counter()
+        threading.Thread(target=self.server.serve_forever, kwargs=dict(poll_interval=0.01), daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmpdir.name, 'api.cache')
+        self.pool = HttpConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def client(self):
+        return DbTimetableClient(KARLSRUHE, apiurl=self.url, pool=self.pool, cache=ApiResponseCache(self.cache_file))
+
+    def test_restart(self):
+        first = self.client()
+        board = first.current_board(NOW)
+        self.assertEqual(self.server.requests, Counter(plan=3, fchg=1))
+        self.assertEqual(first.api_requests, 4)
+        self.assertTrue(board.departures)
+
+        # a restarted client only asks for the recent changes
+        self.server.requests.clear()
+        restarted = self.client()
+        self.assertEqual(board_key(restarted.current_board(NOW)), board_key(board))
+        self.assertEqual(self.server.requests, Counter(rchg=1))
+
+        # the journal now has an rchg entry, which is replayed as well
+        self.server.requests.clear()
+        self.assertEqual(board_key(self.client().current_board(NOW)), board_key(board))
+        self.assertEqual(self.server.requests, Counter(rchg=1))
+
+    def test_outdated_changes(self):
+        self.client().current_board(NOW)
+
+        cache = ApiResponseCache(self.cache_file)
+        cache.conn.execute('UPDATE ChangeJournal SET fetched = fetched - 600')
+
+        # the changes are too old for rchg, but the plans can still be used
+        self.server.requests.clear()
+        self.client().current_board(NOW)
+        self.assertEqual(self.server.requests, Counter(fchg=1))
+
+        # a later slice isn't cached yet
+        self.server.requests.clear()
+        self.client().current_board(NOW + timedelta(hours=1))
+        self.assertEqual(self.server.requests, Counter(plan=1, fchg=1))
+
+class FakeApi:
+    """the plan slice and fchg fixtures, and a settable rchg response"""
+    cache = None
+    eva_id = KARLSRUHE.backend_stop_id
+
+    def __init__(self):
+        self.plan_stops = _parse_stops(io.BytesIO(TestCaseBytes('dbtimetable plan karlsruhe.xml')))
+        self.rchg = b"<?xml version='1.0' encoding='UTF-8'?><timetable station='Karlsruhe Hbf'/>"
+
+    def plan(self, timeslice):
+        return self.plan_stops
+
+    def changes(self, kind):
+        body = TestCaseBytes('dbtimetable fchg karlsruhe.xml') if kind == 'fchg' else self.rchg
+        return body, _parse_stops(io.BytesIO(body))
+
+def event_state(stops):
+    return [(s.id, s.label and vars(s.label), s.arrival and vars(s.arrival), s.departure and vars(s.departure))
+            for s in stops]
+
+class TestChangeIntegrator(unittest.TestCase):
+    TIMESLICES = {datetime(2018, 5, 22, 8)}
+
+    def test_changes(self):
+        api = FakeApi()
+        plan = event_state(api.plan_stops)
+        integrator = _TimetableChangeIntegrator(api)
+
+        stops = integrator.stops_with_changes(self.TIMESLICES)
+        self.assertEqual(integrator.changed, {s.id for s in stops})
+
+        # the changes were not merged into the cached plan
+        self.assertEqual(event_state(api.plan_stops), plan)
+
+        integrator.stops_with_changes(self.TIMESLICES)
+        self.assertEqual(integrator.changed, set())
+
+        s = next(s for s in stops if s.departure is not None and s.departure.changed_time is None)
+        api.rchg = """<timetable station='Karlsruhe Hbf'><s id='{}'><dp ct='{:%y%m%d%H%M}'/></s></timetable>""".format(
+            s.id, s.departure.planned_time + timedelta(minutes=5)).encode()
+
+        again = integrator.stops_with_changes(self.TIMESLICES)
+        self.assertEqual(integrator.changed, {s.id})
+        self.assertEqual(next(x for x in again if x.id == s.id).departure.delay, 5)
+        self.assertIs(next(x for x in again if x.id == s.id), s)
+
+        # the same change again is no change
+        integrator.stops_with_changes(self.TIMESLICES)
+        self.assertEqual(integrator.changed, set())
+
+    def test_eviction(self):
+        integrator = _TimetableChangeIntegrator(FakeApi())
+        stops = integrator.stops_with_changes(self.TIMESLICES, datetime(2018, 5, 22))
+        self.assertTrue(stops)
+
+        cutoff = sorted(s.hide_after_timestamp for s in stops)[len(stops) // 2]
+        kept = integrator.stops_with_changes(self.TIMESLICES, cutoff)
+        self.assertEqual({s.id for s in kept}, {s.id for s in stops if s.hide_after_timestamp >= cutoff})
+        self.assertLess(len(kept), len(stops))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import unittest
+import math
+import random
+import statistics
+
+from bahnstat.database import DatabaseConnection
+from bahnstat.delaystats import DelayStats, DelaySummary, _select
+
+def sorted_percentile(values, q):
+    """the q-th percentile by sorting, as the separate percentile() aggregate computed it"""
+    l = sorted(values)
+    k = len(l) * q / 100
+    c = math.ceil(k)
+
+    if k == c and 0 < c < len(l):
+        return (l[c-1] + l[c]) / 2
+    else:
+        return l[min(max(c, 1), len(l)) - 1]
+
+class TestDelayStats(unittest.TestCase):
+    def test_same_as_sorting(self):
+        rnd = random.Random(1)
+        db = DatabaseConnection(':memory:')
+        db.exec('CREATE TEMP TABLE Delays(grp INTEGER, delay REAL)')
+        db.execmany('INSERT INTO Delays VALUES (:g, :d)',
+                    [dict(g=g, d=rnd.choice([None, math.inf, rnd.randrange(-2, 30), rnd.uniform(-2, 30)]))
+                     for g in range(50) for i in range(rnd.randrange(1, 40))])
+
+        for grp, stats in db.exec('SELECT grp, delay_stats(delay, 90, 75) FROM Delays GROUP BY grp').fetchall():
+            values = [v for v, in db.exec('SELECT delay FROM Delays WHERE grp = :g AND delay IS NOT NULL', g=grp)]
+            finite = [v for v in values if math.isfinite(v)]
+
+            s = DelayStats.from_sql(stats)
+            self.assertEqual(s.count, len(values))
+            self.assertEqual(s.nonfinite, len(values) - len(finite))
+            if values:
+                self.assertEqual(s.median, statistics.median(values))
+                self.assertEqual(s.quantile(90), sorted_percentile(values, 90))
+                self.assertEqual(s.quantile(75), sorted_percentile(values, 75))
+            else:
+                self.assertIsNone(s.median)
+            if len(finite) < 2:
+                self.assertIsNone(s.stdev)
+            else:
+                self.assertAlmostEqual(s.stdev, statistics.stdev(finite))
+
+    def test_select(self):
+        rnd = random.Random(4)
+        for n in [1, 2, 3, 10, 100, 1000]:
+            for values in [[rnd.randrange(-2, 30) for i in range(n)], [rnd.uniform(-2, 30) for i in range(n)],
+                           list(range(n)), list(range(n, 0, -1)), [7] * n]:
+                ranks = {rnd.randrange(n) for i in range(5)} | {0, n - 1}
+                before = list(values)
+                self.assertEqual(_select(values, ranks), {r: sorted(values)[r] for r in ranks})
+                self.assertEqual(values, before)
+
+    def test_counts(self):
+        s = DelayStats.from_values([1, 3, math.inf, 2, math.inf], [90])
+        self.assertEqual(s.count, 5)
+        self.assertEqual(s.nonfinite, 2)
+        self.assertEqual(s.median, 3)
+        self.assertEqual(s.quantile(90), math.inf)
+        self.assertEqual(s.stdev, 1)
+
+        s = DelayStats.from_values([])
+        self.assertEqual(s.count, 0)
+        self.assertIsNone(s.median)
+        self.assertIsNone(s.stdev)
+
+class TestDelaySummary(unittest.TestCase):
+    def test_merged_days_same_as_raw_values(self):
+        rnd = random.Random(2)
+        days = [[rnd.choice([None, math.inf, rnd.randrange(-2, 30)]) for i in range(rnd.randrange(0, 5))]
+                for d in range(100)]
+
+        merged = DelaySummary()
+        for day in days:
+            s = DelaySummary()
+            for v in day:
+                s.add(v)
+            merged.merge(DelaySummary.from_sql(s.to_sql()))
+
+        exact = DelayStats.from_values([v for day in days for v in day if v is not None], [90])
+        stats = merged.stats([90])
+        self.assertEqual(stats.count, exact.count)
+        self.assertEqual(stats.nonfinite, exact.nonfinite)
+        self.assertEqual(stats.median, exact.median)
+        self.assertEqual(stats.quantile(90), exact.quantile(90))
+        self.assertAlmostEqual(stats.stdev, exact.stdev)
+
+    def test_accuracy_bound(self):
+        rnd = random.Random(3)
+        db = DatabaseConnection(':memory:')
+        db.exec('CREATE TEMP TABLE Delays(grp INTEGER, day INTEGER, delay REAL)')
+        db.execmany('INSERT INTO Delays VALUES (:g, :d, :v)',
+                    [dict(g=g, d=rnd.randrange(30), v=rnd.choice([math.inf, rnd.uniform(-5, 60), rnd.expovariate(1/300)]))
+                     for g in range(20) for i in range(rnd.randrange(2, 200))])
+
+        for grp, exact_stats in db.exec('SELECT grp, delay_stats(delay, 90) FROM Delays GROUP BY grp').fetchall():
+            exact_stats = DelayStats.from_sql(exact_stats)
+            median, p90, stdev = exact_stats.median, exact_stats.quantile(90), exact_stats.stdev
+            merged, = db.exec('''
+                SELECT delay_summary_merge(per_day)
+                FROM (SELECT delay_summary(delay) AS per_day FROM Delays WHERE grp = :g GROUP BY day)''', g=grp).fetchone()
+            stats = DelaySummary.from_sql(merged).stats([90])
+
+            for exact, approx in [(median, stats.median), (p90, stats.quantile(90))]:
+                if math.isinf(exact):
+                    self.assertEqual(approx, exact)
+                else:
+                    self.assertLessEqual(abs(approx - exact), max(0.5, 0.01 * abs(exact)))
+
+            # the stdev moves by at most the largest error of a single value
+            finite = [v for v, in db.exec('SELECT delay FROM Delays WHERE grp = :g', g=grp) if math.isfinite(v)]
+            bound = max(max(0.5, 0.01 * abs(v)) for v in finite) * math.sqrt(len(finite) / (len(finite) - 1))
+            self.assertLessEqual(abs(stats.stdev - stdev), bound)
+
+    def test_blob_size(self):
+        s = DelaySummary()
+        for v in [0, 3, 3, math.inf, 5000]:
+            s.add(v)
+        self.assertEqual(len(s.to_sql()), 4 + 3 * 6)
+        self.assertEqual(DelaySummary.from_sql(s.to_sql()).counts, s.counts)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import threading
+from uuid import uuid4
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bahnstat.datatypes import WatchedStop
+from bahnstat.efaxmlclient import EfaXmlClient
+from bahnstat.mechanize_mini import HTTPException
+
+DM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testcases', 'XML_DM_REQUEST zugausfall rb neustadt.xml')
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """a stand-in for the EFA, which redirects or answers with HTML depending on the path"""
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        self.server.cookies.append(self.headers.get('Cookie'))
+
+        status, headers, body = 200, {'Content-Type': 'text/html; charset=utf-8'}, b''
+        if path == '/XML_DM_REQUEST':
+            with open(DM, 'rb') as f:
+                headers, body = {'Content-Type': 'text/xml'}, f.read()
+        elif path == '/moved/XML_DM_REQUEST':
+            status, headers = 302, {'Location': '/XML_DM_REQUEST?' + query, 'Set-Cookie': 'session=42; Path=/'}
+        elif path == '/interstitial/XML_DM_REQUEST':
+            body = '<meta http-equiv="refresh" content="0; url=/XML_DM_REQUEST?{}">'.format(query).encode()
+        elif path == '/maintenance/XML_DM_REQUEST':
+            body = b'<p>Wartungsarbeiten</p>'
+        else:
+            status, body = 404, b'not found'
+
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestEfaXmlClient(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.cookies = []
+        threading.Thread(target=self.server.serve_forever, kwargs=dict(poll_interval=0.01), daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.stop = WatchedStop(uuid4(), 7000090, 'Karlsruhe Hbf')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def departures(self, path):
+        return EfaXmlClient('test', baseurl=self.url + path).departure_monitor(self.stop).departures
+
+    def test_streamed(self):
+        deps = self.departures('/XML_DM_REQUEST')
+        self.assertEqual(len(deps), 40)
+        self.assertEqual(deps[0].train_name, 'RB 38824')
+
+    def test_redirects(self):
+        # the cookie set with the redirect is sent to its target
+        self.assertEqual(len(self.departures('/moved/XML_DM_REQUEST')), 40)
+        self.assertEqual(self.server.cookies, [None, 'session=42'])
+
+        self.assertEqual(len(self.departures('/interstitial/XML_DM_REQUEST')), 40)
+
+    def test_not_xml(self):
+        with self.assertRaisesRegex(ValueError, 'got text/html'):
+            self.departures('/maintenance/XML_DM_REQUEST')
+
+        with self.assertRaises(HTTPException):
+            self.departures('/missing/XML_DM_REQUEST')
+
+if __name__ == '__main__':
+    unittest.main()
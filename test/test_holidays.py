@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+import unittest
+from datetime import date
+
+from bahnstat.holidays_bw import *
+
+class TestHolidays(unittest.TestCase):
+    def test_easter(self):
+        self.assertEqual(easter_sunday(2018), date(2018, 4, 1))
+        self.assertEqual(easter_sunday(2019), date(2019, 4, 21))
+        self.assertEqual(easter_sunday(2024), date(2024, 3, 31))
+        self.assertEqual(easter_sunday(2038), date(2038, 4, 25))
+
+    def test_2019(self):
+        self.assertEqual(set(holidays(2019)), {
+            date(2019, 1, 1), date(2019, 1, 6), date(2019, 4, 19), date(2019, 4, 22),
+            date(2019, 5, 1), date(2019, 5, 30), date(2019, 6, 10), date(2019, 6, 20),
+            date(2019, 10, 3), date(2019, 11, 1), date(2019, 12, 25), date(2019, 12, 26) })
+
+    def test_day_type(self):
+        self.assertEqual(day_type(date(2018, 5, 22)), 'mofr')
+        self.assertEqual(day_type(date(2018, 5, 26)), 'sat')
+        self.assertEqual(day_type(date(2018, 5, 27)), 'sun')
+        self.assertEqual(day_type(date(2018, 5, 31)), 'sun') # Fronleichnam
+        self.assertEqual(day_type(date(2017, 10, 31)), 'sun') # Reformationstag
+
+if __name__ == '__main__':
+    unittest.main()
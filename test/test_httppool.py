@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import unittest
+import gzip
+import os
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+
+from bahnstat.httppool import HttpConnectionPool
+from bahnstat.dbtimetableclient import _ApiClient
+
+FCHG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testcases', 'dbtimetable fchg karlsruhe.xml')
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """a stand-in for the API server, which keeps connections alive"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+
+        if self.path.startswith('/fchg/'):
+            with open(FCHG, 'rb') as f:
+                body = f.read()
+        elif self.path == '/hello':
+            body = b'hello' * 100
+        else:
+            body = b'not found'
+
+        self.send_response(200 if body != b'not found' else 404)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        # hang up without telling the client, like servers do with idle connections
+        self.close_connection = self.server.hang_up
+
+    def log_message(self, format, *args):
+        pass
+
+class TestHttpConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.connections = set()
+        self.server.hang_up = False
+        threading.Thread(target=self.server.serve_forever, kwargs=dict(poll_interval=0.01), daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.pool = HttpConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        first = self.pool.get(self.url + '/hello')
+        second = self.pool.get(self.url + '/hello')
+
+        self.assertEqual(second.body, b'hello' * 100)
+        self.assertEqual((first.reused, second.reused), (False, True))
+        self.assertGreater(second.elapsed, 0)
+        self.assertEqual(len(self.server.connections), 1)
+
+        # the stand-in compressed the body
+        self.assertEqual(second.headers['Content-Encoding'], 'gzip')
+
+    def test_stale_connection(self):
+        self.server.hang_up = True
+        self.pool.get(self.url + '/hello')
+
+        r = self.pool.get(self.url + '/hello')
+        self.assertEqual(r.body, b'hello' * 100)
+        self.assertFalse(r.reused)
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_idle_timeout(self):
+        pool = HttpConnectionPool(idle_timeout=0)
+        pool.get(self.url + '/hello')
+        self.assertFalse(pool.get(self.url + '/hello').reused)
+        pool.close()
+
+    def test_error(self):
+        with self.assertRaises(HTTPError) as cm:
+            self.pool.get(self.url + '/missing')
+        self.assertEqual(cm.exception.code, 404)
+
+        # the connection is still good
+        self.assertTrue(self.pool.get(self.url + '/hello').reused)
+
+    def test_api_client(self):
+        # stations share the pool, and with it the connection
+        clients = [_ApiClient(eva_id, self.url, 'key', self.pool) for eva_id in [8000191, 8000290]]
+        stops = [c.fchg() for c in clients]
+
+        self.assertEqual(len(stops[0]), 37)
+        self.assertEqual(stops[0][0].departure.changed_time, datetime(2018, 5, 22, 8, 12))
+        self.assertEqual(len(self.server.connections), 1)
+
+if __name__ == '__main__':
+    unittest.main()
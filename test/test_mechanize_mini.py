@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import email
+import http.client
+import io
+import os
+import unittest
+from urllib.response import addinfourl
+
+import bahnstat.mechanize_mini as minimech
+
+DOC = '''<div id="a" class="x"><div id="b"><p id="c">foo</p></div><p id="d" class="x y">bar</p></div>'''
+
+def ids(elements):
+    return [e.id for e in elements]
+
+def document(body, charset='utf-8', url='http://example.com/'):
+    headers = email.message_from_string('Content-Type: text/html; charset={}\n'.format(charset),
+                                        _class=http.client.HTTPMessage)
+    return minimech.Document(None, addinfourl(io.BytesIO(body), headers, url, 200))
+
+class TestSelectors(unittest.TestCase):
+    def setUp(self):
+        self.root = minimech.HTML(DOC)
+
+    def test_select(self):
+        self.assertEqual(ids(self.root.query_selector_all('p')), ['c', 'd'])
+        self.assertEqual(ids(self.root.query_selector_all('.x')), ['d'])
+        self.assertEqual(ids(self.root.query_selector_all('div > p')), ['c'])
+        self.assertEqual(ids(self.root.query_selector_all('p:contains(bar)')), ['d'])
+        self.assertEqual(ids(self.root.query_selector_all('')), [])
+        self.assertEqual(self.root.query_selector('#nope'), None)
+
+        # both divs have p#c as descendant, but it is returned once
+        outer = minimech.HTML('<section>' + DOC + '</section>')
+        self.assertEqual(ids(outer.query_selector_all('div p')), ['c', 'd'])
+        self.assertEqual(outer.query_selector('div p').id, 'c')
+
+    def test_compiled(self):
+        sel = minimech.compile_selector('div p')
+        self.assertIs(minimech.compile_selector('div p'), sel)
+        self.assertEqual(ids(sel.select_all(self.root)), ['c'])
+        self.assertEqual(sel.select(self.root).id, 'c')
+
+        with self.assertRaises(minimech.InvalidSelectorError):
+            minimech.compile_selector('div $')
+
+class TestElements(unittest.TestCase):
+    def test_shared_containers(self):
+        root = minimech.HTML('<ul><li>a<li>b</ul>')
+        a, b = root
+
+        a.attrib['class'] = 'x'
+        a.set('id', 'y')
+        a.append(minimech.HTML('<i>c</i>'))
+        self.assertEqual(b.attrib, {})
+        self.assertEqual(len(b), 0)
+        self.assertEqual(root.outer_html, '<ul><li class="x" id="y">a<i>c</i></li><li>b</li></ul>')
+
+        with self.assertRaises(AttributeError):
+            b.foo = 1
+
+        # slices are lists, whether the children are still shared or not
+        self.assertEqual(b[0:2], [])
+        self.assertEqual(root[0:1], [a])
+        self.assertIsInstance(b[0:2], list)
+
+    def test_classes(self):
+        form = minimech.HTML('<form><input name=a><textarea></textarea><select><option>x</select><a href=x>y</a></form>')
+        self.assertEqual([type(e).__name__ for e in form.iter()],
+                         ['HtmlFormElement', 'HtmlInputElement', 'HtmlTextareaElement', 'HtmlSelectElement',
+                          'HtmlOptionElement', 'HtmlAnchorElement'])
+        self.assertIsInstance(minimech.HtmlInputElement('TEXTAREA'), minimech.HtmlTextareaElement)
+
+class TestCharset(unittest.TestCase):
+    def test_testcases(self):
+        for name, charset in [('XML_DM_REQUEST zugausfall rb neustadt.xml', 'cp1252'),
+                              ('dbtimetable plan karlsruhe.xml', 'utf-8')]:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testcases', name), 'rb') as f:
+                self.assertEqual(minimech.detect_charset(f.read()), charset)
+
+    def test_prescan(self):
+        self.assertEqual(minimech.detect_charset(b'<meta charset="koi8-r"><p>x</p>'), 'koi8-r')
+        self.assertEqual(minimech.detect_charset(b'<meta http-equiv="Content-Type" content="text/html; charset=UTF-8">'), 'utf-8')
+        self.assertEqual(minimech.detect_charset(b'<meta charset="utf-16">'), 'utf-8')
+        self.assertEqual(minimech.detect_charset(b'<meta charset="koi8-r">', 'utf-8'), 'utf-8')
+        self.assertEqual(minimech.detect_charset(b'\xef\xbb\xbf<meta charset="koi8-r">'), 'utf-8')
+
+        # only the first 1024 bytes count
+        self.assertEqual(minimech.detect_charset(b' ' * 1024 + b'<meta charset="koi8-r">'), 'cp1252')
+
+        # the XML declaration before meta tags, unless it names an unknown encoding
+        self.assertEqual(minimech.detect_charset(b'<?xml version="1.0" encoding="utf-8"?><meta charset="koi8-r">'), 'utf-8')
+        self.assertEqual(minimech.detect_charset(b'<?xml version="1.0" encoding="nope"?><meta charset="koi8-r">'), 'koi8-r')
+
+class TestDocumentIndex(unittest.TestCase):
+    def test_same_as_walk(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testcases', 'XML_DM_REQUEST zugausfall rb neustadt.xml')
+        with open(path, 'rb') as f:
+            body = f.read()
+
+        doc = document(body, 'iso-8859-1')
+        tree = minimech.parsehtmlbytes(body, 'iso-8859-1')
+        for sel in ['itdDeparture', 'itdDepartureList itdDeparture', 'itdDeparture > itdServingLine',
+                    'itdOdvName odvNameElem', 'itdDateTime itdDate', 'itdServingLine:contains(Rastatt)', '*']:
+            indexed = [e.outer_xml for e in doc.query_selector_all(sel)]
+            walked = [e.outer_xml for e in minimech.compile_selector(sel).select_all(tree, include_self=True)]
+            self.assertEqual(indexed, walked, sel)
+            self.assertGreater(len(indexed), 0, sel)
+
+        # on a subtree
+        dep = doc.query_selector('itdDeparture')
+        self.assertEqual([e.outer_xml for e in dep.query_selector_all('itdDate')],
+                         [e.outer_xml for e in tree.query_selector('itdDeparture').query_selector_all('itdDate')])
+
+    def test_root(self):
+        doc = document(b'<html><body><div id="a"><p class="x">one</p></div></body></html>')
+        html = doc.document_element
+        body = html.query_selector('body')
+        self.assertIs(doc.query_selector('html'), html)
+        self.assertIs(doc.query_selector('html body'), body)
+        self.assertIs(doc.query_selector('html > body'), body)
+        self.assertIs(doc.query_selector('html > div'), None)
+        self.assertEqual([e.tag for e in doc.query_selector_all('*')], ['html', 'body', 'div', 'p'])
+
+        # elements still only search below themselves
+        self.assertIs(html.query_selector('html'), None)
+        self.assertIs(body.query_selector('body div'), None)
+
+    def test_mutation(self):
+        doc = document(b'<html><body><div id="a"><p class="x">one</p></div></body></html>')
+        div = doc.query_selector('#a')
+        self.assertEqual(len(list(doc.query_selector_all('.x'))), 1)
+
+        p = doc.create_element('p', {'class': 'x'})
+        div.append(p)
+        self.assertEqual(list(doc.query_selector_all('div .x'))[1], p)
+
+        p.id = 'b'
+        self.assertIs(doc.query_selector('#b'), p)
+
+        div.remove(p)
+        self.assertIsNone(doc.query_selector('#b'))
+        self.assertEqual(list(div.query_selector_all('#b')), [])
+
+        div.inner_html = '<span class="x">two</span>'
+        self.assertEqual([e.tag for e in doc.query_selector_all('.x')], ['span'])
+
+    def test_attribute_and_tag_mutation(self):
+        doc = document(b'<html><body><div id="a"><p class="x">one</p></div></body></html>')
+        p = doc.query_selector('p')
+
+        p.attrib['id'] = 'z'
+        self.assertIs(doc.query_selector('#z'), p)
+        p.attrib['class'] = 'y'
+        self.assertIsNone(doc.query_selector('.x'))
+        self.assertIs(doc.query_selector('div > .y'), p)
+        del p.attrib['id']
+        self.assertIsNone(doc.query_selector('#z'))
+
+        p.tag = 'span'
+        self.assertIs(doc.query_selector('span'), p)
+        self.assertIsNone(doc.query_selector('p'))
+        self.assertIs(doc.query_selector('html div span'), p)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,23 +1,43 @@
 #!/usr/bin/env python3
 
 import unittest
+import io
 import os
 import math
 from datetime import datetime, date
 from uuid import UUID
+from xml.dom.minidom import parse as domparse
 
 from bahnstat.efaxmlclient import _departure_monitor_from_response as departure_monitor_from_response
+from bahnstat.efaxmlclient import parse_monitor
 import bahnstat.mechanize_mini as minimech
+from bahnstat.dbtimetableclient import DbTimetableStop, _parse_stops
+
+def TestCasePath(filename):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testcases', filename)
 
 def TestCaseXml(filename):
     with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testcases', filename), 'r', encoding='latin-1') as f:
         return minimech.HTML(f.read())
 
 class TestDmParser(unittest.TestCase):
-    def test_basic(self):
-        xml = TestCaseXml('XML_DM_REQUEST zugausfall rb neustadt.xml')
-        dm = departure_monitor_from_response(xml)
+    FILENAME = 'XML_DM_REQUEST zugausfall rb neustadt.xml'
+
+    def streamed(self, mode):
+        with open(TestCasePath(self.FILENAME), 'rb') as f:
+            return parse_monitor(f, mode)
+
+    def test_tree(self):
+        self.check_basic(departure_monitor_from_response(TestCaseXml(self.FILENAME)))
+
+    def test_streaming(self):
+        self.check_basic(self.streamed('dep'))
 
+    def test_same_result(self):
+        xml = TestCaseXml(self.FILENAME)
+        self.assertEqual(plain(self.streamed('dep')), plain(departure_monitor_from_response(xml)))
+
+    def check_basic(self, dm):
         self.assertEqual(dm.now, datetime(2018, 5, 22, 8, 15, 9))
         self.assertEqual(dm.stop_gid, 'de:08212:90')
         self.assertEqual(dm.stop_name, 'Karlsruhe, Karlsruhe Hbf')
@@ -48,5 +68,62 @@ class TestDmParser(unittest.TestCase):
         self.assertEqual(dm.departures[3].trip_code, '19506')
         self.assertEqual(dm.departures[3].stop_id, '7000090')
 
+def plain(obj):
+    """nested tuples of the attribute values, for comparing parser results"""
+    if isinstance(obj, list):
+        return [plain(x) for x in obj]
+    elif hasattr(obj, '__dict__'):
+        return (type(obj).__name__,) + tuple(sorted((k, plain(v)) for k, v in vars(obj).items()))
+    else:
+        return obj
+
+class TestDbTimetableParser(unittest.TestCase):
+    def parse_both(self, xml):
+        dom = [DbTimetableStop.from_domnode(s) for s in domparse(io.BytesIO(xml)).getElementsByTagName('s')]
+        streamed = _parse_stops(io.BytesIO(xml))
+
+        self.assertEqual(plain(streamed), plain(dom))
+        return streamed
+
+    def parse_testcase(self, filename):
+        with open(TestCasePath(filename), 'rb') as f:
+            return self.parse_both(f.read())
+
+    def test_plan(self):
+        stops = self.parse_testcase('dbtimetable plan karlsruhe.xml')
+        self.assertEqual(len(stops), 60)
+
+        s = stops[0]
+        self.assertEqual(s.id, '3007621696699967246-1805220806-12')
+        self.assertEqual((s.label.category, s.label.number, s.label.filter_flags), ('IC', '20772', 'F'))
+        self.assertEqual(s.arrival.planned_time, datetime(2018, 5, 22, 8, 3))
+        self.assertEqual(s.arrival.origin, 'Heidelberg Hbf')
+        self.assertEqual(s.departure.destination, 'Stuttgart Hbf')
+        self.assertEqual(s.departure.planned_platform, '2')
+        self.assertIsNone(s.departure.changed_time)
+
+    def test_changes(self):
+        stops = self.parse_testcase('dbtimetable fchg karlsruhe.xml')
+
+        s = stops[0]
+        self.assertIsNone(s.label)
+        self.assertEqual(s.departure.changed_time, datetime(2018, 5, 22, 8, 12))
+
+        cancelled = [s for s in stops if s.departure is not None and s.departure.cancelled]
+        self.assertTrue(cancelled)
+        self.assertEqual(cancelled[0].departure.delay, math.inf)
+
+        extra = stops[-1]
+        self.assertEqual(extra.id_trip, -123456789012345678)
+        self.assertEqual(extra.departure.delay, 2)
+
+    def test_nested(self):
+        # every <s> takes the first matching elements inside of it, like getElementsByTagName()
+        outer, inner = self.parse_both(b'''<timetable><s id="1-1805220800-1"><dp pt="1805220801"/>
+            <s id="2-1805220800-2"><ar pt="1805220802"/><dp pt="1805220803"/></s></s></timetable>''')
+        self.assertEqual(outer.departure.planned_time, datetime(2018, 5, 22, 8, 1))
+        self.assertEqual(outer.arrival.planned_time, datetime(2018, 5, 22, 8, 2))
+        self.assertEqual(inner.departure.planned_time, datetime(2018, 5, 22, 8, 3))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from bahnstat.scheduling import TokenBucket, StalestFirstScheduler
+from bahnstat.dbrunner import sustainable_stations, sync_interval
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_and_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(0.5, 2, clock=clock, sleep=clock.sleep)
+
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertFalse(bucket.try_acquire())
+
+        self.assertAlmostEqual(bucket.acquire(), 2.0)
+        self.assertAlmostEqual(clock.now, 1002.0)
+
+        # the bucket never holds more than its capacity
+        clock.now += 100
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_window(self):
+        clock = FakeClock()
+        bucket = TokenBucket(18 / 60, 2, clock=clock, sleep=clock.sleep)
+
+        times = []
+        for i in range(100):
+            bucket.acquire()
+            times.append(clock.now)
+
+        for i, t in enumerate(times):
+            self.assertLessEqual(sum(1 for u in times[i:] if u < t + 60), 20)
+
+class TestStalestFirstScheduler(unittest.TestCase):
+    def test_order(self):
+        clock = FakeClock()
+        s = StalestFirstScheduler(['a', 'b', 'c'], 10, clock=clock, sleep=clock.sleep)
+
+        served = []
+        for i in range(7):
+            item = s.next()
+            served.append(item)
+            clock.now += 1
+            s.done(item)
+
+        self.assertEqual(served, ['a', 'b', 'c', 'a', 'b', 'c', 'a'])
+
+        # every item waits min_interval after it was done, which took 1 s each
+        self.assertEqual(clock.now, 1023)
+
+        count, mean, longest = s.interval_stats()
+        self.assertEqual(count, 4)
+        self.assertEqual(mean, 11)
+        self.assertEqual(longest, 11)
+        self.assertEqual(s.interval_stats(), (0, 0.0, 0.0))
+
+class TestBudget(unittest.TestCase):
+    def test_sustainable_stations(self):
+        self.assertEqual(sustainable_stations(20, 60), 19)
+        self.assertEqual(sustainable_stations(20, 300), 85)
+        self.assertAlmostEqual(sync_interval(20, 19), 3600 / (1200 / 19 - 2))
+        self.assertEqual(sync_interval(20, 1000), float('inf'))
+
+if __name__ == '__main__':
+    unittest.main()